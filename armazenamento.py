@@ -0,0 +1,301 @@
+# encoding: utf-8
+
+from __future__ import print_function
+
+import os
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import metricas
+
+
+# Backend de armazenamento usado pelos modelos (usuários, leilões e lances):
+#   'json'   -> arquivos json, como sempre foi (lances.json, leiloes.json e
+#               usuarios.json, mais os diários lances.jsonl, leiloes.jsonl
+#               e usuarios.jsonl)
+#   'sqlite' -> um banco sqlite3 em modo WAL (leilao.db), com uma tabela por
+#               modelo
+# Pode ser escolhido pela variável de ambiente LEILAO_ARMAZENAMENTO.
+BACKEND = os.environ.get('LEILAO_ARMAZENAMENTO', 'json')
+
+# Diretório dos arquivos de dados. Por padrão, o diretório dos módulos; pode
+# ser trocado pela variável de ambiente LEILAO_DADOS (cada fragmento do
+# modo com vários processos tem o seu; veja fragmentos.py).
+DATA_DIR = (os.environ.get('LEILAO_DADOS') or
+            os.path.dirname(os.path.abspath(__file__)))
+
+SQLITE_FILENAME = os.path.join(DATA_DIR, 'leilao.db')
+
+# Número de linhas do diário a partir do qual ele é compactado numa nova
+# base (veja JournalStorage.compact)
+COMPACT_LINES = 10000
+
+
+class Storage(object):
+    # Interface comum dos backends. Os registros são dicionários no formato
+    # dos arquivos json e todos têm a chave 'id'. Os modelos mantêm os seus
+    # dados em memória; o backend só é lido na inicialização (load) e
+    # recebe as alterações em lotes (commit).
+
+    def load(self):
+        # Retorna a lista de todos os registros, em ordem de id.
+        raise NotImplementedError
+
+    def commit(self, saved=(), deleted=()):
+        # Grava, de uma só vez, os registros novos ou alterados (saved) e
+        # apaga os registros cujos ids estão em deleted.
+        raise NotImplementedError
+
+    def needs_compaction(self):
+        # Retorna True se o backend acumulou alterações que valem uma
+        # compactação (veja compact).
+        return False
+
+    def compact(self, snapshot):
+        # Troca o histórico de alterações por uma cópia do estado atual.
+        # snapshot é uma função que retorna todos os registros; ela é
+        # chamada com a lock do backend em mãos, de modo que nenhum commit
+        # fica de fora da cópia.
+        pass
+
+    def close(self):
+        pass
+
+
+class JsonStorage(Storage):
+    # Um arquivo json com a lista completa dos registros. Cada commit
+    # reescreve o arquivo inteiro a partir de uma cópia em memória.
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.records = OrderedDict()
+        self.lock = threading.RLock()
+
+    def load(self):
+        with self.lock:
+            if not os.path.exists(self.filename):
+                return []
+
+            with open(self.filename) as f:
+                records = sorted(json.load(f), key=lambda r: r['id'])
+
+            self.records = OrderedDict((r['id'], r) for r in records)
+            return records
+
+    def commit(self, saved=(), deleted=()):
+        with self.lock:
+            for r in saved:
+                self.records[r['id']] = r
+            for id in deleted:
+                self.records.pop(id, None)
+
+            with open(self.filename, 'w') as f:
+                json.dump(list(self.records.values()), f)
+
+
+class JournalStorage(Storage):
+    # Um arquivo json servindo de base e um diário (json por linha) com as
+    # alterações posteriores: cada registro salvo é uma linha com o
+    # registro completo e cada deleção é uma lápide {"id": ..., "deleted":
+    # true}. Um commit é uma única escrita no fim do diário.
+    # De tempos em tempos (veja COMPACT_LINES), a base é regravada com o
+    # estado atual e o diário é esvaziado, mantendo a leitura na
+    # inicialização rápida.
+
+    def __init__(self, filename, journal_filename):
+        self.filename = filename
+        self.journal_filename = journal_filename
+        self.journal = None
+        self.lines = 0  # linhas no diário
+        self.lock = threading.RLock()
+
+    def load(self):
+        # Lê a base e reaplica o diário por cima dela, em ordem. Uma última
+        # linha incompleta (servidor interrompido no meio da escrita) é
+        # ignorada.
+        with self.lock:
+            records = OrderedDict()
+
+            if os.path.exists(self.filename):
+                with open(self.filename) as f:
+                    for r in json.load(f):
+                        records[r['id']] = r
+
+            self.lines = 0
+            if os.path.exists(self.journal_filename):
+                with open(self.journal_filename) as f:
+                    for line in f:
+                        self.lines += 1
+                        try:
+                            r = json.loads(line)
+                        except ValueError:
+                            continue
+
+                        if r.get('deleted'):
+                            records.pop(r['id'], None)
+                        else:
+                            records.pop(r['id'], None)
+                            records[r['id']] = r
+
+            return sorted(records.values(), key=lambda r: r['id'])
+
+    def commit(self, saved=(), deleted=()):
+        lines = [json.dumps(r) + '\n' for r in saved]
+        lines.extend(json.dumps({'id': id, 'deleted': True}) + '\n'
+                     for id in deleted)
+
+        with self.lock:
+            if self.journal is None:
+                self.journal = open(self.journal_filename, 'a')
+
+                # Se a última linha ficou pela metade, começa uma nova para
+                # não emendar o próximo registro nela.
+                if self.journal.tell() > 0:
+                    with open(self.journal_filename, 'rb') as f:
+                        f.seek(-1, os.SEEK_END)
+                        if f.read(1) != b'\n':
+                            self.journal.write('\n')
+
+            self.journal.write(''.join(lines))
+            self.journal.flush()
+            self.lines += len(lines)
+
+    def needs_compaction(self):
+        return self.lines >= COMPACT_LINES
+
+    def compact(self, snapshot):
+        # A nova base é gravada num arquivo temporário, que depois toma o
+        # lugar da antiga de uma só vez; só então o diário é esvaziado. Se
+        # o servidor cair entre os dois passos, reaplicar o diário sobre a
+        # nova base dá o mesmo resultado.
+        with self.lock:
+            records = snapshot()
+
+            tmp = self.filename + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(records, f, separators=(',', ':'))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, self.filename)
+
+            self.close()
+            open(self.journal_filename, 'w').close()
+            self.lines = 0
+
+    def close(self):
+        with self.lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+
+
+class SqliteStorage(Storage):
+    # Uma tabela do banco sqlite3, em modo WAL: as escritas não bloqueiam
+    # leitores concorrentes (outros processos ou ferramentas lendo o
+    # banco), e cada commit altera só as linhas envolvidas, numa única
+    # transação. O registro completo fica na coluna data, em json. Como nos
+    # outros backends, o banco só é lido na inicialização; as consultas são
+    # respondidas pelos índices em memória de cada modelo (veja
+    # lances.BidStore).
+
+    def __init__(self, filename, table):
+        self.table = table
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(filename, timeout=30,
+                                  check_same_thread=False)
+
+        with self.lock:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS %s (id INTEGER PRIMARY KEY, '
+                'user_id INTEGER, auction_id INTEGER, data TEXT NOT NULL)'
+                % table)
+            self.db.commit()
+
+    def load(self):
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT data FROM %s ORDER BY id' % self.table)
+            return [json.loads(data) for data, in rows]
+
+    def commit(self, saved=(), deleted=()):
+        with self.lock:
+            with self.db:  # uma transação para o lote inteiro
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO %s (id, user_id, auction_id, data) '
+                    'VALUES (?, ?, ?, ?)' % self.table,
+                    [(r['id'], r.get('user_id'), r.get('auction_id'),
+                      json.dumps(r)) for r in saved])
+                self.db.executemany(
+                    'DELETE FROM %s WHERE id = ?' % self.table,
+                    [(id,) for id in deleted])
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class TimedStorage(Storage):
+    # Envolve um backend, medindo a duração de load (leitura e
+    # interpretação dos registros) e de commit, e contando os registros
+    # gravados e apagados. Os demais métodos passam direto ao backend.
+
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.name = 'armazenamento.' + name
+
+    def __getattr__(self, attr):
+        return getattr(self.storage, attr)
+
+    def load(self):
+        with metricas.timer(self.name + '.load'):
+            return self.storage.load()
+
+    def commit(self, saved=(), deleted=()):
+        with metricas.timer(self.name + '.commit'):
+            self.storage.commit(saved, deleted)
+
+        metricas.count(self.name + '.gravados', len(saved))
+        metricas.count(self.name + '.apagados', len(deleted))
+
+    def needs_compaction(self):
+        return self.storage.needs_compaction()
+
+    def compact(self, snapshot):
+        with metricas.timer(self.name + '.compactacao'):
+            self.storage.compact(snapshot)
+
+    def close(self):
+        self.storage.close()
+
+
+def open_storage(table, filename, journal_filename=None,
+                 sqlite_filename=None):
+    # Abre o armazenamento de um modelo conforme o BACKEND escolhido.
+    # table é o nome da tabela no sqlite; filename (e journal_filename,
+    # para usar o diário) são os arquivos do backend json, e
+    # sqlite_filename é o banco do backend sqlite (por padrão,
+    # SQLITE_FILENAME).
+    # Na primeira vez que o backend sqlite é usado, uma tabela vazia
+    # recebe os registros que já existiam nos arquivos json.
+    if journal_filename is not None:
+        json_storage = JournalStorage(filename, journal_filename)
+    else:
+        json_storage = JsonStorage(filename)
+
+    if BACKEND == 'json':
+        return TimedStorage(json_storage, table)
+
+    if BACKEND != 'sqlite':
+        raise ValueError('Backend de armazenamento desconhecido: %s' % BACKEND)
+
+    storage = SqliteStorage(sqlite_filename or SQLITE_FILENAME, table)
+    if not storage.load():
+        records = json_storage.load()
+        if records:
+            storage.commit(records)
+
+    return TimedStorage(storage, table)
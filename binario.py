@@ -0,0 +1,187 @@
+# encoding: utf-8
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import mmap
+import time
+import struct
+from datetime import datetime
+
+import armazenamento
+
+
+# Formato binário dos lances (lances.bin), usado com
+# LEILAO_LANCES=binario (veja lances.PERSISTENCE).
+#
+# O arquivo tem um cabeçalho (HEADER: assinatura e número de linhas) e
+# linhas de tamanho fixo (RECORD), uma por lance:
+#   id, user_id, auction_id (inteiros de 64 bits), value e o instante do
+# lance em segundos desde a época (doubles), em little-endian.
+# O lance de id i fica na linha i - 1, de modo que a posição de um lance é
+# calculada direto do id. Uma linha com id 0 é um lance apagado (ou um id
+# que nunca foi usado). O arquivo cresce em blocos e é lido e escrito por
+# mmap: as consultas desempacotam só as linhas pedidas, sem montar um
+# dicionário por lance.
+#
+# Conversão de e para o formato json (com o servidor parado):
+#   python binario.py para-binario [diretório de dados]
+#   python binario.py para-json [diretório de dados]
+# para-binario lê lances.json e o diário lances.jsonl e grava lances.bin;
+# para-json lê lances.bin, grava lances.json e esvazia o diário.
+
+MAGIC = b'LANCES01'
+HEADER = struct.Struct('<8sQ')
+RECORD = struct.Struct('<qqqdd')
+
+# Linhas reservadas quando o arquivo é criado; a capacidade dobra sempre
+# que acaba.
+INITIAL_ROWS = 1024
+
+
+class BidFile(object):
+    # Um arquivo de lances no formato binário, mapeado em memória. Não tem
+    # lock própria: quem usa (veja lances.BinaryBidStore) serializa os
+    # acessos, pois o mapa é trocado quando o arquivo cresce.
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+
+        new = os.fstat(self.fd).st_size < HEADER.size
+        if new:
+            os.ftruncate(self.fd, HEADER.size + INITIAL_ROWS * RECORD.size)
+
+        self.map = mmap.mmap(self.fd, 0)
+        if new:
+            HEADER.pack_into(self.map, 0, MAGIC, 0)
+
+        magic, self.rows = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('Arquivo de lances inválido: %s' % filename)
+
+        self.rows = min(self.rows, self.capacity())
+
+    def capacity(self):
+        return (len(self.map) - HEADER.size) // RECORD.size
+
+    def read(self, row):
+        # Retorna a tupla (id, user_id, auction_id, value, instante) da
+        # linha, ou None se ela não existe.
+        if not 0 <= row < self.rows:
+            return None
+
+        return RECORD.unpack_from(self.map, HEADER.size + row * RECORD.size)
+
+    def scan(self, rows):
+        # Tuplas das linhas informadas, pulando os lances apagados.
+        result = []
+        for row in rows:
+            r = RECORD.unpack_from(self.map, HEADER.size + row * RECORD.size)
+            if r[0]:
+                result.append(r)
+        return result
+
+    def write(self, row, record):
+        # Grava a tupla record na linha, aumentando o arquivo se preciso.
+        # O número de linhas do cabeçalho só é atualizado depois da linha,
+        # de modo que uma escrita interrompida nunca é lida.
+        if row >= self.capacity():
+            self._grow(row + 1)
+
+        RECORD.pack_into(self.map, HEADER.size + row * RECORD.size, *record)
+
+        if row >= self.rows:
+            self.rows = row + 1
+            HEADER.pack_into(self.map, 0, MAGIC, self.rows)
+
+    def erase(self, row):
+        self.write(row, (0, 0, 0, 0.0, 0.0))
+
+    def _grow(self, rows):
+        capacity = max(self.capacity(), INITIAL_ROWS)
+        while capacity < rows:
+            capacity *= 2
+
+        self.map.close()
+        os.ftruncate(self.fd, HEADER.size + capacity * RECORD.size)
+        self.map = mmap.mmap(self.fd, 0)
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+def to_record(b):
+    # Converte um lance no formato json para uma tupla do formato binário.
+    return (b['id'], b['user_id'], b['auction_id'], b['value'],
+            time.mktime(datetime(*b['bid_date']).timetuple()))
+
+
+def to_dict(r):
+    # Converte uma tupla do formato binário para um lance no formato json.
+    return {'id': r[0], 'user_id': r[1], 'auction_id': r[2], 'value': r[3],
+            'bid_date': list(datetime.fromtimestamp(r[4]).timetuple()[:6])}
+
+
+def from_json(filename, journal_filename, binary_filename):
+    # Grava em binary_filename os lances da base json e do diário. O
+    # arquivo é montado num temporário e só então toma o lugar do destino.
+    records = armazenamento.JournalStorage(filename, journal_filename).load()
+
+    tmp = binary_filename + '.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+
+    f = BidFile(tmp)
+    try:
+        for b in records:
+            f.write(b['id'] - 1, to_record(b))
+        f.flush()
+    finally:
+        f.close()
+
+    os.rename(tmp, binary_filename)
+    return len(records)
+
+
+def to_json(binary_filename, filename, journal_filename):
+    # Grava em filename (a base json) os lances do arquivo binário e
+    # esvazia o diário, que passaria a ser reaplicado sobre a nova base.
+    f = BidFile(binary_filename)
+    try:
+        records = [to_dict(r) for r in f.scan(range(f.rows))]
+    finally:
+        f.close()
+
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as out:
+        json.dump(records, out)
+    os.rename(tmp, filename)
+
+    open(journal_filename, 'w').close()
+    return len(records)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3) or \
+            sys.argv[1] not in ('para-binario', 'para-json'):
+        raise SystemExit('Uso: python binario.py para-binario|para-json '
+                         '[diretório de dados]')
+
+    directory = sys.argv[2] if len(sys.argv) == 3 else armazenamento.DATA_DIR
+    names = [os.path.join(directory, name)
+             for name in ('lances.json', 'lances.jsonl', 'lances.bin')]
+
+    if sys.argv[1] == 'para-binario':
+        n = from_json(*names)
+        print('%d lances gravados em %s' % (n, names[2]))
+    else:
+        n = to_json(names[2], names[0], names[1])
+        print('%d lances gravados em %s' % (n, names[0]))
@@ -1,13 +1,17 @@
 # encoding: utf-8
 
+from collections import OrderedDict
+
+import sequenciador
 from lances import Bid
-from leiloes import Auction
+from leiloes import Auction, STATUSES
 from usuarios import User
 
 client_commands = [
     'apaga_usuario',
     'entrar_leilao',
     'enviar_lance',
+    'enviar_lances',
     'lanca_produto',
     'lista_leiloes',
     'sair',
@@ -19,6 +23,7 @@ client_commands_anonymous = [
     'adiciona_usuario',
     'faz_login',
     'lista_leiloes',
+    'protocolo',
 ]
 
 
@@ -41,13 +46,46 @@ server_commands = [
 # Comandos de usuários logados
 
 def lista_leiloes(user=None, data=None):
-    # Função para listar os leilões. Carrega todos os leilões em uma
-    # lista e envia para o usuário.
-    auctions = Auction.all() #reotrno a lista com todos os leilões cadastrados
+    # Função para listar os leilões. Sem argumentos, usa o texto da
+    # listagem completa mantido em cache pela classe Auction.
+    # Aceita também filtros no formato chave=valor, em qualquer ordem:
+    #   status=aberto|agendado|encerrado
+    #   vendedor=<nome do vendedor>
+    #   cursor=<id do último leilão recebido>
+    #   limite=<número máximo de leilões, a partir de 1>
+    # Ex.: lista_leiloes,status=aberto,cursor=20,limite=10
+    # Quando há mais leilões depois da página, a resposta traz a linha
+    # `cursor,<id>` antes do ok, com o cursor da próxima página.
+    args = data.split(',')[1:] if data else []
+
+    if not args:
+        return Auction.listing() + '\nok'
+
+    filters = dict(arg.split('=', 1) for arg in args)
+    status = filters.pop('status', None)
+    seller = filters.pop('vendedor', None)
+    cursor = int(filters.pop('cursor', 0))
+    limit = filters.pop('limite', None)
+    if limit is not None:
+        limit = int(limit)
+
+    if (filters or (status is not None and status not in STATUSES) or
+            (limit is not None and limit < 1)):
+        raise Exception('not_ok')
 
-    msg = '\n'.join(str(a) for a in auctions) + '\nok' #join 
+    user_id = None
+    if seller is not None:
+        user_id = User.id_by_name(seller)
+        if user_id is None:  # Vendedor inexistente: nenhum leilão
+            return '\nok'
+
+    lines, next_cursor = Auction.page(status, user_id, cursor, limit)
+
+    if next_cursor is not None:
+        lines.append('cursor,%d' % next_cursor)
+
+    return '\n'.join(lines) + '\nok'
 
-    return msg
 
 
 def apaga_usuario(user, data):
@@ -70,9 +108,7 @@ def entrar_leilao(user, data):
     command, auction_id = data.split(',')
     auction = Auction.load(int(auction_id)) 
 
-    if user.id not in auction.users: #lista de usuário participando do leilão ( não estiver na lista de leilão) ele entra
-        auction.users.append(user.id) 
-        auction.save()
+    if auction.follow(user.id): #se o usuário ainda não segue o leilão, ele entra
         return True
 
     raise Exception('not_ok')
@@ -85,27 +121,120 @@ def enviar_lance(user, data):
     # Envia uma mensagem de volta para o controle do servidor
     # contendo os lances já feitos para os usuários 'seguidores'
     # do leilão.
+    # O lance é aplicado na fila do leilão no sequenciador: lances de um
+    # mesmo leilão são registrados um de cada vez, em ordem, e lances de
+    # leilões diferentes não esperam uns pelos outros.
     command, auction_id, value = data.split(',')
     auction_id = int(auction_id)
     value = float(value) #número com virgula
+
+    return sequenciador.SEQUENCER.submit(auction_id, _registra_lance, user,
+                                         auction_id, value)
+
+
+def _registra_lance(user, auction_id, value):
+    # Valida e registra o lance. Executado pelo sequenciador do leilão.
     auction = Auction.load(auction_id) #carregar o leilão
 
-    if auction.open and value >= auction.min_bid and user.id in auction.users:
+    if _lance_valido(user, auction, value):
         bid = Bid.new(user.id, auction_id, float(value))
-        auction.last_bid = bid.id #identificar o último lance no leilão
-        auction.save() #salvar
-
-        for u in User._logados: #u é cada usuario na lista de logados e user é o usuario logado
-            if u.id in auction.users and u.id != user.id: #u.id e acution.user verificar quais usuários logados estão participando do leilão
-                u.notify('%d,%s,%f,%d,%d\n' % (                 #u.id != user.id verifica dentro dos usuario logados se ele não é o usuario que enviou o comando
-                    auction_id, user.name, bid.value, len(auction.users), 
-                    len(Bid.filter_by_auction(auction_id)))) #
+        auction.add_bid(bid) #registra o último lance e adia o fechamento
 
+        _notifica_lances(user, auction_id, [_linha_lance(user, auction, bid)])
         return True
 
     raise Exception('not_ok')
 
 
+def enviar_lances(user, data):
+    # Envia vários lances numa única mensagem, no formato
+    #   enviar_lances,<id do leilão>,<valor>,<id do leilão>,<valor>,...
+    # A resposta traz uma linha `<id do leilão>,ok` ou
+    # `<id do leilão>,not_ok` para cada lance, na ordem do pedido, antes
+    # do ok final.
+    # Os lances de cada leilão são aplicados em ordem na fila dele no
+    # sequenciador, com as mesmas regras de enviar_lance, e os leilões
+    # andam em paralelo. Todos os lances aceitos são gravados num único
+    # commit, e cada leilão notifica os seus seguidores uma única vez,
+    # com uma linha por lance.
+    args = data.split(',')[1:]
+    if not args or len(args) % 2:
+        raise Exception('not_ok')
+
+    items = [(int(args[i]), float(args[i + 1]))
+             for i in range(0, len(args), 2)]
+
+    values = OrderedDict()  # id do leilão -> valores, na ordem do pedido
+    for auction_id, value in items:
+        values.setdefault(auction_id, []).append(value)
+
+    tasks = [(auction_id, sequenciador.SEQUENCER.submit(
+                 auction_id, _registra_lances, user, auction_id,
+                 values[auction_id], wait=False))
+             for auction_id in values]
+
+    results = {}  # id do leilão -> linhas das notificações (None se recusado)
+    bids = []
+    for auction_id, task in tasks:
+        try:
+            accepted = task.get()
+        except Exception:  # Leilão inexistente: todos os lances recusados
+            accepted = [None] * len(values[auction_id])
+
+        results[auction_id] = accepted
+        bids.extend(bid for bid, line in filter(None, accepted))
+
+    Bid.save_many(bids)
+
+    for auction_id, accepted in results.items():
+        lines = [line for bid, line in filter(None, accepted)]
+        if lines:
+            _notifica_lances(user, auction_id, lines)
+
+    answer = []
+    for auction_id, value in items:
+        accepted = results[auction_id].pop(0)
+        answer.append('%d,%s' % (auction_id,
+                                 'not_ok' if accepted is None else 'ok'))
+
+    return '\n'.join(answer) + '\nok'
+
+
+def _registra_lances(user, auction_id, values):
+    # Valida e registra, em ordem, os lances de um mesmo leilão, sem
+    # gravá-los no armazenamento. Executado pelo sequenciador do leilão.
+    # Retorna, para cada valor, o par (lance, linha da notificação), ou
+    # None se o lance foi recusado.
+    auction = Auction.load(auction_id)
+    accepted = []
+
+    for value in values:
+        if _lance_valido(user, auction, value):
+            bid = Bid.new(user.id, auction_id, value, commit=False)
+            auction.add_bid(bid)
+            accepted.append((bid, _linha_lance(user, auction, bid)))
+        else:
+            accepted.append(None)
+
+    return accepted
+
+
+def _lance_valido(user, auction, value):
+    return (auction.open and value >= auction.min_bid
+            and auction.id in user.seguindo)
+
+
+def _linha_lance(user, auction, bid):
+    return '%d,%s,%f,%d,%d\n' % (auction.id, user.name, bid.value,
+                                 len(auction.users), auction.bid_count)
+
+
+def _notifica_lances(user, auction_id, lines):
+    # Envia as linhas dos lances aos seguidores do leilão, numa única
+    # notificação por sessão, exceto ao usuário que deu os lances.
+    User.publish(auction_id, ''.join(lines), ('lance', auction_id), user.id)
+
+
 def lanca_produto(user, data):
     # Registra um novo produto para leilão. Cria um objeto Auction com os dados
     # e salva no arquivo de leilões.
@@ -141,8 +270,7 @@ def sair_leilao(user, data):
     command, auction_id = data.split(',')
     auction = Auction.load(int(auction_id))
 
-    auction.users.remove(user.id) #remove é uma função da lista do python
-    auction.save()
+    auction.unfollow(user.id)
     return True
 
 
@@ -151,6 +279,7 @@ client_functions = { #dicionario, comando mapeando as funções (as defs)
     'apaga_usuario': apaga_usuario,
     'entrar_leilao': entrar_leilao,
     'enviar_lance': enviar_lance,
+    'enviar_lances': enviar_lances,
     'lanca_produto': lanca_produto,
     'sair': sair,
     'sair_leilao': sair_leilao
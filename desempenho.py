@@ -0,0 +1,466 @@
+# encoding: utf-8
+
+# Gerador de carga e medidor de latência do servidor de leilões.
+#
+# Sobe o servidor (main.py) numa porta local, a partir de uma cópia dos
+# módulos num diretório temporário (para não mexer nos arquivos de dados),
+# e simula N clientes fazendo o mesmo caminho de um cliente real:
+#   adiciona_usuario -> socket recebedor com o número da porta ->
+#   entrar_leilao -> rajadas de enviar_lance
+# ou, com --unico, o mesmo caminho numa única conexão no modo de socket
+# único (protocolo,unico; veja protocolo.SINGLE), sem o socket recebedor.
+# No fim, mostra a vazão e a latência (p50/p99) de cada comando e o atraso
+# de entrega das notificações de lance, e acrescenta os resultados, em
+# json, ao arquivo de saída (uma linha por execução), para comparar
+# versões.
+#
+# Uso:
+#   python desempenho.py [--clientes=20] [--leiloes=4] [--rajadas=5]
+#                        [--lances=10] [--pausa=0.1] [--porta=0]
+#                        [--fragmentos=0] [--eventos] [--unico]
+#                        [--saida=desempenho.jsonl]
+# Com --porta=0 (o padrão), o servidor sobe numa porta livre. Com
+# --fragmentos=N, o servidor roda com N processos de fragmento.
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timedelta
+
+try:
+    import Queue as queue
+except ImportError:  # Python 3
+    import queue
+
+
+HOST = '127.0.0.1'
+
+# Parâmetros padrão; cada um pode ser trocado com --<nome>=<valor>
+DEFAULTS = {
+    'clientes': 20,  # número de clientes simultâneos
+    'leiloes': 4,  # número de leilões disputados
+    'rajadas': 5,  # rajadas de lances de cada cliente
+    'lances': 10,  # lances em cada rajada
+    'pausa': 0.1,  # segundos entre as rajadas
+    'porta': 0,
+    'fragmentos': 0,
+    'saida': 'desempenho.jsonl',
+}
+
+# Segundos entre a criação dos leilões e a sua abertura
+START_DELAY = 3
+
+# Tempo máximo, em segundos, de espera pelas respostas e notificações
+TIMEOUT = 30
+
+MODULES = os.path.dirname(os.path.abspath(__file__))
+
+
+class Stats(object):
+    # Latências coletadas pelos clientes, por comando.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}  # comando -> latências, em segundos
+        self.errors = {}  # comando -> número de respostas diferentes de ok
+        self.sent = {}  # (id do leilão, valor) -> instante do envio
+        self.lags = []  # atrasos das notificações, em segundos
+
+    def add(self, command, latency, ok):
+        with self.lock:
+            self.latencies.setdefault(command, []).append(latency)
+            if not ok:
+                self.errors[command] = self.errors.get(command, 0) + 1
+
+    def bid_sent(self, auction_id, value, when):
+        with self.lock:
+            self.sent[(auction_id, value)] = when
+
+    def bid_received(self, auction_id, value, when):
+        with self.lock:
+            sent = self.sent.get((auction_id, value))
+            if sent is not None:
+                self.lags.append(when - sent)
+
+
+class Client(object):
+    # Um cliente com os seus dois sockets: o principal, por onde vão os
+    # comandos, e o recebedor, lido por uma thread que mede o atraso das
+    # notificações. No modo de socket único (single), uma só conexão leva
+    # as duas coisas, e a thread de leitura separa as respostas, que vão
+    # para a fila replies, das notificações.
+
+    def __init__(self, name, port, stats, single=False):
+        self.name = name
+        self.port = port
+        self.stats = stats
+        self.single = single
+        self.sender = None
+        self.receiver = None
+        self.replies = queue.Queue()
+
+    def connect(self):
+        conn = socket.create_connection((HOST, self.port))
+        conn.settimeout(TIMEOUT)
+        conn.recv(1024)  # mensagem de boas-vindas
+        return conn
+
+    def command(self, text, name=None):
+        # Envia um comando e espera a resposta, registrando a latência.
+        start = time.time()
+        if self.single:
+            # A espera é sem timeout: no Python 2, get com timeout dorme
+            # em intervalos de até 50ms. A thread de leitura coloca None
+            # na fila se a conexão cair.
+            self.sender.send('%d\n%s' % (len(text), text))
+            answer = self.replies.get()
+            if answer is None:
+                raise socket.error('Conexão encerrada')
+        else:
+            self.sender.send(text)
+            answer = self.sender.recv(65536)
+        self.stats.add(name or text.partition(',')[0], time.time() - start,
+                       answer.endswith('ok') and not answer.endswith('not_ok'))
+        return answer
+
+    def login(self):
+        # Registra o usuário e vincula o socket recebedor. A duração total,
+        # da primeira conexão até a sessão pronta, é registrada como
+        # 'sessao'.
+        login_start = time.time()
+        self.sender = self.connect()
+
+        if self.single:
+            start = time.time()
+            self.sender.send('protocolo,unico')
+            answer = self.sender.recv(1024)
+            self.stats.add('protocolo', time.time() - start, answer == 'ok')
+
+            t = threading.Thread(target=self.listen_single)
+            t.daemon = True
+            t.start()
+
+            self.command('adiciona_usuario,%s,1,r,e,p' % self.name)
+            self.stats.add('sessao', time.time() - login_start, True)
+            return
+
+        self.command('adiciona_usuario,%s,1,r,e,p' % self.name)
+
+        self.receiver = self.connect()
+        start = time.time()
+        self.receiver.send(str(self.sender.getsockname()[1]))
+        answer = self.receiver.recv(1024)
+        self.stats.add('recebedor', time.time() - start, answer == 'ok')
+        self.stats.add('sessao', time.time() - login_start, True)
+
+        t = threading.Thread(target=self.listen)
+        t.daemon = True
+        t.start()
+
+    def listen(self):
+        # Lê as notificações do socket recebedor. As linhas de lance têm o
+        # formato <leilão>,<usuário>,<valor>,<seguidores>,<lances>.
+        buffer = ''
+        while True:
+            try:
+                data = self.receiver.recv(65536)
+            except socket.error:
+                return
+            if not data:
+                return
+
+            now = time.time()
+            buffer += data
+            lines = buffer.split('\n')
+            buffer = lines.pop()
+            self.notified(lines, now)
+
+    def listen_single(self):
+        # Lê as mensagens da conexão no modo de socket único: cada uma tem
+        # o cabeçalho <tipo><tamanho>, com tipo r (resposta) ou n
+        # (notificação).
+        try:
+            self.read_single()
+        finally:
+            self.replies.put(None)
+
+    def read_single(self):
+        # Percorre o buffer por posição, cortando-o só uma vez por recv,
+        # para não copiar o resto do buffer a cada mensagem.
+        buffer = ''
+        while True:
+            try:
+                data = self.sender.recv(65536)
+            except socket.error:
+                return
+            if not data:
+                return
+
+            now = time.time()
+            buffer += data
+            pos = 0
+            while True:
+                header_end = buffer.find('\n', pos)
+                if header_end < 0:
+                    break
+                end = header_end + 1 + int(buffer[pos + 1:header_end])
+                if len(buffer) < end:
+                    break
+
+                kind, text = buffer[pos], buffer[header_end + 1:end]
+                pos = end
+                if kind == 'r':
+                    self.replies.put(text)
+                else:
+                    self.notified(text.split('\n'), now)
+
+            buffer = buffer[pos:]
+
+    def notified(self, lines, now):
+        for line in lines:
+            # O aviso de abertura termina com o prompt '> ', sem quebra
+            # de linha, e fica grudado na linha seguinte.
+            if line.startswith('> '):
+                line = line[2:]
+
+            fields = line.split(',')
+            if len(fields) != 5:
+                continue
+            try:
+                auction_id, value = int(fields[0]), float(fields[2])
+            except ValueError:
+                continue
+            self.stats.bid_received(auction_id, value, now)
+
+    def close(self):
+        try:
+            self.command('sair')
+        except socket.error:
+            pass
+
+        for conn in (self.sender, self.receiver):
+            if conn is not None:
+                conn.close()
+
+
+def percentile(values, p):
+    # Percentil pelo método do posto mais próximo.
+    if not values:
+        return None
+
+    values = sorted(values)
+    k = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values))) - 1))
+    return values[k]
+
+
+def parse_args(argv):
+    options = dict(DEFAULTS)
+    options['eventos'] = False
+    options['unico'] = False
+
+    for arg in argv:
+        if arg in ('--eventos', '--unico'):
+            options[arg[2:]] = True
+            continue
+
+        key, sep, value = arg.lstrip('-').partition('=')
+        if key not in DEFAULTS or not sep:
+            raise SystemExit('Opção desconhecida: %s' % arg)
+
+        options[key] = type(DEFAULTS[key])(value)
+
+    return options
+
+
+def start_server(options):
+    # Copia os módulos para um diretório temporário e sobe o servidor lá,
+    # esperando até que ele aceite conexões.
+    if not options['porta']:
+        probe = socket.socket()
+        probe.bind((HOST, 0))
+        options['porta'] = probe.getsockname()[1]
+        probe.close()
+
+    workdir = tempfile.mkdtemp(prefix='leilao-desempenho-')
+    for name in os.listdir(MODULES):
+        if name.endswith('.py'):
+            shutil.copy(os.path.join(MODULES, name), workdir)
+
+    args = [sys.executable, '-u', 'main.py', '--porta=%d' % options['porta']]
+    if options['eventos']:
+        args.append('--eventos')
+    if options['fragmentos']:
+        args.append('--fragmentos=%d' % options['fragmentos'])
+
+    log = open(os.path.join(workdir, 'servidor.log'), 'w')
+    server = subprocess.Popen(args, cwd=workdir, stdout=log,
+                              stderr=subprocess.STDOUT)
+
+    deadline = time.time() + TIMEOUT
+    while True:
+        try:
+            socket.create_connection((HOST, options['porta'])).close()
+            return server, workdir
+        except socket.error:
+            if server.poll() is not None or time.time() > deadline:
+                raise SystemExit('Servidor não iniciou; veja %s'
+                                 % os.path.join(workdir, 'servidor.log'))
+            time.sleep(0.1)
+
+
+def run(options):
+    stats = Stats()
+    run_id = int(time.time())
+    port = options['porta']
+
+    # O vendedor cria os leilões, que abrem START_DELAY segundos depois.
+    seller = Client('vendedor%d' % run_id, port, stats, options['unico'])
+    seller.login()
+
+    start = datetime.now() + timedelta(seconds=START_DELAY)
+    for i in range(options['leiloes']):
+        seller.command('lanca_produto,item%d,desc,1.0,%d,%d,%d,%d,%d,%d,600' % (
+            i, start.day, start.month, start.year, start.hour, start.minute,
+            start.second))
+
+    listing = seller.command('lista_leiloes').split('\n')
+    auction_ids = [int(line.split(',')[0]) for line in listing[:-1]
+                   if line.split(',')[-1] == seller.name]
+
+    # Os clientes se registram e seguem todos os leilões.
+    clients = [Client('cliente%d_%d' % (i, run_id), port, stats,
+                      options['unico'])
+               for i in range(options['clientes'])]
+
+    def join(client):
+        client.login()
+        for auction_id in auction_ids:
+            client.command('entrar_leilao,%d' % auction_id)
+
+    _parallel(join, clients)
+
+    delay = time.mktime(start.timetuple()) + 1 - time.time()
+    if delay > 0:
+        time.sleep(delay)
+
+    # Rajadas de lances. Cada lance tem um valor único, o que permite
+    # casar as notificações com o instante do envio.
+    counter = [0]
+    counter_lock = threading.Lock()
+
+    def bid(client):
+        for burst in range(options['rajadas']):
+            for i in range(options['lances']):
+                with counter_lock:
+                    counter[0] += 1
+                    n = counter[0]
+                value = float(n) + 1
+                auction_id = auction_ids[n % len(auction_ids)]
+
+                stats.bid_sent(auction_id, value, time.time())
+                client.command('enviar_lance,%d,%d' % (auction_id, value))
+            time.sleep(options['pausa'])
+
+    bids_start = time.time()
+    _parallel(bid, clients)
+    bids_elapsed = time.time() - bids_start
+
+    # Espera as últimas notificações chegarem.
+    expected = len(stats.sent) * (len(clients) - 1)
+    deadline = time.time() + TIMEOUT
+    while len(stats.lags) < expected and time.time() < deadline:
+        time.sleep(0.1)
+
+    for client in clients + [seller]:
+        client.close()
+
+    return report(options, stats, bids_elapsed, expected)
+
+
+def _parallel(func, clients):
+    threads = [threading.Thread(target=func, args=(c,)) for c in clients]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def report(options, stats, bids_elapsed, expected):
+    # Monta o resultado da execução, em segundos.
+    result = {
+        'data': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'versao': _version(),
+        'parametros': options,
+        'comandos': {},
+        'notificacoes': {
+            'esperadas': expected,
+            'recebidas': len(stats.lags),
+            'p50': percentile(stats.lags, 50),
+            'p99': percentile(stats.lags, 99),
+        },
+    }
+
+    for command, latencies in sorted(stats.latencies.items()):
+        result['comandos'][command] = {
+            'n': len(latencies),
+            'erros': stats.errors.get(command, 0),
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99),
+        }
+
+    bids = len(stats.latencies.get('enviar_lance', ()))
+    result['lances_por_segundo'] = bids / bids_elapsed if bids_elapsed else None
+    return result
+
+
+def _version():
+    # Commit atual do repositório, se houver.
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=MODULES,
+            stderr=subprocess.STDOUT).strip().decode('ascii')
+    except Exception:
+        return None
+
+
+def show(result):
+    def ms(seconds):
+        return '-' if seconds is None else '%.2f' % (seconds * 1000)
+
+    print('%-18s %8s %6s %10s %10s' % ('comando', 'n', 'erros', 'p50 (ms)',
+                                      'p99 (ms)'))
+    for command, r in sorted(result['comandos'].items()):
+        print('%-18s %8d %6d %10s %10s' % (command, r['n'], r['erros'],
+                                           ms(r['p50']), ms(r['p99'])))
+
+    n = result['notificacoes']
+    print('%-18s %8d %6d %10s %10s' % ('notificacao', n['recebidas'],
+                                       n['esperadas'] - n['recebidas'],
+                                       ms(n['p50']), ms(n['p99'])))
+    if result['lances_por_segundo'] is not None:
+        print('vazão: %.1f lances/s' % result['lances_por_segundo'])
+
+
+if __name__ == '__main__':
+    options = parse_args(sys.argv[1:])
+    server, workdir = start_server(options)
+
+    try:
+        result = run(options)
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    show(result)
+    with open(options['saida'], 'a') as f:
+        f.write(json.dumps(result, sort_keys=True) + '\n')
+    print('Resultados acrescentados a %s' % options['saida'])
@@ -0,0 +1,598 @@
+# encoding: utf-8
+
+from __future__ import print_function
+
+# Modo com vários processos (python main.py --fragmentos=N).
+#
+# Os leilões são divididos entre N processos de fragmento: o leilão de id
+# i pertence ao fragmento i % N, que guarda o leilão e os seus lances no
+# seu próprio diretório de dados (fragmento-<k>, dentro do diretório de
+# dados do servidor) e executa o escalonador, o sequenciador e a validação
+# dos lances desse leilão. Cada fragmento roda no seu próprio processo, com
+# o seu próprio GIL, de modo que o trabalho com leilões diferentes se
+# espalha pelos núcleos da máquina.
+#
+# O processo da frente (main.py) continua aceitando as conexões e cuidando
+# dos usuários e das sessões. Os comandos de leilão são repassados ao
+# fragmento dono do leilão (veja ROUTED), lista_leiloes junta as listagens
+# de todos os fragmentos, e as notificações geradas nos fragmentos voltam
+# ao processo da frente, que as entrega às sessões que seguem o leilão.
+#
+# A comunicação usa multiprocessing.connection, por TCP local e com uma
+# chave de autenticação sorteada a cada inicialização. O número de
+# fragmentos não deve mudar entre execuções sobre os mesmos dados.
+#
+# O processo da frente não carrega leilões nem rearma prazos. Os leilões e
+# lances que estiverem no diretório de dados do servidor (de execuções sem
+# fragmentos) são movidos para os fragmentos na inicialização (veja
+# Router.migrate).
+
+import os
+import sys
+import time
+import socket
+import signal
+import atexit
+import binascii
+import threading
+import subprocess
+from multiprocessing.connection import Listener, Client
+
+try:
+    import Queue as queue
+except ImportError:  # Python 3
+    import queue
+
+import lances
+import comandos
+import leiloes
+import usuarios
+import armazenamento
+from usuarios import User
+
+
+HOST = '127.0.0.1'
+
+# Conexões pendentes aceitas por um fragmento (o padrão do Listener é 1, e
+# as conexões do pool são abertas em rajadas, sob carga).
+BACKLOG = 128
+
+# Arquivo, no diretório de dados do fragmento, onde ele publica a porta em
+# que aceita conexões (escolhida pelo sistema, sem corrida com outros
+# processos pela mesma porta).
+PORT_FILENAME = 'fragmento.porta'
+
+# Conexões abertas com cada fragmento na inicialização e mantidas no pool.
+# Numa rajada maior, as conexões a mais são abertas na hora e fechadas ao
+# fim da chamada.
+POOL_SIZE = 16
+
+# Comandos dos usuários repassados aos fragmentos
+ROUTED = (
+    'apaga_usuario',
+    'entrar_leilao',
+    'enviar_lance',
+    'enviar_lances',
+    'lanca_produto',
+    'lista_leiloes',
+    'sair_leilao',
+)
+
+# Roteador do processo da frente; None fora do modo com vários processos.
+ROUTER = None
+
+
+class Shard(object):
+    # Um processo de fragmento, visto do processo da frente. As chamadas
+    # usam conexões de um pool, uma por chamada em andamento; uma conexão
+    # separada recebe as notificações do fragmento.
+
+    def __init__(self, index, count):
+        self.index = index
+        self.count = count
+        self.directory = os.path.join(armazenamento.DATA_DIR,
+                                      'fragmento-%d' % index)
+        self.authkey = binascii.hexlify(os.urandom(16))
+        self.address = None
+        self.process = None
+        self.pool = queue.Queue(POOL_SIZE)
+
+    def start(self):
+        # Sobe o processo do fragmento e espera até que ele aceite
+        # conexões. A primeira conexão é a das notificações; o fragmento
+        # confirma que a recebeu antes de qualquer pedido.
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        port_filename = os.path.join(self.directory, PORT_FILENAME)
+        if os.path.exists(port_filename):
+            os.remove(port_filename)
+
+        env = dict(os.environ)
+        env['LEILAO_DADOS'] = self.directory
+        env['LEILAO_FRAGMENTO'] = '%d,%d' % (self.index, self.count)
+        env['LEILAO_FRAGMENTO_CHAVE'] = self.authkey
+
+        log = open(os.path.join(self.directory, 'fragmento.log'), 'a')
+        self.process = subprocess.Popen(
+            [sys.executable, '-u', os.path.abspath(__file__)], env=env,
+            stdin=subprocess.PIPE, stdout=log, stderr=subprocess.STDOUT)
+
+        while not os.path.exists(port_filename):
+            if self.process.poll() is not None:
+                raise Exception('Fragmento %d não iniciou' % self.index)
+            time.sleep(0.05)
+
+        with open(port_filename) as f:
+            self.address = (HOST, int(f.read()))
+
+        events = self._connect()
+        events.send(('eventos',))
+        events.recv()
+        t = threading.Thread(target=self._events, args=(events,))
+        t.daemon = True
+        t.start()
+
+        for i in range(POOL_SIZE):
+            self.pool.put(self._connect())
+
+    def _connect(self):
+        return _nodelay(Client(self.address, authkey=self.authkey))
+
+    def store(self, auctions, bids, users):
+        # Grava leilões e lances no diretório de dados do fragmento, com o
+        # processo do fragmento ainda parado (veja Router.migrate), e os
+        # usuários (id e nome) a que eles se referem. Os armazenamentos são
+        # carregados antes, pois o backend json regrava o arquivo inteiro
+        # a partir do que leu.
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        storage = usuarios.open_storage(self.directory)
+        try:
+            known = set(u['id'] for u in storage.load())
+            storage.commit([User.placeholder(id, name)
+                            for id, name in users if id not in known])
+        finally:
+            storage.close()
+
+        storage = leiloes.open_storage(self.directory)
+        try:
+            storage.load()
+            storage.commit(auctions)
+        finally:
+            storage.close()
+
+        store = lances.open_store(self.directory)
+        try:
+            store.load()
+            store.commit(bids)
+        finally:
+            store.close()
+
+    def stop(self):
+        # Fecha a entrada do processo; o fragmento grava o que está
+        # pendente e termina (veja _watch_parent).
+        if self.process is not None and self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait()
+
+    def call(self, *request):
+        # Envia o pedido ao fragmento e retorna a resposta. Lança uma
+        # exceção se o fragmento recusou o comando.
+        return self.receive(self.send(request))
+
+    def send(self, request):
+        # Envia o pedido por uma conexão do pool, sem esperar a resposta,
+        # e retorna a conexão, de onde a resposta é lida com receive.
+        try:
+            conn = self.pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+
+        try:
+            conn.send(request)
+        except Exception:
+            conn.close()
+            raise
+
+        return conn
+
+    def receive(self, conn):
+        # Lê a resposta do pedido enviado por conn e devolve a conexão ao
+        # pool. Lança uma exceção se o fragmento recusou o comando.
+        try:
+            status, result = conn.recv()
+        except Exception:
+            conn.close()
+            raise
+
+        try:
+            self.pool.put_nowait(conn)
+        except queue.Full:  # Conexão aberta a mais, numa rajada
+            conn.close()
+
+        if status != 'ok':
+            raise Exception(result)
+
+        return result
+
+    def _events(self, conn):
+        # Entrega às sessões locais as notificações vindas do fragmento.
+        while True:
+            try:
+                auction_id, text, key, exclude = conn.recv()
+            except (EOFError, IOError):
+                return
+
+            User.publish(auction_id, text, key, exclude)
+
+
+class Router(object):
+    # Repassa os comandos de leilão ao fragmento dono de cada leilão.
+
+    def __init__(self, count):
+        self.shards = [Shard(i, count) for i in range(count)]
+        self.next_shard = 0
+        self.lock = threading.Lock()
+        self.handlers = {
+            'apaga_usuario': self.apaga_usuario,
+            'entrar_leilao': self.entrar_leilao,
+            'enviar_lance': self.enviar_lance,
+            'enviar_lances': self.enviar_lances,
+            'lanca_produto': self.lanca_produto,
+            'lista_leiloes': self.lista_leiloes,
+            'sair_leilao': self.sair_leilao,
+        }
+
+    def start(self):
+        self.migrate()
+
+        for shard in self.shards:
+            shard.start()
+
+        usuarios.FOLLOWED_BY = self.followed_by
+        atexit.register(self.stop)
+
+    def stop(self):
+        for shard in self.shards:
+            shard.stop()
+
+    def migrate(self):
+        # Move os leilões e lances do diretório de dados do servidor para o
+        # fragmento dono de cada leilão. Os registros são gravados nos
+        # fragmentos antes de serem apagados do servidor: uma migração
+        # interrompida é refeita por inteiro na próxima inicialização, e
+        # gravar de novo um registro com o mesmo id só o substitui.
+        auctions = leiloes.STORAGE.load()
+        bids = lances.STORE.all()
+        if not auctions and not bids:
+            return
+
+        print('[Servidor] Movendo %d leilões e %d lances para os fragmentos...'
+              % (len(auctions), len(bids)))
+
+        for shard in self.shards:
+            mine = [a for a in auctions if self.owner(a['id']) is shard]
+            my_bids = [b for b in bids if self.owner(b['auction_id']) is shard]
+
+            ids = set(b['user_id'] for b in my_bids)
+            for a in mine:
+                ids.add(a['user_id'])
+                ids.update(a.get('users', ()))
+
+            users = []
+            for id in sorted(ids):
+                try:
+                    users.append((id, User.load(id).name))
+                except Exception:  # Usuário já apagado
+                    pass
+
+            shard.store(mine, my_bids, users)
+
+        leiloes.STORAGE.commit(deleted=[a['id'] for a in auctions])
+        lances.STORE.delete_many([b['id'] for b in bids])
+
+    def handler(self, command, default):
+        # Função que trata o comando: a do roteador, para os comandos
+        # repassados aos fragmentos, ou default.
+        return self.handlers.get(command, default)
+
+    def owner(self, auction_id):
+        return self.shards[auction_id % len(self.shards)]
+
+    def command(self, shard, user, data):
+        # Executa um comando de usuário no fragmento.
+        return shard.call(*_command(user, data))
+
+    def broadcast(self, *request):
+        # Envia o pedido a todos os fragmentos antes de ler a primeira
+        # resposta, de modo que eles trabalham ao mesmo tempo, e retorna as
+        # respostas, na ordem dos fragmentos. Se algum fragmento falhar, a
+        # exceção é lançada depois que todos responderem.
+        sent = []  # (fragmento, conexão)
+        try:
+            for shard in self.shards:
+                sent.append((shard, shard.send(request)))
+        except Exception:
+            for shard, conn in sent:
+                conn.close()
+            raise
+
+        answers = []
+        errors = []
+        for shard, conn in sent:
+            try:
+                answers.append(shard.receive(conn))
+            except Exception as e:
+                errors.append(e)
+
+        if errors:
+            raise errors[0]
+        return answers
+
+    def followed_by(self, user_id):
+        followed = []
+        for answer in self.broadcast('seguidos', user_id):
+            followed.extend(answer)
+        return followed
+
+    def enviar_lance(self, user, data):
+        auction_id = int(data.split(',')[1])
+        return self.command(self.owner(auction_id), user, data)
+
+    def enviar_lances(self, user, data):
+        # O lote inteiro é lido e validado aqui, antes que qualquer lance
+        # chegue a um fragmento: um pedido malformado é recusado sem aplicar
+        # nada, como no modo com um só processo. Depois, cada fragmento
+        # recebe a sua parte ao mesmo tempo (e a grava num único commit), e
+        # as respostas são remontadas na ordem do pedido, uma por lance; se
+        # um fragmento falhar, só os lances dele são recusados.
+        args = data.split(',')[1:]
+        if not args or len(args) % 2:
+            raise Exception('not_ok')
+
+        items = [(int(args[i]), float(args[i + 1]))
+                 for i in range(0, len(args), 2)]
+
+        parts = {}  # fragmento -> itens do fragmento
+        for auction_id, value in items:
+            parts.setdefault(self.owner(auction_id), []).append(
+                '%d,%r' % (auction_id, value))
+
+        sent = []  # (fragmento, conexão, ou None se o envio falhou)
+        for shard, part in parts.items():
+            request = _command(user, 'enviar_lances,' + ','.join(part))
+            try:
+                sent.append((shard, shard.send(request)))
+            except Exception as e:
+                print(repr(e))
+                sent.append((shard, None))
+
+        answers = {}  # fragmento -> respostas, na ordem dos itens
+        for shard, conn in sent:
+            try:
+                answers[shard] = shard.receive(conn).split('\n')[:-1]
+            except Exception as e:
+                if conn is not None:
+                    print(repr(e))
+                answers[shard] = ['%s,not_ok' % item.partition(',')[0]
+                                  for item in parts[shard]]
+
+        lines = [answers[self.owner(auction_id)].pop(0)
+                 for auction_id, value in items]
+        return '\n'.join(lines) + '\nok'
+
+    def entrar_leilao(self, user, data):
+        auction_id = int(data.split(',')[1])
+        self.command(self.owner(auction_id), user, data)
+        User.subscribe(user.id, auction_id)
+        return True
+
+    def sair_leilao(self, user, data):
+        auction_id = int(data.split(',')[1])
+        self.command(self.owner(auction_id), user, data)
+        User.unsubscribe(user.id, auction_id)
+        return True
+
+    def lanca_produto(self, user, data):
+        # Os leilões novos são distribuídos entre os fragmentos, um de
+        # cada vez; o fragmento escolhido cria o leilão com um id seu.
+        with self.lock:
+            shard = self.shards[self.next_shard]
+            self.next_shard = (self.next_shard + 1) % len(self.shards)
+
+        return self.command(shard, user, data)
+
+    def lista_leiloes(self, user=None, data=None):
+        # Junta as listagens dos fragmentos, com os mesmos filtros, em ordem
+        # de id. Com limite, a página tem os primeiros leilões do conjunto
+        # e o cursor é o último leilão da página, se algum fragmento tiver
+        # mais leilões.
+        data = data or 'lista_leiloes'
+        filters = dict(arg.split('=', 1) for arg in data.split(',')[1:])
+        limit = filters.get('limite')
+
+        auctions = []
+        more = False
+        for answer in self.broadcast('lista', data):
+            for line in answer.split('\n')[:-1]:
+                if line.startswith('cursor,'):
+                    more = True
+                elif line:
+                    auctions.append(line)
+
+        auctions.sort(key=lambda line: int(line.partition(',')[0]))
+
+        if limit is not None and len(auctions) > int(limit):
+            del auctions[int(limit):]
+            more = True
+
+        if more and auctions:
+            auctions.append('cursor,%s' % auctions[-1].partition(',')[0])
+
+        return '\n'.join(auctions) + '\nok'
+
+    def apaga_usuario(self, user, data):
+        # Apaga os leilões e lances do usuário em todos os fragmentos e,
+        # depois, o próprio usuário, no processo da frente.
+        command, name, password = data.split(',')
+        if user.name != name or user.password != password:
+            raise Exception('not_ok')
+
+        # Os fragmentos não têm as sessões: os seguidores dos leilões
+        # apagados são esquecidos aqui, para que um leilão novo que reuse
+        # um desses ids não herde os seguidores do antigo.
+        for ids in self.broadcast('apaga', user.id):
+            for auction_id in ids:
+                User.drop_followers(auction_id)
+
+        return comandos.apaga_usuario(user, data)
+
+
+def _command(user, data):
+    # Pedido de um comando de usuário a um fragmento. O fragmento recebe o
+    # id e o nome do usuário e os leilões que a sessão segue.
+    return ('comando', data.partition(',')[0], user.id, user.name,
+            list(user.seguindo), data)
+
+
+def _nodelay(conn):
+    # Liga TCP_NODELAY numa conexão de multiprocessing.connection. Pedidos
+    # e respostas são mensagens pequenas, e o cabeçalho de tamanho pode
+    # sair numa escrita separada; com o algoritmo de Nagle, a segunda
+    # escrita esperaria a confirmação do outro lado (até 40ms).
+    s = socket.fromfd(conn.fileno(), socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    finally:
+        s.close()
+    return conn
+
+
+def start(count):
+    # Inicia o modo com vários processos, no processo da frente.
+    global ROUTER
+
+    ROUTER = Router(count)
+    ROUTER.start()
+
+
+# Abaixo fica o lado dos fragmentos: o processo iniciado por Shard.start.
+
+def serve_shard():
+    index, count = [int(n) for n in os.environ['LEILAO_FRAGMENTO'].split(',')]
+    authkey = os.environ['LEILAO_FRAGMENTO_CHAVE']
+
+    leiloes.ID_STRIDE = count
+    leiloes.ID_OFFSET = index
+    signal.signal(signal.SIGTERM, leiloes.terminate)
+    leiloes.start()
+
+    events = []  # conexão das notificações, quando a frente se conectar
+    events_lock = threading.Lock()
+
+    def forward(auction_id, text, key, exclude):
+        with events_lock:
+            if events:
+                events[0].send((auction_id, text, key, exclude))
+
+    usuarios.FORWARD = forward
+
+    t = threading.Thread(target=_watch_parent)
+    t.daemon = True
+    t.start()
+
+    listener = Listener((HOST, 0), backlog=BACKLOG, authkey=authkey)
+    port = listener.address[1]
+
+    # A porta é publicada de uma só vez (veja PORT_FILENAME)
+    filename = os.path.join(armazenamento.DATA_DIR, PORT_FILENAME)
+    with open(filename + '.tmp', 'w') as f:
+        f.write(str(port))
+    os.rename(filename + '.tmp', filename)
+
+    print('[Fragmento %d/%d] Aguardando o processo da frente na porta %d...'
+          % (index, count, port))
+
+    def serve(conn):
+        # A primeira mensagem diz se a conexão é a das notificações ou uma
+        # conexão de pedidos do pool (que pode ficar ociosa por um tempo).
+        try:
+            request = conn.recv()
+        except (EOFError, IOError):
+            return
+
+        if request == ('eventos',):
+            with events_lock:
+                events[:] = [conn]
+                conn.send(('ok', True))
+            return
+
+        _serve_connection(conn, request)
+
+    while True:
+        try:
+            conn = listener.accept()
+        except Exception as e:  # Conexão recusada na autenticação
+            print(repr(e))
+            continue
+
+        _nodelay(conn)
+        t = threading.Thread(target=serve, args=(conn,))
+        t.daemon = True
+        t.start()
+
+
+def _serve_connection(conn, request):
+    # Atende os pedidos de uma conexão do processo da frente, um por vez.
+    while True:
+        try:
+            answer = ('ok', _handle(request))
+        except Exception as e:
+            print(repr(e))
+            answer = ('erro', 'not_ok')
+
+        try:
+            conn.send(answer)
+            request = conn.recv()
+        except (EOFError, IOError):
+            return
+
+
+def _handle(request):
+    kind = request[0]
+
+    if kind == 'comando':
+        command, user_id, name, following, data = request[1:]
+        User.ensure(user_id, name)
+        user = User.load(user_id)
+        user.seguindo = set(following)
+        return comandos.client_functions[command](user, data)
+
+    if kind == 'lista':
+        return comandos.lista_leiloes(None, request[1])
+
+    if kind == 'seguidos':
+        return leiloes.Auction.followed_by(request[1])
+
+    if kind == 'apaga':
+        try:
+            user = User.load(request[1])
+        except Exception:  # Usuário sem leilões nem lances neste fragmento
+            return []
+        return user.purge()
+
+    raise Exception('Pedido desconhecido: %r' % (kind,))
+
+
+def _watch_parent():
+    # Termina o fragmento quando o processo da frente fecha a entrada
+    # (ou morre), gravando antes os leilões pendentes.
+    sys.stdin.read()
+    leiloes.Auction.flush()
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    serve_shard()
@@ -3,91 +3,373 @@
 from __future__ import print_function
 
 import os
-import json
+import time
 import threading
+from collections import OrderedDict
 from datetime import datetime
 
+import armazenamento
+import binario
+import metricas
+
+
+FILENAME = os.path.join(armazenamento.DATA_DIR, 'lances.json')
+FILELOCK = metricas.TimedLock(threading.RLock(), 'lances.lock')
+
+# Modo de persistência dos lances:
+#   'journal' -> cada lance novo é acrescentado como uma linha json ao
+#                diário (lances.jsonl) e cada deleção é registrada como uma
+#                lápide. O lances.json serve apenas de base para o diário.
+#   'json'    -> o arquivo lances.json inteiro é reescrito a cada alteração.
+#   'binario' -> os lances ficam em lances.bin, com linhas de tamanho fixo
+#                lidas e escritas por mmap (veja binario.py). Na primeira
+#                vez, o arquivo recebe os lances de lances.json e do diário.
+# Só vale para o backend json (veja armazenamento.BACKEND). Pode ser
+# escolhido pela variável de ambiente LEILAO_LANCES.
+PERSISTENCE = os.environ.get('LEILAO_LANCES', 'journal')
+JOURNAL_FILENAME = os.path.join(armazenamento.DATA_DIR, 'lances.jsonl')
+BINARY_FILENAME = os.path.join(armazenamento.DATA_DIR, 'lances.bin')
+
+
+class BidStore(object):
+    # Repositório residente dos lances. O armazenamento (veja armazenamento)
+    # é lido uma única vez, na inicialização do servidor, e a partir daí as
+    # consultas são respondidas pelos índices em memória:
+    #   by_id      -> id do lance -> registro
+    #   by_auction -> id do leilão -> registros dos lances daquele leilão
+    #   by_user    -> id do usuário -> registros dos lances daquele usuário
+    # Os registros são dicionários no mesmo formato do arquivo json. A
+    # persistência é um passo separado dos índices, delegado ao
+    # armazenamento: no modo 'journal' cada alteração vira uma única linha
+    # acrescentada ao diário.
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.lock = FILELOCK
+        self.by_id = OrderedDict()
+        self.by_auction = {}
+        self.by_user = {}
+        self.last_id = 0
+
+    def load(self):
+        # Carrega os registros do armazenamento e monta os índices.
+        with self.lock:
+            self.by_id.clear()
+            self.by_auction.clear()
+            self.by_user.clear()
+            self.last_id = 0
+
+            for b in self.storage.load():
+                self.put(b)
+
+    def next_id(self):
+        # Retorna o próximo id livre. Deve ser chamado com a lock em mãos.
+        return self.last_id + 1
+
+    def get(self, id):
+        return self.by_id.get(id)
+
+    def filter_by_auction(self, id):
+        return list(self.by_auction.get(id, {}).values())
+
+    def filter_by_user(self, id):
+        return list(self.by_user.get(id, {}).values())
+
+    def rows_by_auction(self, id):
+        # Tuplas (id, user_id, value, instante) dos lances do leilão.
+        return [(b['id'], b['user_id'], b['value'], _epoch(b['bid_date']))
+                for b in self.filter_by_auction(id)]
+
+    def all(self):
+        return list(self.by_id.values())
+
+    def put(self, b):
+        # Insere ou atualiza um registro em todos os índices.
+        with self.lock:
+            old = self.by_id.get(b['id'])
+            if old is not None:
+                self._unindex(old)
+
+            self.by_id[b['id']] = b
+            self.by_auction.setdefault(b['auction_id'], OrderedDict())[b['id']] = b
+            self.by_user.setdefault(b['user_id'], OrderedDict())[b['id']] = b
+            self.last_id = max(self.last_id, b['id'])
+
+    def remove(self, id):
+        # Retira um registro de todos os índices.
+        with self.lock:
+            b = self.by_id.pop(id)
+            self._unindex(b)
+
+    def _unindex(self, b):
+        for index, key in ((self.by_auction, b['auction_id']),
+                           (self.by_user, b['user_id'])):
+            bucket = index.get(key)
+            if bucket is not None:
+                bucket.pop(b['id'], None)
+                if not bucket:
+                    del index[key]
+
+    def create(self, user_id, auction_id, value, bid_date, commit=True):
+        # Cria e persiste um novo registro. A lock só é mantida enquanto o
+        # id é reservado e os índices são atualizados; a escrita no
+        # armazenamento (que tem a sua própria lock) é feita depois, de
+        # modo que lances de leilões diferentes não esperam uns pelos
+        # outros durante a escrita. Com commit=False, a escrita fica a
+        # cargo de quem chamou (veja commit).
+        with self.lock:
+            b = {'id': self.next_id(), 'user_id': user_id,
+                 'auction_id': auction_id, 'value': value,
+                 'bid_date': bid_date}
+            self.put(b)
+
+        if commit:
+            self.storage.commit([b])
 
-FILENAME = os.path.splitext(__file__)[0] + '.json'
-FILELOCK = threading.RLock()
+        return b
 
+    def records(self):
+        # Cópia da lista de todos os registros, para a compactação.
+        with self.lock:
+            return list(self.by_id.values())
+
+    def compact(self):
+        # Compacta o armazenamento, se ele acumulou alterações demais.
+        if self.storage.needs_compaction():
+            self.storage.compact(self.records)
+
+    def commit(self, records):
+        # Persiste, num único commit, registros já presentes nos índices.
+        if records:
+            self.storage.commit(records)
+
+    def save(self, b):
+        # Atualiza os índices e persiste a alteração.
+        self.put(b)
+        self.storage.commit([b])
+
+    def delete(self, id):
+        # Retira o registro dos índices e persiste a deleção.
+        self.remove(id)
+        self.storage.commit(deleted=[id])
+
+    def delete_many(self, ids):
+        # Retira vários registros dos índices e persiste todas as deleções
+        # num único commit (no diário, um único acréscimo com as lápides).
+        # Os ids são filtrados com a lock em mãos: um registro apagado por
+        # outra thread no meio do caminho não é removido duas vezes.
+        with self.lock:
+            ids = [id for id in ids if id in self.by_id]
+            for id in ids:
+                self.remove(id)
+
+        if ids:
+            self.storage.commit(deleted=ids)
+
+    def close(self):
+        self.storage.close()
+
+
+class BinaryBidStore(object):
+    # Repositório dos lances no formato binário (veja binario.py), com a
+    # mesma interface de BidStore. Os registros ficam só no arquivo mapeado
+    # em memória; os índices guardam apenas os ids:
+    #   by_auction -> id do leilão -> ids dos lances daquele leilão
+    #   by_user    -> id do usuário -> ids dos lances daquele usuário
+    # e o lance de id i é lido direto da linha i - 1. As consultas
+    # desempacotam só as linhas pedidas; rows_by_auction devolve tuplas,
+    # sem montar um dicionário por lance.
+    # Não há passo separado de persistência: cada alteração é escrita na
+    # sua linha do arquivo na hora, e commit só regrava as linhas. As
+    # linhas dos lances apagados ficam zeradas (os ids não são reusados),
+    # de modo que não há compactação.
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = FILELOCK
+        self.file = None
+        self.by_auction = {}
+        self.by_user = {}
+        self.last_id = 0
+        self.name = 'armazenamento.lances'
+
+    def load(self):
+        # Abre o arquivo e monta os índices.
+        with metricas.timer(self.name + '.load'):
+            with self.lock:
+                if self.file is None:
+                    self.file = binario.BidFile(self.filename)
+
+                self.by_auction.clear()
+                self.by_user.clear()
+                self.last_id = 0
+
+                for r in self.file.scan(range(self.file.rows)):
+                    self._index(r)
+
+    def next_id(self):
+        # Retorna o próximo id livre. Deve ser chamado com a lock em mãos.
+        return self.last_id + 1
+
+    def get(self, id):
+        with self.lock:
+            r = self._read(id)
+        return None if r is None else binario.to_dict(r)
+
+    def filter_by_auction(self, id):
+        return self._filter(self.by_auction, id)
+
+    def filter_by_user(self, id):
+        return self._filter(self.by_user, id)
+
+    def rows_by_auction(self, id):
+        # Tuplas (id, user_id, value, instante) dos lances do leilão.
+        with self.lock:
+            rows = [i - 1 for i in self.by_auction.get(id, ())]
+            return [(r[0], r[1], r[3], r[4]) for r in self.file.scan(rows)]
+
+    def all(self):
+        with self.lock:
+            return [binario.to_dict(r) for r in
+                    self.file.scan(range(self.file.rows))]
+
+    def records(self):
+        return self.all()
+
+    def _filter(self, index, key):
+        with self.lock:
+            rows = [i - 1 for i in index.get(key, ())]
+            return [binario.to_dict(r) for r in self.file.scan(rows)]
+
+    def _read(self, id):
+        # Tupla do lance de id informado, ou None se ele não existe.
+        r = self.file.read(id - 1) if id > 0 else None
+        return r if r is not None and r[0] == id else None
+
+    def _index(self, r):
+        self.by_auction.setdefault(r[2], []).append(r[0])
+        self.by_user.setdefault(r[1], []).append(r[0])
+        self.last_id = max(self.last_id, r[0])
+
+    def _unindex(self, records):
+        # Retira dos índices os lances das tuplas informadas, reconstruindo
+        # uma vez cada lista afetada.
+        for index, column in ((self.by_auction, 2), (self.by_user, 1)):
+            removed = {}  # chave -> ids retirados
+            for r in records:
+                removed.setdefault(r[column], set()).add(r[0])
+
+            for key, ids in removed.items():
+                bucket = [i for i in index.get(key, ()) if i not in ids]
+                if bucket:
+                    index[key] = bucket
+                else:
+                    index.pop(key, None)
+
+    def put(self, b):
+        # Insere ou atualiza um registro no arquivo e nos índices.
+        r = binario.to_record(b)
+        with self.lock:
+            old = self._read(b['id'])
+            if old is not None:
+                self._unindex([old])
+
+            self.file.write(b['id'] - 1, r)
+            self._index(r)
+
+    def create(self, user_id, auction_id, value, bid_date, commit=True):
+        # Cria o registro direto na sua linha do arquivo; commit é aceito
+        # pela compatibilidade com BidStore.
+        with self.lock:
+            b = {'id': self.next_id(), 'user_id': user_id,
+                 'auction_id': auction_id, 'value': value,
+                 'bid_date': bid_date}
+            self.put(b)
+
+        metricas.count(self.name + '.gravados')
+        return b
 
-class Bid(object): #orientação ao objeto, justama para manipular mais facilmente os dados
-    @classmethod
-    def new(cls, user_id, auction_id, value): #cls - classe (Bid)
-        # Cria um novo objeto Bid com os dados informados e salva no
-        # arquivo json.
-        with FILELOCK:
-            with open(FILENAME) as f:
-                bids = json.load(f) #carrega nosso arquivo
+    def compact(self):
+        pass
 
-            try:
-                id = bids[-1]['id'] + 1
-            except IndexError:
-                id = 1
+    def commit(self, records):
+        for b in records:
+            self.put(b)
 
-            b = cls(id, user_id, auction_id, value,
-                    datetime.now().timetuple()[:6]) #timetuple retorma a lista contendo hora,minuto,segundo...
+    def save(self, b):
+        self.put(b)
+        metricas.count(self.name + '.gravados')
 
-            b.save()
+    def delete(self, id):
+        self.delete_many([id])
 
-        return b
+    def delete_many(self, ids):
+        # Zera as linhas dos lances e os retira dos índices.
+        with self.lock:
+            records = [r for r in (self._read(id) for id in ids)
+                       if r is not None]
+            for r in records:
+                self.file.erase(r[0] - 1)
+            self._unindex(records)
+
+        metricas.count(self.name + '.apagados', len(records))
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+                self.file.close()
+                self.file = None
+
+
+class Bid(object): #orientação ao objeto, justama para manipular mais facilmente os dados
+    @classmethod
+    def new(cls, user_id, auction_id, value, commit=True): #cls - classe (Bid)
+        # Cria um novo objeto Bid com os dados informados e salva no
+        # armazenamento. Com commit=False, o lance só entra no repositório
+        # em memória e deve ser gravado depois com save_many.
+        return cls.from_dict(STORE.create(
+            user_id, auction_id, value,
+            list(datetime.now().timetuple()[:6]), commit)) #timetuple retorma a lista contendo hora,minuto,segundo...
+
+    @classmethod
+    def from_dict(cls, b):
+        # Cria o objeto Bid a partir de um registro do repositório.
+        return cls(b['id'], b['user_id'], b['auction_id'], b['value'],
+                   b['bid_date'])
 
     @classmethod
     def load(cls, id):
         # Carrega o objeto Bid cujo id é o id informado.
-        with FILELOCK:
-            with open(FILENAME) as f:
-                bids = json.load(f)
+        b = STORE.get(id)
 
-        for b in bids:
-            if b['id'] == id:
-                return cls(b['id'], b['user_id'], b['auction_id'],
-                           b['value'], b['bid_date'])
+        if b is None:
+            raise Exception('Lance não encontrado.')
 
-        raise Exception('Lance não encontrado.')
+        return cls.from_dict(b)
 
     @classmethod
     def filter_by_user(cls, id): #carregar todos os lances do usuário -- para deletar o usuário--
         # Carrega todos os objetos Bid cujos user_id correspondem ao
         # id informado.
-        bid_list = []
-        with FILELOCK:
-            with open(FILENAME) as f:
-                bids = json.load(f)
-
-            for b in bids:
-                if b['user_id'] == id:
-                    bid_list.append(cls(b['id'], b['user_id'], b['auction_id'],
-                                        b['value'], b['bid_date']))
-
-        return bid_list
+        return [cls.from_dict(b) for b in STORE.filter_by_user(id)]
 
     @classmethod
     def filter_by_auction(cls, id): #listar os lances de um leilão
         # Carrega todos os Bids cujos auction_id correspondem ao id
         # informado.
-        bid_list = []
-        with FILELOCK:
-            with open(FILENAME) as f:
-                bids = json.load(f)
+        return [cls.from_dict(b) for b in STORE.filter_by_auction(id)]
 
-            for b in bids:
-                if b['auction_id'] == id:
-                    bid_list.append(cls(b['id'], b['user_id'], b['auction_id'],
-                                        b['value'], b['bid_date']))
-
-        return bid_list
+    @classmethod
+    def rows_by_auction(cls, id):
+        # Tuplas (id, user_id, value, instante) dos lances do leilão, para
+        # as varreduras que não precisam de objetos Bid.
+        return STORE.rows_by_auction(id)
 
     @classmethod
     def all(cls): #carrega todos os lances, para 
         # Carrega e retorna todos os objetos Bid.
-        with FILELOCK:
-            with open(FILENAME) as f:
-                bids = json.load(f)
-
-        return [cls(b['id'], b['user_id'], b['auction_id'],
-                    b['value'], b['bid_date']) for b in bids]
+        return [cls.from_dict(b) for b in STORE.all()]
 
     def __init__(self, id, user_id, auction_id, value, bid_date):
         self.id = id
@@ -96,44 +378,34 @@ class Bid(object): #orientação ao objeto, justama para manipular mais facilmen
         self.value = value
         self.bid_date = bid_date
 
-    def save(self):
-        # Salva este objeto Bid no arquivo json. Assim como os métodos
-        # de load (filter*, load, all), este método utiliza o lock de
-        # arquivo (semáforo) para ler de e escrever para o arquivo,
-        # evitando "confusões" de escrita e leitura.
-        with FILELOCK:
-            with open(FILENAME) as f:
-                bids = json.load(f)
+    @classmethod
+    def save_many(cls, bids):
+        # Grava de uma só vez os lances informados.
+        STORE.commit([b.to_dict() for b in bids])
 
-            for b in bids:
-                if b['id'] == self.id:
-                    break
-            else:
-                b = {'id': self.id}
-                bids.append(b)
+    @classmethod
+    def delete_many(cls, ids):
+        # Deleta de uma só vez os lances cujos ids foram informados.
+        STORE.delete_many(ids)
 
-            b['user_id'] = self.user_id
-            b['auction_id'] = self.auction_id
-            b['value'] = self.value
-            b['bid_date'] = self.bid_date
+    def to_dict(self):
+        return {'id': self.id, 'user_id': self.user_id,
+                'auction_id': self.auction_id, 'value': self.value,
+                'bid_date': self.bid_date}
 
-            with open(FILENAME, 'w') as f:
-                json.dump(bids, f)
+    def save(self):
+        # Salva este objeto Bid. Primeiro o registro é atualizado no
+        # repositório em memória e, em seguida, a alteração é persistida
+        # (uma linha no diário, uma linha no sqlite, ou o arquivo json
+        # inteiro no modo 'json'). Os índices são protegidos pela lock de
+        # arquivo (semáforo) e o armazenamento pela sua própria lock,
+        # evitando "confusões" de escrita e leitura.
+        STORE.save(self.to_dict())
 
     def delete(self):
-        # Deleta este objeto Bid do arquivo json.
-        with FILELOCK:
-            with open(FILENAME) as f:
-                bids = json.load(f)
-
-            for b in bids:
-                if b['id'] == self.id:
-                    break
-
-            bids.remove(b)
-
-            with open(FILENAME, 'w') as f:
-                json.dump(bids, f)
+        # Deleta este objeto Bid do repositório e do armazenamento (no
+        # diário, a deleção é registrada como uma lápide).
+        STORE.delete(self.id)
 
 
 # Abaixo é feito o preparo do arquivo de lances.
@@ -148,3 +420,35 @@ if not os.path.exists(FILENAME):
         # Escreve no arquivo uma "lista" json vazia.
         # Desta forma, deixamos o servidor preparado para ler e até mesmo
         # escrever json no arquivo.
+
+
+def _epoch(date):
+    # Converte uma data no formato dos arquivos json para segundos desde a
+    # época.
+    return time.mktime(datetime(*date).timetuple())
+
+
+def open_store(directory):
+    # Abre o repositório dos lances de um diretório de dados (o do servidor
+    # ou o de um fragmento; veja fragmentos.Router.migrate), conforme
+    # PERSISTENCE. Os arquivos têm os mesmos nomes em qualquer diretório.
+    filename, journal_filename, binary_filename, sqlite_filename = [
+        os.path.join(directory, os.path.basename(name))
+        for name in (FILENAME, JOURNAL_FILENAME, BINARY_FILENAME,
+                     armazenamento.SQLITE_FILENAME)]
+
+    if PERSISTENCE == 'binario' and armazenamento.BACKEND == 'json':
+        if not os.path.exists(binary_filename):
+            binario.from_json(filename, journal_filename, binary_filename)
+        return BinaryBidStore(binary_filename)
+
+    return BidStore(armazenamento.open_storage(
+        'lances', filename,
+        journal_filename if PERSISTENCE == 'journal' else None,
+        sqlite_filename))
+
+
+# O repositório é carregado uma única vez, aqui, logo após a garantia de
+# que o arquivo existe.
+STORE = open_store(armazenamento.DATA_DIR)
+STORE.load()
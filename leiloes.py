@@ -3,32 +3,92 @@
 from __future__ import print_function
 
 import os
-import json
+import sys
 import time
+import heapq
+import bisect
+import atexit
 import threading
-from datetime import datetime, timedelta
+from collections import OrderedDict
+from datetime import datetime
 
+import lances
+import armazenamento
+import metricas
+import sequenciador
 from lances import Bid
 from usuarios import User
 
 
-FILENAME = os.path.splitext(__file__)[0] + '.json'
-FILELOCK = threading.RLock()
+FILENAME = os.path.join(armazenamento.DATA_DIR, 'leiloes.json')
+JOURNAL_FILENAME = os.path.join(armazenamento.DATA_DIR, 'leiloes.jsonl')
+FILELOCK = metricas.TimedLock(threading.RLock(), 'leiloes.lock')
+FLUSHLOCK = threading.Lock()  # serializa as gravações em lote
+
+
+# Intervalo, em segundos, entre as gravações em lote do arquivo de leilões.
+FLUSH_INTERVAL = 1.0
+
+# Os ids dos leilões novos são os números que deixam resto ID_OFFSET na
+# divisão por ID_STRIDE. Com vários processos, cada fragmento cria só ids
+# que são seus (veja fragmentos.py).
+ID_STRIDE = 1
+ID_OFFSET = 0
+
+# Situações de um leilão, usadas para filtrar a listagem
+UPCOMING = 'agendado'
+RUNNING = 'aberto'
+FINISHED = 'encerrado'
+STATUSES = (UPCOMING, RUNNING, FINISHED)
 
 
 class Auction(object):
+    # A tabela de leilões fica residente em memória e é a fonte oficial dos
+    # dados enquanto o servidor roda: load devolve sempre o mesmo objeto
+    # para um mesmo id, de modo que todas as threads enxergam as mesmas
+    # alterações. save apenas marca o leilão como "sujo"; uma thread grava
+    # as alterações em lote no armazenamento (STORAGE) a cada
+    # FLUSH_INTERVAL segundos, e uma última vez quando o servidor é
+    # finalizado.
+
+    # id do leilão -> objeto Auction
+    _tabela = OrderedDict()
+
+    # ids dos leilões alterados desde a última gravação
+    _sujos = set()
+
+    # id do usuário -> ids dos leilões que ele segue (inverso de users)
+    _por_seguidor = {}
+
+    # Cache da listagem de leilões (lista_leiloes). Cada leilão é formatado
+    # uma única vez e o texto completo só é refeito quando algum leilão é
+    # criado, apagado, aberto ou fechado:
+    #   _listagem       -> id do leilão -> linha já formatada (veja __str__)
+    #   _listagem_texto -> texto completo, ou None se precisa ser refeito
+    _listagem = {}
+    _listagem_texto = None
+
+    # Índices da listagem filtrada, cada um uma lista ordenada de ids, o
+    # que permite paginar a partir de um cursor com uma busca binária:
+    #   _ids          -> todos os leilões
+    #   _por_status   -> situação (veja STATUSES) -> leilões nessa situação
+    #   _por_vendedor -> id do vendedor -> leilões desse vendedor
+    _ids = []
+    _por_status = dict((status, []) for status in STATUSES)
+    _por_vendedor = {}
+
+    _flusher = None
+
     @classmethod
     def new(cls, user_id, name, description, min_bid, day, month, year, hour,
             minute, second, max_timeout):
         # Cria um novo leilão com os dados especificados
         with FILELOCK:
-            with open(FILENAME) as f:
-                auctions = json.load(f)
-
             try:
-                id = auctions[-1]['id'] + 1
-            except IndexError:
+                id = next(reversed(cls._tabela)) + 1
+            except StopIteration:
                 id = 1
+            id += (ID_OFFSET - id) % ID_STRIDE
 
             start_date = (year, month, day, hour, minute, second)
 
@@ -36,56 +96,286 @@ class Auction(object):
                     max_timeout)
 
             a.save()
+            a.invalidate_listing()
+            cls._index(a)
 
         return a
 
     @classmethod
-    def load(cls, id):
-        # Carrega o leilão cujo id é o especificado nos argumentos
+    def from_dict(cls, a):
+        # Cria o objeto Auction a partir de um registro do arquivo json.
+        # Arquivos gravados antes dos agregados existirem não têm
+        # 'bid_count'; nesse caso os agregados são calculados a partir dos
+        # lances, uma única vez.
+        # Da mesma forma, sem 'closed', um leilão fechado cuja data de início
+        # já passou é considerado encerrado.
+        auction = cls(a['id'], a['user_id'], a['name'], a['description'],
+                      a['min_bid'], a['start_date'], a['max_timeout'],
+                      a['last_bid'], a['users'], a['open'],
+                      a.get('high_value'), a.get('leader_id'),
+                      a.get('bid_count', 0), a.get('last_bid_time'),
+                      a.get('closed', False), a.get('open_time'))
+
+        if 'bid_count' not in a:
+            auction.recompute_aggregates()
+
+        if 'closed' not in a:
+            auction.closed = (not auction.open and
+                              auction.time_to_start().total_seconds() <= 0)
+
+        return auction
+
+    @classmethod
+    def load_all(cls):
+        # Lê os leilões do armazenamento e monta a tabela em memória. É
+        # executado uma única vez, na inicialização do servidor.
         with FILELOCK:
-            with open(FILENAME) as f:
-                auctions = json.load(f)
+            auctions = STORAGE.load()
+
+            cls._tabela.clear()
+            cls._sujos.clear()
+            cls._por_seguidor.clear()
+            cls._listagem.clear()
+            Auction._listagem_texto = None
+            del cls._ids[:]
+            for ids in cls._por_status.values():
+                del ids[:]
+            cls._por_vendedor.clear()
 
-        for a in auctions:
-            if a['id'] == id:
-                return cls(a['id'], a['user_id'], a['name'], a['description'],
-                           a['min_bid'], a['start_date'], a['max_timeout'],
-                           a['last_bid'], a['users'], a['open'])
+            for a in auctions:
+                auction = cls._tabela[a['id']] = cls.from_dict(a)
+                cls._index(auction)
+                for user_id in a['users']:
+                    cls._por_seguidor.setdefault(user_id, set()).add(a['id'])
 
-        raise Exception('Leilão não encontrado.')
+    @classmethod
+    def reconcile(cls):
+        # Os lances são gravados um a um, mas os leilões só a cada
+        # FLUSH_INTERVAL (veja flush): se o servidor caiu no intervalo, os
+        # agregados gravados (último lance, contagem, maior lance) não
+        # incluem os lances mais recentes. Esses leilões têm os agregados
+        # recalculados a partir dos lances. Um leilão com lances que ainda
+        # consta como agendado já tinha aberto.
+        for a in cls.all():
+            ids = [r[0] for r in Bid.rows_by_auction(a.id)]
+            if len(ids) == a.bid_count and (not ids or max(ids) == a.last_bid):
+                continue
+
+            a.recompute_aggregates()
+
+            if ids and not a.open and not a.closed:
+                a.change_status(True, False)
+
+    @classmethod
+    def _index(cls, a):
+        # Inclui o leilão nos índices da listagem filtrada.
+        # A situação usada fica guardada no leilão, para que _unindex o
+        # encontre mesmo que ela mude depois.
+        with FILELOCK:
+            a.indexed_status = a.status()
+            bisect.insort(cls._ids, a.id)
+            bisect.insort(cls._por_status[a.indexed_status], a.id)
+            bisect.insort(cls._por_vendedor.setdefault(a.user_id, []), a.id)
+
+    @classmethod
+    def _unindex(cls, a):
+        # Retira o leilão dos índices da listagem filtrada.
+        with FILELOCK:
+            _remove_sorted(cls._ids, a.id)
+            _remove_sorted(cls._por_status[a.indexed_status], a.id)
+            _remove_sorted(cls._por_vendedor.get(a.user_id, []), a.id)
+
+    @classmethod
+    def load(cls, id):
+        # Carrega o leilão cujo id é o especificado nos argumentos
+        try:
+            return cls._tabela[id]
+        except KeyError:
+            raise Exception('Leilão não encontrado.')
 
     @classmethod #classmethod a nível de classe, ####
     def filter_by_user(cls, id):
         # Filtra leilões a partir do id de um usuário.
         # Retorna uma lista de leilões cujos user_id === id.
-        auction_list = []
-        with FILELOCK:
-            with open(FILENAME) as f:
-                auctions = json.load(f)
-
-            for a in auctions:
-                if a['user_id'] == id:
-                    auction_list.append(cls(
-                        a['id'], a['user_id'], a['name'], a['description'],
-                        a['min_bid'], a['start_date'], a['max_timeout'],
-                        a['last_bid'], a['users'], a['open']))
-
-        return auction_list
+        return [a for a in cls.all() if a.user_id == id]
 
     @classmethod
     def all(cls): #lista leiloes
         # Retorna todos os leilões presentes no sistema, abertos
         # ou não.
         with FILELOCK:
-            with open(FILENAME) as f:
-                auctions = json.load(f)
+            return list(cls._tabela.values())
 
-        return [cls(a['id'], a['user_id'], a['name'], a['description'],
-                    a['min_bid'], a['start_date'], a['max_timeout'],
-                    a['last_bid'], a['users'], a['open']) for a in auctions]
+    @classmethod
+    def listing(cls):
+        # Retorna o texto da listagem de todos os leilões, uma linha por
+        # leilão. Enquanto nenhum leilão mudar, devolve o texto já pronto,
+        # sem consultar o diretório de usuários.
+        with FILELOCK:
+            if cls._listagem_texto is None:
+                lines = [cls._line(a) for a in cls._tabela.values()]
+                Auction._listagem_texto = '\n'.join(lines)
+
+            return cls._listagem_texto
+
+    @classmethod
+    def page(cls, status=None, user_id=None, cursor=0, limit=None):
+        # Retorna as linhas da listagem dos leilões com id maior que cursor,
+        # filtrando pela situação e/ou pelo vendedor, até no máximo limit
+        # linhas. Também retorna o cursor da próxima página, ou None se não
+        # houver mais leilões. A busca parte do índice mais restrito e não
+        # monta a lista completa de leilões.
+        with FILELOCK:
+            if user_id is not None:
+                ids = cls._por_vendedor.get(user_id, [])
+            elif status is not None:
+                ids = cls._por_status[status]
+            else:
+                ids = cls._ids
+
+            lines = []
+            i = bisect.bisect_right(ids, cursor)
+            while i < len(ids):
+                a = cls._tabela[ids[i]]
+                i += 1
+
+                if status is not None and a.status() != status:
+                    continue
+
+                lines.append(cls._line(a))
+                if limit is not None and len(lines) >= limit:
+                    return lines, (a.id if i < len(ids) else None)
+
+            return lines, None
+
+    @classmethod
+    def _line(cls, a):
+        # Retorna a linha da listagem do leilão, usando o cache.
+        line = cls._listagem.get(a.id)
+        if line is None:
+            line = cls._listagem[a.id] = str(a)
+        return line
+
+    @classmethod
+    def followed_by(cls, user_id):
+        # Retorna os ids dos leilões que o usuário segue.
+        with FILELOCK:
+            return list(cls._por_seguidor.get(user_id, ()))
+
+    @classmethod
+    def flush(cls):
+        # Grava no armazenamento os leilões alterados ou apagados desde a
+        # última gravação. Todas as alterações acumuladas no intervalo
+        # saem num único commit. A lock de arquivo só é mantida enquanto
+        # os leilões são copiados; a escrita é feita depois, sem bloquear
+        # quem está alterando outros leilões.
+        with FLUSHLOCK:
+            with FILELOCK:
+                if not cls._sujos:
+                    return
+
+                saved = [cls._tabela[id].to_dict() for id in cls._sujos
+                         if id in cls._tabela]
+                deleted = [id for id in cls._sujos if id not in cls._tabela]
+                cls._sujos.clear()
+
+            STORAGE.commit(saved, deleted)
+
+            # De tempos em tempos, o diário vira uma nova base (veja
+            # armazenamento.JournalStorage.compact).
+            if STORAGE.needs_compaction():
+                STORAGE.compact(cls._snapshot)
+
+    @classmethod
+    def _snapshot(cls):
+        with FILELOCK:
+            return [a.to_dict() for a in cls._tabela.values()]
+
+    @classmethod
+    def resume(cls):
+        # Rearma no escalonador os prazos dos leilões não encerrados, na
+        # inicialização do servidor: um leilão agendado volta a esperar a
+        # abertura, e um leilão aberto fecha max_timeout segundos depois
+        # do último lance (ou da abertura, se ainda não houve lance).
+        # Prazos que já passaram enquanto o servidor estava parado disparam
+        # logo em seguida.
+        for a in cls.all():
+            if a.closed:
+                continue
+
+            if not a.open:
+                a.start()
+                continue
+
+            SCHEDULER.schedule(a.id, CLOSE, a.deadline())
+
+    @classmethod
+    def _mark_dirty(cls, id):
+        # Marca o leilão para a próxima gravação em lote e garante que a
+        # thread de gravação esteja rodando.
+        with FILELOCK:
+            cls._sujos.add(id)
+
+            if cls._flusher is None:
+                cls._flusher = threading.Thread(target=_flush_loop)
+                cls._flusher.daemon = True
+                cls._flusher.start()
+
+    @classmethod
+    def delete_many(cls, auctions, bid_ids=()):
+        # Deleta os leilões informados de uma só vez. Cada leilão sai da
+        # tabela na sua fila do sequenciador, como um lance: os lances que
+        # já estavam na fila entram antes e são apagados junto, e os que
+        # vierem depois não encontram mais o leilão. Em seguida, os lances
+        # desses leilões, junto com os lances extras de bid_ids, são
+        # apagados num único lote. A tabela é gravada na próxima gravação
+        # em lote, com todas as deleções juntas.
+        tasks = [sequenciador.SEQUENCER.submit(a.id, cls._remove, a,
+                                               wait=False)
+                 for a in auctions]
+
+        bid_ids = set(bid_ids)
+        for task in tasks:
+            bid_ids.update(task.get())
+
+        Bid.delete_many(sorted(bid_ids))
+
+        for a in auctions:
+            User.drop_followers(a.id)
+
+    @classmethod
+    def _remove(cls, a):
+        # Retira o leilão do escalonador (abertura e fechamento pendentes),
+        # da tabela e dos índices, e retorna os ids dos seus lances.
+        # Executado pelo sequenciador do leilão (veja delete_many).
+        SCHEDULER.cancel(a.id)
+
+        with FILELOCK:
+            cls._tabela.pop(a.id, None)
+            cls._mark_dirty(a.id)
+            a.invalidate_listing()
+            cls._unindex(a)
+
+            for user_id in a.users:
+                cls._por_seguidor.get(user_id, set()).discard(a.id)
+
+        return [r[0] for r in Bid.rows_by_auction(a.id)]
+
+    @classmethod
+    def recompute(cls, ids):
+        # Recalcula os agregados dos leilões informados depois que lances
+        # deles foram apagados, cada um na sua fila do sequenciador, para
+        # não se misturar com um lance novo. Leilões já apagados são
+        # ignorados.
+        tasks = [sequenciador.SEQUENCER.submit(id, _recompute, id, wait=False)
+                 for id in ids]
+        for task in tasks:
+            task.get()
 
     def __init__(self, id, user_id, name, description, min_bid, start_date,
-                 max_timeout, last_bid=None, users=None, open=False):
+                 max_timeout, last_bid=None, users=None, open=False,
+                 high_value=None, leader_id=None, bid_count=0,
+                 last_bid_time=None, closed=False, open_time=None):
         # Método inicializador do nosso Leilão.
         # Convetendo os dados do json para python e assim facilitando a manipulação.
         
@@ -99,6 +389,17 @@ class Auction(object):
         self.last_bid = last_bid
         self.users = [] if users is None else users #
         self.open = open
+        self.closed = closed  # True depois que o leilão termina
+        self.open_time = open_time  # instante da abertura (segundos)
+        self.indexed_status = None  # situação registrada nos índices
+
+        # Agregados dos lances, atualizados a cada lance em add_bid:
+        # maior valor, usuário que o deu, número de lances e instante (em
+        # segundos desde a época) do último lance.
+        self.high_value = high_value
+        self.leader_id = leader_id
+        self.bid_count = bid_count
+        self.last_bid_time = last_bid_time
 
     def __str__(self):
         # Método especial __str__. Retorna uma string legível
@@ -112,34 +413,44 @@ class Auction(object):
         # Retorna o objeto User associado ao criador deste leilão.
         return User.load(self.user_id) #pra pegar o nome pra def _str_
 
+    def to_dict(self):
+        # Converte os dados do objeto Auction em uma estrutura de dicionário,
+        # no formato do arquivo json.
+        return {'id': self.id, 'name': self.name, 'user_id': self.user_id,
+                'description': self.description, 'min_bid': self.min_bid,
+                'start_date': self.start_date,
+                'max_timeout': self.max_timeout, 'last_bid': self.last_bid,
+                'users': list(self.users), 'open': self.open,
+                'high_value': self.high_value, 'leader_id': self.leader_id,
+                'bid_count': self.bid_count,
+                'last_bid_time': self.last_bid_time, 'closed': self.closed,
+                'open_time': self.open_time}
+
     def save(self):
-        # Converte os dados do objeto Auction em uma estrutura de dicionário e salva em um arquivo json.
-        # Assim como nos métodos de loading,
-        # este método faz uso do lock (semáforo) para ler do e escrever para
-        # o arquivo.
+        # Registra o leilão na tabela em memória e o marca como alterado.
+        # A escrita no armazenamento é feita depois, em lote, pela thread
+        # de gravação (veja Auction.flush).
+        with FILELOCK:
+            self._tabela[self.id] = self
+            self._mark_dirty(self.id)
+
+    def status(self):
+        # Retorna a situação do leilão (veja STATUSES).
+        if self.open:
+            return RUNNING
+        return FINISHED if self.closed else UPCOMING
+
+    def change_status(self, open, closed):
+        # Abre ou fecha o leilão, mantendo os índices e o cache da
+        # listagem atualizados.
         with FILELOCK:
-            with open(FILENAME) as f:
-                auctions = json.load(f)
+            self.open = open
+            self.closed = closed
+            self.save()
 
-            for a in auctions:
-                if a['id'] == self.id:
-                    break
-            else:
-                a = {'id': self.id}
-                auctions.append(a)
-
-            a['name'] = self.name
-            a['user_id'] = self.user_id
-            a['description'] = self.description
-            a['min_bid'] = self.min_bid
-            a['start_date'] = self.start_date
-            a['max_timeout'] = self.max_timeout
-            a['last_bid'] = self.last_bid
-            a['users'] = self.users
-            a['open'] = self.open
-
-            with open(FILENAME, 'w') as f:
-                json.dump(auctions, f)
+            self._unindex(self)
+            self._index(self)
+            self.invalidate_listing()
 
     def time_to_start(self):
         # Retorna o tempo em segundos até o início do leilão
@@ -148,86 +459,266 @@ class Auction(object):
 
     def closes_in(self):
         # Retorna o tempo em segundos para terminar o leilão
-        if self.last_bid is None: 
+        if self.last_bid_time is None: 
             return None
 
-        diff = datetime.now() - datetime(*Bid.load(self.last_bid).bid_date) #tempo 
-        max_timeout = timedelta(seconds=self.max_timeout)
-        seconds_remaining = (diff - max_timeout).total_seconds() #
+        seconds_remaining = (self.last_bid_time + self.max_timeout -
+                             time.time())
+
+        return max(seconds_remaining, 0)
+
+    def deadline(self):
+        # Retorna o instante, em segundos desde a época, em que o leilão
+        # aberto fecha: max_timeout segundos depois do último lance, ou da
+        # abertura se ainda não houve lance.
+        since = self.last_bid_time or self.open_time
+        if since is None:  # Arquivos antigos não têm open_time
+            since = _timestamp(self.start_date)
 
-        return abs(seconds_remaining)
+        return since + self.max_timeout
 
     def delete(self):
-        # O primeiro passo é deletar todos os lances feitos neste
-        # leilão
-        bids = Bid.filter_by_auction(self.id)
+        self.delete_many([self])
 
-        for b in bids:
-            b.delete()
+    def invalidate_listing(self):
+        # Descarta a linha deste leilão no cache da listagem, que será
+        # formatada de novo na próxima chamada a listing.
+        with FILELOCK:
+            self._listagem.pop(self.id, None)
+            Auction._listagem_texto = None
 
-        # Depois prosseguimos para a deleção do leilão em si,
-        # assim como feito na deleção dos lances
+    def follow(self, user_id):
+        # Adiciona o usuário aos seguidores do leilão e inscreve as suas
+        # sessões logadas. Retorna False se ele já seguia o leilão.
         with FILELOCK:
-            with open(FILENAME) as f:
-                auctions = json.load(f)
+            following = self._por_seguidor.setdefault(user_id, set())
+            if self.id in following:
+                return False
 
-            for a in auctions:
-                if a['id'] == self.id:
-                    break
+            following.add(self.id)
+            self.users.append(user_id)
+            self.save()
+
+        User.subscribe(user_id, self.id)
+        return True
+
+    def unfollow(self, user_id):
+        # Retira o usuário dos seguidores do leilão. Lança ValueError se
+        # ele não seguia o leilão.
+        with FILELOCK:
+            self.users.remove(user_id) #remove é uma função da lista do python
+            self._por_seguidor[user_id].discard(self.id)
+            self.save()
+
+        User.unsubscribe(user_id, self.id)
+
+    def add_bid(self, bid):
+        # Registra um novo lance como o último do leilão, atualiza os
+        # agregados e empurra o prazo de fechamento para max_timeout
+        # segundos depois dele. Em caso de empate no valor, o lance mais
+        # antigo continua na frente.
+        # Executado pelo sequenciador do leilão (veja sequenciador), que
+        # já garante um lance de cada vez por leilão; por isso não é
+        # preciso a lock global aqui.
+        self.last_bid = bid.id #identificar o último lance no leilão
+        self.last_bid_time = time.time()
+        self.bid_count += 1
+
+        if self.high_value is None or bid.value > self.high_value:
+            self.high_value = bid.value
+            self.leader_id = bid.user_id
+
+        self.save()
+
+        SCHEDULER.schedule(self.id, CLOSE,
+                           self.last_bid_time + self.max_timeout)
+
+    def recompute_aggregates(self):
+        # Recalcula os agregados percorrendo os lances do leilão. Só é
+        # usado fora dos caminhos quentes: ao ler arquivos antigos, na
+        # recuperação após uma queda (veja reconcile) e quando lances são
+        # apagados.
+        with FILELOCK:
+            self.high_value = self.leader_id = self.last_bid_time = None
+            self.bid_count = 0
+
+            self.last_bid = None
 
-            auctions.remove(a)  #lista do python
+            for id, user_id, value, when in Bid.rows_by_auction(self.id):
+                self.bid_count += 1
+                if self.high_value is None or value > self.high_value:
+                    self.high_value = value
+                    self.leader_id = user_id
+                if self.last_bid is None or id > self.last_bid:
+                    self.last_bid = id
+                    self.last_bid_time = when
 
-            with open(FILENAME, 'w') as f:
-                json.dump(auctions, f)
+            self.save()
 
     def start(self):
-        # Essa função cria a thread com a contagem regressiva para a
-        # abertura do leilão, e conta os segundos antes de fechar.
-        # A thread é iniciada com a função _run abaixo.
-        t = threading.Thread(target=_run, args=(self.id,))
-        t.daemon = True #caso aperto ctrl+c pra thread não travar
-        t.start()
-
-	#Um contador dentro da def para o termino do leilão 
-def _run(auction_id):
+        # Agenda a abertura do leilão no escalonador. O fechamento é
+        # agendado quando o leilão abre (veja _open).
+        SCHEDULER.schedule(self.id, OPEN, _timestamp(self.start_date))
+
+
+# Tipos de prazo tratados pelo escalonador
+OPEN = 'open'
+CLOSE = 'close'
+
+
+class Scheduler(object):
+    # Escalonador único dos ciclos de vida dos leilões. Em vez de uma thread
+    # dormindo por leilão, os prazos de abertura e de fechamento de todos os
+    # leilões ficam numa fila de prioridade (heap), atendida por uma só
+    # thread.
+    # Cada leilão tem no máximo um prazo válido por vez. Reagendar (um novo
+    # lance adiando o fechamento, por exemplo) apenas empurra uma nova
+    # entrada no heap, em O(log n); as entradas antigas viram "lixo" e são
+    # descartadas quando chegam ao topo.
+
+    def __init__(self):
+        self.heap = []
+        self.pending = {}  # id do leilão -> número da entrada válida
+        self.seq = 0
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def schedule(self, auction_id, kind, deadline):
+        # Agenda (ou reagenda) o prazo do leilão para o instante deadline,
+        # em segundos desde a época.
+        with self.cond:
+            self.seq += 1
+            self.pending[auction_id] = self.seq
+            heapq.heappush(self.heap, (deadline, self.seq, kind, auction_id))
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True #caso aperto ctrl+c pra thread não travar
+                self.thread.start()
+
+            self.cond.notify()
+
+    def cancel(self, auction_id):
+        # Descarta o prazo pendente do leilão, se houver.
+        with self.cond:
+            self.pending.pop(auction_id, None)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if not self.heap:
+                        self.cond.wait()
+                        continue
+
+                    deadline, seq, kind, auction_id = self.heap[0]
+                    if self.pending.get(auction_id) != seq:  # entrada antiga
+                        heapq.heappop(self.heap)
+                        continue
+
+                    delay = deadline - time.time()
+                    if delay > 0:
+                        self.cond.wait(delay)
+                        continue
+
+                    heapq.heappop(self.heap)
+                    del self.pending[auction_id]
+                    break
+
+            # O evento é executado fora da lock, na fila do leilão no
+            # sequenciador: assim a abertura e o fechamento nunca se
+            # intercalam com um lance do mesmo leilão, e novos
+            # agendamentos não ficam esperando as notificações.
+            sequenciador.SEQUENCER.submit(auction_id, _fire, kind, auction_id,
+                                          wait=False)
+
+
+def _remove_sorted(ids, id):
+    # Remove id de uma lista ordenada, com busca binária.
+    i = bisect.bisect_left(ids, id)
+    if i < len(ids) and ids[i] == id:
+        del ids[i]
+
+
+def _timestamp(date):
+    # Converte uma data no formato dos arquivos json (ano, mês, dia, hora,
+    # minuto, segundo) para segundos desde a época.
+    return time.mktime(datetime(*date).timetuple())
+
+
+def _open(auction_id):
+    # Abre o leilão e agenda o seu fechamento. Se ninguém der lance, ele
+    # fecha após max_timeout segundos.
     a = Auction.load(auction_id)
-    seconds = a.time_to_start().total_seconds()
-    print(seconds)
-    time.sleep(seconds) #espera até o inicio do leilão
-    a = Auction.load(auction_id) #carrega novamente a auction
-    a.open = True
-    a.save()
-    #Envia para todos os usuários logados o leilão que abriu
-    for u in User._logados:
-        if u.id in a.users:
-            u.notify('Leilao aberto:\n%s\n> ' % a)
 
+    # Um evento repetido (o leilão já abriu ou já foi encerrado) é ignorado.
+    if a.open or a.closed:
+        return
+
+    a.open_time = time.time()
+    a.change_status(True, False)
+    SCHEDULER.schedule(a.id, CLOSE, a.open_time + a.max_timeout)
+
+    #Envia para os seguidores logados o leilão que abriu
+    User.publish(a.id, 'Leilao aberto:\n%s\n> ' % a)
+
+
+def _close(auction_id):
+    # Fecha o leilão, cujo prazo terminou sem nenhum lance novo, e avisa os
+    # seguidores sobre o lance vencedor.
     a = Auction.load(auction_id)
-    while True:
-        last_bid = a.last_bid #leilao
-        timeout = a.closes_in() #tempo pra ele fechar
 
-        if timeout is None:
-            timeout = a.max_timeout #se não houver lance, ele fecha com o max_timeout
+    # O evento pode estar vencido: um lance que estava na fila do leilão à
+    # frente dele já empurrou o prazo (e reagendou o fechamento), ou o
+    # leilão já foi fechado. Nesses casos não há nada a fazer.
+    if not a.open or time.time() < a.deadline():
+        return
+
+    a.change_status(False, True)
+
+    if a.bid_count == 0:
+        return
 
-        print(timeout)
-        time.sleep(timeout)
+    # O vencedor já é conhecido pelos agregados do leilão
+    winner = User.load(a.leader_id).name
+    User.publish(a.id, 'fim_leilao,%d,%.2f,%s' % (a.id, a.high_value, winner))
 
+
+def _recompute(auction_id):
+    # Executado pelo sequenciador do leilão (veja Auction.recompute).
+    try:
         a = Auction.load(auction_id)
-        if last_bid == a.last_bid:  # Ninguém fez nenhum lance e o tempo acabou
-            break
+    except Exception:
+        return  # Leilão já apagado
+
+    a.recompute_aggregates()
+
 
-    a.open = False
-    a.save()
+def _fire(kind, auction_id):
+    # Executa um evento do escalonador (abertura ou fechamento).
+    try:
+        if kind == OPEN:
+            _open(auction_id)
+        else:
+            _close(auction_id)
+    except Exception as e:
+        print(repr(e))
 
-    highest_bid = sorted(
-        Bid.filter_by_auction(a.id), key=lambda b: b.value, reverse=True)[0] #sorted pela uma lista e ele devolve uma lista ordenada 
-#lambda serve pra definir pelo oq o sorted vai ordenadar os lances, nesse casa é o valor
-    for u in User._logados:
-        if u.id in a.users:
-            u.notify(
-                'fim_leilao,%d,%.2f,%s' %
-                (a.id, highest_bid.value, User.load(highest_bid.user_id).name))
+
+def terminate(signum, frame):
+    # Tratador do SIGTERM (o sinal padrão do kill), que não executa o
+    # atexit: grava os leilões pendentes e sai pelo caminho normal.
+    Auction.flush()
+    sys.exit(0)
+
+
+def _flush_loop():
+    # Laço da thread de gravação em lote do arquivo de leilões. Aproveita
+    # para compactar o diário dos lances, quando necessário.
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        Auction.flush()
+        lances.STORE.compact()
 
 
 # Abaixo é feito o preparo do arquivo de leilões.
@@ -240,3 +731,39 @@ if not os.path.exists(FILENAME):
         # Escreve no arquivo uma "lista" json vazia.
         # Desta forma, deixamos o servidor preparado para ler e até mesmo
         # escrever json no arquivo.
+
+
+def open_storage(directory):
+    # Abre o armazenamento dos leilões de um diretório de dados (o do
+    # servidor ou o de um fragmento; veja fragmentos.Router.migrate). Os
+    # arquivos têm os mesmos nomes em qualquer diretório.
+    filename, journal_filename, sqlite_filename = [
+        os.path.join(directory, os.path.basename(name))
+        for name in (FILENAME, JOURNAL_FILENAME,
+                     armazenamento.SQLITE_FILENAME)]
+
+    return armazenamento.open_storage('leiloes', filename, journal_filename,
+                                      sqlite_filename)
+
+
+def start():
+    # Monta a tabela de leilões e rearma os prazos dos leilões em
+    # andamento. Executado uma única vez, na inicialização do servidor ou
+    # de cada fragmento; o processo da frente do modo com vários processos
+    # não tem leilões (veja fragmentos.py).
+    Auction.load_all()
+    Auction.reconcile()
+    Auction.resume()
+
+
+# O escalonador e o armazenamento são criados uma única vez, aqui, logo
+# após a garantia de que o arquivo existe; a tabela é montada por start.
+# Ao finalizar o servidor, as alterações pendentes são gravadas.
+SCHEDULER = Scheduler()
+STORAGE = open_storage(armazenamento.DATA_DIR)
+atexit.register(Auction.flush)
+
+metricas.gauge('leiloes.sujos', lambda: len(Auction._sujos))
+metricas.gauge('escalonador.prazos', lambda: len(SCHEDULER.pending))
+metricas.gauge('sequenciador.filas',
+               lambda: len(sequenciador.SEQUENCER.queues))
@@ -2,122 +2,274 @@
 
 from __future__ import print_function
 
+import os
+import sys
+import time
+import select
+import signal
 import socket
 import threading
+from collections import deque
 
 import comandos
+import metricas
+import perfil
+import leiloes
+import protocolo
+import fragmentos
 from usuarios import User
 
+try:
+    import Queue as queue
+except ImportError:  # Python 3
+    import queue
+
 # Host e porta utilizados pelo servidor
 HOST = '127.0.0.1'
 PORT = 5003
 
 
-def handle_connection(conn, addr):
-    # Função principal para lidar com novas conexões que o servidor receberá.
-    # Ela é a responsável por associar os sockets ao usuário correto.
-    # Um timeout padrão de 600 segundos (10 minutos) será imposto a fim de
-    # não sobrecarregar o servidor em caso de conexões inativas.
-    conn.settimeout(600)
+# Tempo máximo, em segundos, que uma conexão pode ficar inativa
+TIMEOUT = 600
 
-    # Após receber a conexão, o servidor deve aguardar por dados de login
-    # ou de registro. Ou, no caso do socket recebedor (secundário) do
-    # usuário, uma referência ao socket primário.
+# Tamanho da fila de conexões ainda não aceitas. Com fila 0, conexões
+# simultâneas ficam presas no handshake TCP.
+BACKLOG = 128
+
+# Número de threads que executam os comandos no modo por eventos (veja
+# serve_events). Um comando pode esperar pelo sequenciador do leilão ou,
+# no modo com vários processos, por um fragmento; enquanto isso, o laço
+# continua atendendo as outras conexões.
+WORKERS = 16
+
+# Valor retornado por anonymous_command quando a conexão passa a ser o
+# socket recebedor de um usuário já logado.
+RECEIVER = object()
+
+
+def greet(conn, buffered=False):
+    # Prepara uma conexão recém-aceita e envia a mensagem de boas-vindas.
+    # Retorna a conexão envolvida em um protocolo.Connection, que passa a
+    # ser usada no lugar do socket. Com buffered, nenhum envio pela conexão
+    # espera o socket (veja protocolo.Connection.buffered).
+    conn = protocolo.Connection(conn)
+    conn.settimeout(TIMEOUT)
+    conn.buffered = buffered
     conn.send(('[Servidor] Efetue login ou cadastre um novo usuário. '
               'Digite `ajuda` para listar os comandos disponíveis.'))
+    return conn
+
+
+def anonymous_command(conn, addr, command):
+    # Trata um comando recebido por uma conexão que ainda não está associada
+    # a nenhum usuário. Este comando pode ser ajuda, protocolo, faz_login,
+    # adiciona_usuario, lista_leiloes, metricas, perfil ou, no caso do
+    # socket recebedor (secundário) do usuário, uma referência ao socket
+    # primário.
+    # Retorna o usuário quando o login ou o registro dá certo, RECEIVER
+    # quando a conexão foi vinculada como socket recebedor, ou None se a
+    # conexão deve continuar aguardando comandos.
+    command_lower = command.lower()
+
+    if command_lower == 'ajuda':
+        conn.send('\n'.join(comandos.client_commands_anonymous))
+
+    elif command_lower.startswith('protocolo'):
+        # Cliente escolhe o modo de protocolo desta conexão (veja
+        # protocolo.py). A resposta ainda vai no modo anterior.
+        try:
+            command, mode = command.split(',')
+            mode = protocolo.MODES[mode]
+        except Exception as e:  # Modo desconhecido
+            print(repr(e))
+            conn.send('not_ok')
+            return None
+
+        conn.send('ok')
+        conn.set_mode(mode)
+
+    elif command_lower.startswith('faz_login'):
+        # Usuário tenta fazer login aqui. Segundo a especificação,
+        # ao separar a strings por vírgulas, temos
+        # o comando, o nome do usuário e sua senha. Logo:
+        try:
+            command, name, password = command.split(',')
+        except Exception as e:  # Cliente enviou menos ou mais que 3 dados
+            print(repr(e))
+            conn.send('not_ok')
+            return None
+
+        # E tentamos fazer o login do usuário com esses dados.
+        try:
+            user = User.login(conn, name, password)
+            print('[Servidor] %s:%d :: Usuário logado:' % addr,
+                  name)
+            conn.send('ok')
+            bind_single(user, conn)
+            return user
+        except Exception as e:  # O código do except será executado se não
+            # existe um usuário com esses dados
+            print(repr(e))
+            conn.send('not_ok')
+            print('[Servidor] %s:%d :: Falha no login:' % addr,
+                  name)
+
+    elif command_lower.startswith('adiciona_usuario'):
+        # Cliente tenta criar um usuário. Especifica-se:
+        # nome, telefone, endereço, e-mail e senha.
+        try:
+            command, name, phone, address, email, password = \
+                command.split(',')
+        except Exception as e:  # Cliente enviou menos ou mais que 6 dados
+            print(repr(e))
+            conn.send('not_ok')
+            return None
+
+        # Pode ser que já exista um usuário com esse nome.
+        # Se for o caso, não deve ser possível fazer o registro.
+
+        try:
+            user = User.signup(conn, name, phone, address,
+                               email, password)# Tentar registrar
+            print('[Servidor] %s:%d :: Usuário registrado:' % addr,
+                  name)
+            conn.send('ok')
+            bind_single(user, conn)
+            return user
+        except Exception as e:  # O código do except será executado se não
+            # existe um usuário com esses dados
+            print(repr(e))
+            conn.send('not_ok')
+            print('[Servidor] %s:%d :: Falha no registro:' % addr,
+                  name)
+
+    elif command.startswith('lista_leiloes'): #startwith se a string começa com essa texto --> não precisava
+        handler = comandos.lista_leiloes
+        if fragmentos.ROUTER is not None:  # Modo com vários processos
+            handler = fragmentos.ROUTER.handler('lista_leiloes', handler)
+
+        try:
+            auctions = handler(None, command)
+        except Exception as e:  # Filtros inválidos
+            print(repr(e))
+            auctions = 'not_ok'
+        conn.send(auctions)
+
+    elif command.startswith('metricas'):
+        # Comando de administração: `metricas,<token>` responde com as
+        # métricas do servidor, em json (veja metricas.py).
+        if (metricas.ADMIN_TOKEN
+                and command == 'metricas,' + metricas.ADMIN_TOKEN):
+            conn.send(metricas.report() + '\nok')
+        else:
+            conn.send('not_ok')
+
+    elif command.startswith('perfil'):
+        # Comando de administração: `perfil,<token>,<opções>` liga ou
+        # desliga o perfilamento dos comandos (veja perfil.py).
+        args = command.split(',')
+        try:
+            if not metricas.ADMIN_TOKEN or args[1] != metricas.ADMIN_TOKEN:
+                raise ValueError('token')
+            perfil.configure(args[2:], comandos.client_commands)
+            conn.send('ok')
+        except (IndexError, ValueError) as e:
+            print(repr(e))
+            conn.send('not_ok')
+
+    elif command.isdigit():
+        # Se a string for um número, deve ser o segundo socket
+        # enviando o número da porta do primeiro socket
+        # para que seja possível ligá-lo ao usuário logado.
+        port_number = int(command)
+
+        try:
+            user = User.get_user_by_socket_port(port_number)
+
+            # Associa o socket da conexão atual ao usuário; este
+            # socket é o socket recebedor do usuário. Por este
+            # socket o servidor enviará as atualizações automáticas
+            # como, por exemplo, novos lances em leilões em que
+            # o usuário participa.
+            user.bind_receiver_socket(conn)
+            conn.send('ok')
+            return RECEIVER
+
+        except Exception as e:  # Não há um usuário logado cuja porta do socket
+            # primário é essa
+            print(repr(e))
+            conn.send('not_ok')
+
+    else:
+        conn.send('not_ok')
+
+    return None
+
+
+def bind_single(user, conn):
+    # No modo de socket único, a própria conexão recebe as notificações da
+    # sessão, dispensando o socket recebedor (veja protocolo.SINGLE).
+    if conn.mode == protocolo.SINGLE:
+        user.bind_receiver_socket(protocolo.Pushes(conn))
+
+
+def user_command(user, data):
+    # Executa um comando de um usuário logado, despachando-o para a função
+    # correspondente em comandos.client_functions, e envia a resposta.
+    command = data.partition(',')[0] #Funciona parecido com slpit porém pega o primeiro comando antes da virgula [0]
+
+    if command not in comandos.client_commands:
+        user.answer('not_ok')
+        return
 
     try:
-        while True:
-            # Aguarda um comando. Este comando pode ser ajuda, faz_login
-            # ou adiciona_usuario.
-            command = conn.recv(1024)
-            command_lower = command.lower()
+        handler = comandos.client_functions[command]
+        if fragmentos.ROUTER is not None:  # Modo com vários processos
+            handler = fragmentos.ROUTER.handler(command, handler)
 
-            if command_lower == 'ajuda':
-                conn.send('\n'.join(comandos.client_commands_anonymous))
+        with metricas.timer('comando.' + command):
+            output = perfil.run(command, handler, user, data)
+        user.answer('ok' if output is True else output) #se o output for explicitamento True responde com OK, snão responde com o próprio output
+    except Exception as e:
+        print(repr(e)) #representação da except debug
+        metricas.count('comando.%s.erros' % command)
+        user.answer('not_ok')
 
-            elif command_lower.startswith('faz_login'):
-                # Usuário tenta fazer login aqui. Segundo a especificação,
-                # ao separar a strings por vírgulas, temos
-                # o comando, o nome do usuário e sua senha. Logo:
-                try:
-                    command, name, password = command.split(',')
-                except Exception as e:  # Cliente enviou menos ou mais que 3 dados
-                    print(repr(e))
-                    conn.send('not_ok')
-                    continue
 
-                # E tentamos fazer o login do usuário com esses dados.
-                try:
-                    user = User.login(conn, name, password)
-                    print('[Servidor] %s:%d :: Usuário logado:' % addr,
-                          name)
-                    conn.send('ok')
-                    break  # Sai do loop infinito para continuar
-                except Exception as e:  # O código do except será executado se não
-                    # existe um usuário com esses dados
-                    print(repr(e))
-                    conn.send('not_ok')
-                    print('[Servidor] %s:%d :: Falha no login:' % addr,
-                          name)
+def user_timeout(user):
+    # Encerra a sessão de um usuário inativo por mais de TIMEOUT segundos.
+    user.answer('[Servidor] Tempo excedido.')
+    user.sender.close()
 
-            elif command_lower.startswith('adiciona_usuario'):
-                # Cliente tenta criar um usuário. Especifica-se:
-                # nome, telefone, endereço, e-mail e senha.
-                try:
-                    command, name, phone, address, email, password = \
-                        command.split(',')
-                except Exception as e:  # Cliente enviou menos ou mais que 6 dados
-                    print(repr(e))
-                    conn.send('not_ok')
-                    continue
+    if user.receiver is not None:
+        user.receiver.close()
 
-                # Pode ser que já exista um usuário com esse nome.
-                # Se for o caso, não deve ser possível fazer o registro.
+    user.logout()
 
-                try:
-                    user = User.signup(conn, name, phone, address,
-                                       email, password)# Tentar registrar
-                    print('[Servidor] %s:%d :: Usuário registrado:' % addr,
-                          name)
-                    conn.send('ok')
-                    break  # Sai do loop infinito para continuar
-                except Exception as e:  # O código do except será executado se não
-                    # existe um usuário com esses dados
-                    print(repr(e))
-                    conn.send('not_ok')
-                    print('[Servidor] %s:%d :: Falha no registro:' % addr,
-                          name)
 
-            elif command.startswith('lista_leiloes'): #startwith se a string começa com essa texto --> não precisava
-                auctions = comandos.lista_leiloes()
-                conn.send(auctions)
+def handle_connection(conn, addr):
+    # Função principal para lidar com novas conexões que o servidor receberá.
+    # Ela é a responsável por associar os sockets ao usuário correto.
+    # Um timeout padrão de 600 segundos (10 minutos) será imposto a fim de
+    # não sobrecarregar o servidor em caso de conexões inativas.
 
-            elif command.isdigit():
-                # Se a string for um número, deve ser o segundo socket
-                # enviando o número da porta do primeiro socket
-                # para que seja possível ligá-lo ao usuário logado.
-                port_number = int(command)
+    # Após receber a conexão, o servidor deve aguardar por dados de login
+    # ou de registro. Ou, no caso do socket recebedor (secundário) do
+    # usuário, uma referência ao socket primário.
+    conn = greet(conn)
 
-                try:
-                    user = User.get_user_by_socket_port(port_number)
-
-                    # Associa o socket da conexão atual ao usuário; este
-                    # socket é o socket recebedor do usuário. Por este
-                    # socket o servidor enviará as atualizações automáticas
-                    # como, por exemplo, novos lances em leilões em que
-                    # o usuário participa.
-                    user.bind_receiver_socket(conn)
-                    conn.send('ok')
-                    return
-
-                except Exception as e:  # Não há um usuário logado cuja porta do socket
-                    # primário é essa
-                    print(repr(e))
-                    conn.send('not_ok')
+    try:
+        while True:
+            # Aguarda um comando e o trata (veja anonymous_command).
+            command = conn.recv(1024)
+            result = anonymous_command(conn, addr, command)
 
-            else:
-                conn.send('not_ok')
+            if result is RECEIVER:
+                return
+
+            if result is not None:
+                user = result
+                break  # Sai do loop infinito para continuar
 
     except socket.timeout: #caso o cliente não mande nada 
         conn.send('[Servidor] Tempo excedido.')
@@ -132,55 +284,289 @@ def handle_user(user): #usuario logado
     try:
         while True:
             data = user.recv() #def recv no usuários
-            command = data.partition(',')[0] #Funciona parecido com slpit porém pega o primeiro comando antes da virgula [0]
+            user_command(user, data)
+
+    except socket.timeout:
+        user_timeout(user)
+
+
+def serve_threads(server):
+    # Modo padrão: uma thread por conexão aceita.
+    while True:
+        # Aqui deixamos um loop infinito onde o servidor aceita
+        # conexões. Todo o resto será feito pelas threads criadas
+        # após este ponto.
+        connection = server.accept()
+
+        print('[Servidor] Nova conexão de %s:%d' % connection[1])
+
+        # Inicia uma nova thread com os dados de conexão recebidos
+        t = threading.Thread(target=handle_connection, args=connection)
+        t.daemon = True
+        t.start()
+
+
+def serve_events(server):
+    # Modo por eventos: todas as conexões são multiplexadas num único laço,
+    # sem nenhuma thread por conexão. O laço usa epoll (ou poll, onde epoll
+    # não existe) para descobrir quais sockets têm dados, e cada mensagem
+    # recebida passa pelas mesmas funções do modo com threads
+    # (anonymous_command e user_command).
+    # Os comandos não rodam no laço, e sim num grupo fixo de threads
+    # (WORKERS): um lance que espera a fila do leilão, ou um comando que
+    # espera um fragmento, não atrasa as outras conexões. Cada conexão tem
+    # no máximo um comando em execução; enquanto ele roda, a conexão sai
+    # do poller, e os comandos seguintes dela esperam a sua vez, em ordem.
+    # Ao terminar, a thread devolve o resultado ao laço por um pipe.
+    # Nenhum envio espera o socket: as conexões são buffered, e o que o
+    # socket não aceitou na hora fica na conexão até o laço receber
+    # POLLOUT. Enquanto há respostas pendentes, a conexão não é lida, de
+    # modo que um cliente que não lê as respostas não acumula mais delas.
+    # A inatividade das conexões é verificada pelo próprio laço.
+    if hasattr(select, 'epoll'):
+        poller, scale = select.epoll(), 1
+    else:
+        poller, scale = select.poll(), 1000
+
+    # descritor -> [socket, endereço, usuário (None se anônimo, RECEIVER se
+    # é um socket recebedor com o ok ainda pendente), último uso, comandos
+    # ainda não executados, True se há um comando em execução]
+    connections = {}
+    # descritor -> eventos registrados no poller
+    registered = {}
+
+    commands = queue.Queue()  # (descritor, estado, comando) a executar
+    done = queue.Queue()  # (descritor, estado, resultado) já executados
+    wake, notify = os.pipe()
+
+    for i in range(WORKERS):
+        t = threading.Thread(target=_command_worker,
+                             args=(commands, done, notify))
+        t.daemon = True
+        t.start()
+
+    def watch(fd, conn):
+        # Registra o fd para leitura ou, com envio pendente, para escrita.
+        events = select.POLLOUT if conn.out else select.POLLIN
+        if registered.get(fd) == events:
+            return
+
+        if fd in registered:
+            poller.modify(fd, events)
+        else:
+            poller.register(fd, events)
+        registered[fd] = events
+
+    def unwatch(fd):
+        if registered.pop(fd, None) is not None:
+            poller.unregister(fd)
+
+    def forget(fd):
+        connections.pop(fd, None)
+        registered.pop(fd, None)
+        try:
+            poller.unregister(fd)
+        except (IOError, OSError, KeyError, ValueError):
+            pass  # O socket já foi fechado por outro caminho (sair, etc.)
+
+    def drop(fd, conn, user):
+        # Encerra a conexão (e a sessão, se houver) após um erro ou o
+        # fechamento pelo cliente.
+        forget(fd)
+        if user is not None and user in User._logados:
+            user.logout()
+        else:
+            conn.close()
+
+    def run_next(fd, state):
+        # Entrega o próximo comando da conexão às threads, ou volta a
+        # vigiar a conexão se não há mais comandos.
+        if not state[4]:
+            watch(fd, state[0])
+            return
+
+        unwatch(fd)
+        state[5] = True
+        commands.put((fd, state, state[4].popleft()))
+
+    def finish(fd, state, result):
+        # Aplica o resultado de um comando executado pelas threads.
+        conn, addr, user = state[:3]
+        state[3] = time.time()
+        state[5] = False
+
+        if isinstance(result, socket.error):
+            print(repr(result))
+            drop(fd, conn, user)
+        elif user is None and result is RECEIVER:
+            # O socket recebedor só é usado para envio; o laço só o
+            # acompanha até o ok sair.
+            state[4].clear()
+            if conn.out:
+                state[2] = RECEIVER
+                watch(fd, conn)
+            else:
+                forget(fd)
+        elif user is not None and user not in User._logados:
+            forget(fd)  # sair ou apaga_usuario
+        else:
+            if user is None and result is not None:
+                state[2] = result
+            run_next(fd, state)
+
+    poller.register(server.fileno(), select.POLLIN)
+    poller.register(wake, select.POLLIN)
+    last_sweep = time.time()
+
+    while True:
+        for fd, event in poller.poll(1 * scale):
+            if fd == server.fileno():
+                conn, addr = server.accept()
+                print('[Servidor] Nova conexão de %s:%d' % addr)
+                try:
+                    conn = greet(conn, buffered=True)
+                except socket.error as e:
+                    print(repr(e))
+                    conn.close()
+                    continue
+
+                connections[conn.fileno()] = [conn, addr, None, time.time(),
+                                              deque(), False]
+                watch(conn.fileno(), conn)
+                continue
+
+            if fd == wake:  # Comandos executados pelas threads
+                os.read(wake, 4096)
+                while True:
+                    try:
+                        fd, state, result = done.get_nowait()
+                    except queue.Empty:
+                        break
+
+                    # A conexão pode ter sido fechada pelo comando, e o
+                    # descritor reaproveitado por uma conexão nova.
+                    if connections.get(fd) is state:
+                        finish(fd, state, result)
+                continue
 
-            if command not in comandos.client_commands:
-                user.answer('not_ok')
+            state = connections.get(fd)
+            if state is None:
+                forget(fd)
                 continue
 
+            conn, addr, user = state[:3]
+            state[3] = time.time()
+
             try:
-                output = comandos.client_functions[command](user, data) 
-                user.answer('ok' if output is True else output) #se o output for explicitamento True responde com OK, snão responde com o próprio output
-            except Exception as e:
-                print(repr(e)) #representação da except debug
-                user.answer('not_ok')
+                if conn.out or not event & select.POLLIN:
+                    # Conexão esperando para enviar (POLLOUT, ou erro)
+                    conn.flush()
+                    if user is RECEIVER and not conn.out:
+                        forget(fd)
+                    else:
+                        watch(fd, conn)
+                    continue
 
-    except socket.timeout:
-        user.answer('[Servidor] Tempo excedido.')
-        user.sender.close()
+                data = conn.sock.recv(1024)
+
+                if not data:  # O cliente fechou a conexão
+                    drop(fd, conn, user)
+                    continue
+
+                # Um mesmo recv pode trazer vários comandos (ou nenhum
+                # completo) no modo com quadros; são executados em ordem.
+                state[4].extend(conn.feed(data))
+                run_next(fd, state)
+
+            except socket.error as e:
+                print(repr(e))
+                drop(fd, conn, user)
+
+        # Uma vez por segundo, encerra as conexões inativas
+        now = time.time()
+        if now - last_sweep >= 1:
+            last_sweep = now
+            for fd, state in list(connections.items()):
+                conn, addr, user, last, pending, running = state
+                if running or now - last < TIMEOUT:
+                    continue
+
+                forget(fd)
+                try:
+                    if user is RECEIVER:  # Encerrado junto com a sessão
+                        continue
+                    elif user is None:
+                        conn.send('[Servidor] Tempo excedido.')
+                        conn.close()
+                        print('[Servidor] %s:%d :: Tempo excedido.' % addr)
+                    else:
+                        user_timeout(user)
+                except socket.error as e:
+                    print(repr(e))
+
+
+def _command_worker(commands, done, notify):
+    # Thread do modo por eventos: executa os comandos entregues pelo laço
+    # e devolve o resultado (o de anonymous_command, ou o erro do socket),
+    # acordando o laço pelo pipe.
+    while True:
+        fd, state, command = commands.get()
+        conn, addr, user = state[:3]
 
-        if user.receiver is not None:
-            user.receiver.close()
+        try:
+            if user is None:
+                result = anonymous_command(conn, addr, command)
+            else:
+                result = user_command(user, command)
+        except socket.error as e:
+            result = e
 
-        user.logout()
+        done.put((fd, state, result))
+        os.write(notify, b'.')
 
 
 # A verificação abaixo serve para saber se o programa teve como ponto
 # de entrada este arquivo. Se for, inicializamos e levantamos o
 # servidor e começamos a ouvir as conexões.
+# Executado com `--eventos`, o servidor usa o laço de eventos em vez de
+# uma thread por conexão.
 if __name__ == '__main__':
+    # A porta pode ser trocada com --porta=<número> (usado pelo desempenho.py)
+    # e --fragmentos=<N> liga o modo com N processos (veja fragmentos.py).
+    shards = 0
+    for arg in sys.argv[1:]:
+        if arg.startswith('--porta='):
+            PORT = int(arg.split('=', 1)[1])
+        elif arg.startswith('--fragmentos='):
+            shards = int(arg.split('=', 1)[1])
+
+    # O kill também grava as alterações pendentes (veja leiloes.terminate)
+    signal.signal(signal.SIGTERM, leiloes.terminate)
+
+    # Sem fragmentos, os leilões ficam neste processo
+    if shards:
+        fragmentos.start(shards)
+    else:
+        leiloes.start()
+
     server = socket.socket()  # Inicializa um socket
+    # Permite reiniciar o servidor logo em seguida, na mesma porta
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     print('[Servidor] Inicializando servidor em %s:%d...' % (HOST, PORT))
     server.bind((HOST, PORT))  # Vincula o servidor ao endereço de IP 127.0.0.1 e porta:5003
     
 
-    server.listen(0)  # Aqui habilitamos o servidor para começar a ouvir conexões que chegam
+    server.listen(BACKLOG)  # Aqui habilitamos o servidor para começar a ouvir conexões que chegam
     
+    metricas.start()
+
     try:
+        # O try/except serve para capturar o Ctrl-C
         print('[Servidor] Aguardando conexões...')
-        while True:
-            # Aqui deixamos um loop infinito onde o servidor aceita
-            # conexões. Todo o resto será feito pelas threads criadas
-            # após este ponto. O try/except serve para capturar 
-           
-            connection = server.accept()
-
-            print('[Servidor] Nova conexão de %s:%d' % connection[1])
-
-            # Inicia uma nova thread com os dados de conexão recebidos
-            t = threading.Thread(target=handle_connection, args=connection)
-            t.daemon = True
-            t.start()
+        if '--eventos' in sys.argv:
+            serve_events(server)
+        else:
+            serve_threads(server)
 
     except KeyboardInterrupt:
         print('\n[Servidor] Ctrl-C recebido. Finalizando...')
@@ -0,0 +1,266 @@
+# encoding: utf-8
+
+from __future__ import print_function
+
+import os
+import json
+import time
+import threading
+
+import armazenamento
+
+
+# Métricas internas do servidor: contadores, histogramas de latência e
+# medidores (valores lidos na hora, como o tamanho de uma fila). São
+# medidos o despacho dos comandos, a espera pelas locks dos modelos, a
+# leitura e gravação do armazenamento e as notificações.
+# As métricas podem ser lidas pelo comando de administração
+# `metricas,<token>` (veja ADMIN_TOKEN) ou gravadas periodicamente em
+# DUMP_FILENAME (veja DUMP_INTERVAL).
+# Cada thread soma os seus contadores e histogramas sem lock nenhuma (veja
+# ThreadMetrics); a leitura junta os de todas as threads.
+
+# Token do comando de administração. Sem token, o comando fica desativado.
+ADMIN_TOKEN = os.environ.get('LEILAO_ADMIN_TOKEN')
+
+# Intervalo, em segundos, entre as gravações das métricas em arquivo.
+# Zero desativa a gravação.
+DUMP_INTERVAL = float(os.environ.get('LEILAO_METRICAS_INTERVALO', 0))
+# Arquivo da gravação; None é metricas.json no diretório de dados
+# (armazenamento.DATA_DIR, lido na hora, pois armazenamento importa este
+# módulo).
+DUMP_FILENAME = None
+
+# Limites superiores, em segundos, das faixas dos histogramas
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# Lock do registro das threads e dos medidores. Não é tomada ao contar.
+LOCK = threading.Lock()
+
+_threads = []  # (thread, ThreadMetrics) das threads que registraram métricas
+_gauges = {}  # nome -> função que retorna o valor atual
+_local = threading.local()
+
+
+class Histogram(object):
+    # Distribuição de latências em faixas fixas (BUCKETS), mais a soma e o
+    # máximo. Os percentis são estimados pelo limite superior da faixa.
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # a última faixa é o resto
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        i = 0
+        while i < len(BUCKETS) and value > BUCKETS[i]:
+            i += 1
+
+        self.counts[i] += 1
+        self.n += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        # Soma as contagens de outro histograma a este.
+        for i, count in enumerate(list(other.counts)):
+            self.counts[i] += count
+        self.n += other.n
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        if not self.n:
+            return None
+
+        rank = p / 100.0 * self.n
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return BUCKETS[i] if i < len(BUCKETS) else self.max
+
+    def to_dict(self):
+        return {'n': self.n, 'soma': self.total, 'max': self.max,
+                'p50': self.percentile(50), 'p99': self.percentile(99),
+                'faixas': dict(('<=%g' % b, c) for b, c
+                               in zip(BUCKETS + (float('inf'),),
+                                      self.counts))}
+
+
+class ThreadMetrics(object):
+    # Contadores e histogramas de uma thread. Só a própria thread escreve
+    # neles, sem lock; snapshot os lê (com o GIL, cada leitura vê um valor
+    # inteiro, no máximo uma soma atrasada em relação a outra).
+
+    def __init__(self):
+        self.counters = {}  # nome -> valor
+        self.histograms = {}  # nome -> Histogram
+
+    def merge_into(self, counters, histograms):
+        for name, value in list(self.counters.items()):
+            counters[name] = counters.get(name, 0) + value
+
+        for name, h in list(self.histograms.items()):
+            total = histograms.get(name)
+            if total is None:
+                total = histograms[name] = Histogram()
+            total.merge(h)
+
+
+# Métricas das threads que já terminaram
+_retired = ThreadMetrics()
+
+
+class Timer(object):
+    # Gerenciador de contexto que registra a duração do bloco no
+    # histograma name.
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.time() - self.start)
+
+
+class TimedLock(object):
+    # Envolve uma lock (Lock ou RLock), registrando o tempo de espera de
+    # cada aquisição no histograma '<name>.espera'. Pode ser usada no lugar
+    # da lock original.
+
+    def __init__(self, lock, name):
+        self.lock = lock
+        self.name = name + '.espera'
+
+    def acquire(self, blocking=True):
+        start = time.time()
+        acquired = self.lock.acquire(blocking)
+        observe(self.name, time.time() - start)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def _mine():
+    # Métricas da thread atual, registradas no primeiro uso.
+    try:
+        return _local.metrics
+    except AttributeError:
+        pass
+
+    metrics = _local.metrics = ThreadMetrics()
+    with LOCK:
+        # Aproveita para recolher as métricas das threads que terminaram
+        alive = []
+        for t, m in _threads:
+            if t.is_alive():
+                alive.append((t, m))
+            else:
+                m.merge_into(_retired.counters, _retired.histograms)
+
+        alive.append((threading.current_thread(), metrics))
+        _threads[:] = alive
+
+    return metrics
+
+
+def count(name, n=1):
+    counters = _mine().counters
+    counters[name] = counters.get(name, 0) + n
+
+
+def observe(name, seconds):
+    histograms = _mine().histograms
+    h = histograms.get(name)
+    if h is None:
+        h = histograms[name] = Histogram()
+    h.add(seconds)
+
+
+def timer(name):
+    return Timer(name)
+
+
+def gauge(name, func):
+    # Registra um medidor: func é chamada a cada leitura das métricas.
+    with LOCK:
+        _gauges[name] = func
+
+
+def snapshot():
+    # Retorna todas as métricas num dicionário, pronto para json.
+    counters = {}
+    histograms = {}
+    with LOCK:
+        _retired.merge_into(counters, histograms)
+        for t, m in _threads:
+            m.merge_into(counters, histograms)
+        gauges = list(_gauges.items())
+
+    result = {
+        'instante': time.time(),
+        'contadores': counters,
+        'histogramas': dict((name, h.to_dict())
+                            for name, h in histograms.items()),
+    }
+
+    # Os medidores são lidos fora da lock, pois podem tomar outras locks.
+    result['medidores'] = {}
+    for name, func in gauges:
+        try:
+            result['medidores'][name] = func()
+        except Exception as e:
+            print(repr(e))
+
+    return result
+
+
+def report():
+    # Métricas em json, como resposta ao comando de administração.
+    return json.dumps(snapshot(), sort_keys=True)
+
+
+def dump():
+    # Grava as métricas em DUMP_FILENAME. O arquivo é trocado de uma vez,
+    # para que quem o lê nunca veja uma gravação pela metade.
+    filename = DUMP_FILENAME or os.path.join(armazenamento.DATA_DIR,
+                                             'metricas.json')
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(report())
+    os.rename(tmp, filename)
+
+
+def start():
+    # Inicia a gravação periódica, se estiver configurada.
+    if DUMP_INTERVAL <= 0:
+        return
+
+    t = threading.Thread(target=_dump_loop)
+    t.daemon = True
+    t.start()
+
+
+def _dump_loop():
+    while True:
+        time.sleep(DUMP_INTERVAL)
+        try:
+            dump()
+        except Exception as e:
+            print(repr(e))
+
+
+gauge('threads', threading.active_count)
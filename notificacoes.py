@@ -0,0 +1,325 @@
+# encoding: utf-8
+
+from __future__ import print_function
+
+import os
+import time
+import select
+import socket
+import threading
+from collections import deque, OrderedDict
+
+import metricas
+
+try:
+    import Queue as queue
+except ImportError:  # Python 3
+    import queue
+
+
+# Tamanho máximo da caixa de saída de cada sessão
+OUTBOX_SIZE = 256
+
+# Políticas para quando a caixa de saída de uma sessão está cheia:
+#   DROP_OLDEST -> descarta a notificação mais antiga
+#   COALESCE    -> substitui a notificação pendente de mesma chave (o
+#                  último lance de um mesmo leilão, por exemplo) pela nova;
+#                  sem uma notificação de mesma chave, descarta a mais antiga
+#   DISCONNECT  -> desconecta a sessão, que não está dando conta de ler
+# Pode ser escolhida pela variável de ambiente LEILAO_NOTIFICACAO_POLITICA.
+DROP_OLDEST = 'descarta_antigas'
+COALESCE = 'agrupa'
+DISCONNECT = 'desconecta'
+OVERFLOW_POLICY = os.environ.get('LEILAO_NOTIFICACAO_POLITICA', DROP_OLDEST)
+
+if OVERFLOW_POLICY not in (DROP_OLDEST, COALESCE, DISCONNECT):
+    raise ValueError('Política de caixa cheia desconhecida: %s'
+                     % OVERFLOW_POLICY)
+
+# Número de threads que esvaziam as caixas de saída
+WRITERS = 4
+
+# Janela, em segundos, de agrupamento das notificações de lance de cada
+# leilão (veja Coalescer). Zero desliga o agrupamento: cada lance gera a
+# sua notificação. Pode ser trocada pela variável de ambiente
+# LEILAO_NOTIFICACAO_JANELA.
+COALESCE_WINDOW = float(os.environ.get('LEILAO_NOTIFICACAO_JANELA', 0))
+
+
+class Outbox(object):
+    # Caixa de saída das notificações de uma sessão. notify apenas coloca a
+    # mensagem na fila, sem esperar o envio; as threads de envio (WRITERS)
+    # esvaziam as caixas pelo socket recebedor de cada sessão. Uma sessão é
+    # atendida por uma thread de cada vez, o que mantém a ordem das
+    # mensagens, e um seguidor lento não atrasa quem deu o lance.
+    # As threads de envio nunca esperam por um socket: se o socket
+    # recebedor não aceita mais dados, as mensagens ficam na caixa (onde a
+    # política de caixa cheia continua valendo) e a sessão volta a ser
+    # atendida quando o socket aceitar escrita (veja _wait_loop).
+
+    def __init__(self, user):
+        self.user = user
+        self.queue = deque()  # entradas [chave, texto]
+        self.keys = {}  # chave -> entrada pendente com essa chave
+        self.lock = threading.Lock()
+        self.scheduled = False  # True se está na fila de alguma thread
+        self.closed = False
+
+    def put(self, text, key=None):
+        # Enfileira uma notificação. key identifica notificações que podem
+        # ser agrupadas (veja COALESCE); None nunca é agrupada.
+        disconnect = False
+
+        with self.lock:
+            if self.closed:
+                return
+
+            if len(self.queue) >= OUTBOX_SIZE:
+                entry = self.keys.get(key) if key is not None else None
+
+                if OVERFLOW_POLICY == COALESCE and entry is not None:
+                    entry[1] = text
+                    metricas.count('notificacao.agrupada')
+                    return
+
+                if OVERFLOW_POLICY == DISCONNECT:
+                    self._clear()
+                    self.closed = True
+                    disconnect = True
+                else:
+                    metricas.count('notificacao.descartada')
+                    oldest = self.queue.popleft()
+                    if self.keys.get(oldest[0]) is oldest:
+                        del self.keys[oldest[0]]
+
+            if not disconnect:
+                entry = [key, text]
+                self.queue.append(entry)
+                if key is not None:
+                    self.keys[key] = entry
+
+                if not self.scheduled:
+                    self.scheduled = True
+                    _schedule(self)
+
+        if disconnect:
+            print('[Servidor] Caixa de saída cheia, desconectando:', self.user)
+            metricas.count('notificacao.desconectada')
+            try:
+                self.user.logout()
+            except (ValueError, socket.error):
+                pass  # Sessão já encerrada por outro caminho
+
+    def _clear(self):
+        self.queue.clear()
+        self.keys.clear()
+
+    def close(self):
+        # Descarta as notificações pendentes e recusa as próximas.
+        with self.lock:
+            self.closed = True
+            self._clear()
+
+    def resume(self):
+        # Volta a atender a caixa, se houver notificações guardadas (por
+        # exemplo, quando o socket recebedor é vinculado).
+        with self.lock:
+            if self.closed or self.scheduled or not self.queue:
+                return
+            self.scheduled = True
+            _schedule(self)
+
+    def drain(self):
+        # Envia as notificações pendentes, sem esperar pelo socket.
+        # Executado por uma thread de envio.
+        while True:
+            receiver = self.user.receiver
+
+            with self.lock:
+                if self.closed or receiver is None:
+                    # Sem socket recebedor ainda, as notificações ficam
+                    # guardadas até o vínculo (veja resume).
+                    self.scheduled = False
+                    return
+
+            try:
+                with metricas.timer('notificacao.envio'):
+                    # O que sobrou da última vez sai primeiro; se o socket
+                    # continua cheio, a caixa espera por ele.
+                    if not receiver.flush():
+                        _wait_writable(self, receiver)
+                        return
+
+                    with self.lock:
+                        if self.closed or not self.queue:
+                            self.scheduled = False
+                            return
+
+                        messages = [text for key, text in self.queue]
+                        self._clear()
+
+                    for text in messages:
+                        receiver.write(text)
+            except Exception as e:  # Socket fechado ou com erro
+                print(repr(e))
+                self.close()
+
+
+class Coalescer(object):
+    # Agrupa as notificações de lance por leilão: em vez de uma linha por
+    # lance para cada seguidor, o leilão guarda só a última linha (com o
+    # valor, o autor, o número de seguidores e o número de lances), e a
+    # cada window segundos as linhas pendentes de todos os leilões são
+    # entregues de uma vez. As demais notificações de um leilão (abertura,
+    # fim_leilao) nunca são agrupadas: são entregues na hora, logo depois
+    # da linha pendente do leilão (veja send), o que mantém a ordem.
+    # deliver é a função (leilão, texto, chave, exclude) que entrega uma
+    # notificação aos seguidores.
+
+    def __init__(self, window, deliver):
+        self.window = window
+        self.deliver = deliver
+        self.pending = OrderedDict()  # leilão -> (texto, chave, exclude)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def hold(self, auction_id, text, key=None, exclude=None):
+        # Guarda a notificação de lance como a pendente do leilão, no
+        # lugar da anterior. Cada linha do texto é um lance; só a última
+        # interessa.
+        line = text.splitlines(True)[-1]
+
+        with self.lock:
+            if auction_id in self.pending:
+                metricas.count('notificacao.janela.agrupada')
+            self.pending[auction_id] = (line, key, exclude)
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def send(self, auction_id, text, key=None, exclude=None):
+        # Entrega a notificação na hora, depois da linha pendente do
+        # leilão, se houver.
+        with self.lock:
+            pending = self.pending.pop(auction_id, None)
+            if pending is not None:
+                self.deliver(auction_id, *pending)
+            self.deliver(auction_id, text, key, exclude)
+
+    def _loop(self):
+        # As entregas são feitas com a lock em mãos, para que uma linha
+        # pendente nunca chegue depois de uma notificação enviada por
+        # send; entregar é só enfileirar nas caixas de saída.
+        while True:
+            time.sleep(self.window)
+            with self.lock:
+                pending, self.pending = self.pending, OrderedDict()
+                for auction_id, (text, key, exclude) in pending.items():
+                    self.deliver(auction_id, text, key, exclude)
+
+
+# Fila das caixas de saída com notificações pendentes e threads de envio,
+# iniciadas na primeira notificação.
+_ready = queue.Queue()
+_writers = []
+_writers_lock = threading.Lock()
+
+
+def _schedule(outbox):
+    _ready.put(outbox)
+
+    if not _writers:
+        with _writers_lock:
+            while len(_writers) < WRITERS:
+                t = threading.Thread(target=_writer_loop)
+                t.daemon = True
+                t.start()
+                _writers.append(t)
+
+
+metricas.gauge('notificacao.prontas', _ready.qsize)
+
+
+def _writer_loop():
+    while True:
+        _ready.get().drain()
+
+
+# Caixas de saída cujo socket recebedor está cheio, vigiadas por uma
+# thread até que aceitem escrita. Um pipe acorda a thread quando uma caixa
+# nova entra na espera.
+_waiting = {}  # caixa -> socket recebedor
+_waiting_lock = threading.Lock()
+_wake = []  # [fd de leitura, fd de escrita] do pipe, criado com a thread
+
+
+def _wait_writable(outbox, receiver):
+    # Chamado por drain, com a caixa ainda marcada como agendada.
+    with _waiting_lock:
+        _waiting[outbox] = receiver
+
+        if not _wake:
+            _wake.extend(os.pipe())
+            t = threading.Thread(target=_wait_loop)
+            t.daemon = True
+            t.start()
+
+    os.write(_wake[1], b'.')
+
+
+metricas.gauge('notificacao.esperando', lambda: len(_waiting))
+
+
+def _wait_loop():
+    # Devolve às threads de envio as caixas cujo socket voltou a aceitar
+    # escrita. Um socket com erro (fechado, por exemplo) também volta, e o
+    # erro aparece no envio.
+    while True:
+        with _waiting_lock:
+            waiting = list(_waiting.items())
+
+        by_fd = {}  # descritor -> caixas
+        ready = []
+        for outbox, receiver in waiting:
+            try:
+                by_fd.setdefault(receiver.fileno(), []).append(outbox)
+            except (socket.error, ValueError):  # Socket já fechado
+                ready.append(outbox)
+
+        if not ready:
+            try:
+                readable, writable = _poll(_wake[0], list(by_fd))
+            except (select.error, IOError, OSError, ValueError) as e:
+                print(repr(e))
+                readable, writable = False, list(by_fd)
+
+            if readable:
+                os.read(_wake[0], 4096)
+            for fd in writable:
+                ready.extend(by_fd.get(fd, ()))
+
+        with _waiting_lock:
+            for outbox in ready:
+                _waiting.pop(outbox, None)
+
+        for outbox in ready:
+            _schedule(outbox)
+
+
+def _poll(wake_fd, fds):
+    # Espera o pipe ter dados ou algum dos descritores aceitar escrita.
+    # Retorna (True se o pipe tem dados, descritores prontos).
+    if not hasattr(select, 'poll'):
+        readable, writable, _ = select.select([wake_fd], fds, [])
+        return bool(readable), writable
+
+    poller = select.poll()
+    poller.register(wake_fd, select.POLLIN)
+    for fd in fds:
+        poller.register(fd, select.POLLOUT)
+
+    events = poller.poll()
+    return (any(fd == wake_fd for fd, event in events),
+            [fd for fd, event in events if fd != wake_fd])
@@ -0,0 +1,121 @@
+# encoding: utf-8
+
+from __future__ import print_function
+
+import os
+import time
+import pstats
+import random
+import cProfile
+import threading
+
+import armazenamento
+
+
+# Perfilamento sob demanda dos comandos dos usuários, ligado e desligado
+# com o servidor rodando, pelo comando de administração
+#   perfil,<token>,<opção>,<opção>,...
+# (o token é o mesmo do comando metricas; veja metricas.ADMIN_TOKEN).
+# Opções:
+#   comando=<nome>   perfila todas as execuções do comando <nome>
+#   amostra=<fração> perfila uma fração (de 0 a 1) de todos os comandos
+#   desliga          desliga o perfilamento
+# Cada execução perfilada grava um arquivo do cProfile em DIRECTORY, com o
+# nome <comando>-<instante>-<número>.prof, que pode ser lido com pstats
+# (python -m pstats <arquivo>). O arquivo inclui o trabalho que o comando
+# entregou ao sequenciador (veja sequenciador.py), executado em outra
+# thread. Com o perfilamento desligado, o custo por comando é uma única
+# verificação.
+
+DIRECTORY = os.environ.get(
+    'LEILAO_PERFIL_DIR', os.path.join(armazenamento.DATA_DIR, 'perfis'))
+
+LOCK = threading.Lock()
+
+_commands = set()  # comandos perfilados em todas as execuções
+_fraction = 0.0  # fração de todos os comandos perfilada por amostragem
+_seq = [0]  # número da próxima gravação
+
+# Perfis das tarefas entregues a outras threads durante o comando perfilado
+# pela thread atual (None se a thread não está perfilando).
+_local = threading.local()
+
+
+def configure(options, known):
+    # Aplica as opções do comando de administração (veja acima); known são
+    # os nomes de comando aceitos. Lança ValueError se alguma opção for
+    # inválida.
+    global _fraction
+
+    commands = set(_commands)
+    fraction = _fraction
+
+    for option in options:
+        key, sep, value = option.partition('=')
+
+        if key == 'desliga' and not sep:
+            commands, fraction = set(), 0.0
+        elif key == 'comando' and value in known:
+            commands.add(value)
+        elif key == 'amostra' and 0 <= float(value) <= 1:
+            fraction = float(value)
+        else:
+            raise ValueError(option)
+
+    with LOCK:
+        _commands.clear()
+        _commands.update(commands)
+        _fraction = fraction
+
+
+def run(command, func, *args):
+    # Executa func(*args), perfilando a execução se o comando foi
+    # escolhido ou sorteado.
+    if not _commands and not _fraction:
+        return func(*args)
+
+    if command not in _commands and random.random() >= _fraction:
+        return func(*args)
+
+    profiler = cProfile.Profile()
+    _local.children = children = []
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        _local.children = None
+        _dump(command, profiler, children)
+
+
+def current():
+    # Retorna a lista onde as tarefas entregues a outras threads devem
+    # guardar os seus perfis, ou None se a thread não está perfilando.
+    return getattr(_local, 'children', None)
+
+
+def run_child(children, func, *args):
+    # Executa func(*args) perfilando, e guarda o perfil em children para
+    # ser juntado ao do comando que a originou.
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        children.append(profiler)
+
+
+def _dump(command, profiler, children):
+    with LOCK:
+        _seq[0] += 1
+        n = _seq[0]
+
+    try:
+        if not os.path.isdir(DIRECTORY):
+            os.makedirs(DIRECTORY)
+
+        stats = pstats.Stats(profiler)
+        for child in children:
+            stats.add(child)
+
+        stats.dump_stats(os.path.join(
+            DIRECTORY, '%s-%d-%d.prof' % (command, int(time.time()), n)))
+    except (IOError, OSError) as e:
+        print(repr(e))
@@ -0,0 +1,240 @@
+# encoding: utf-8
+
+from __future__ import print_function
+
+import errno
+import select
+import socket
+import threading
+from collections import deque
+
+
+# Modos de protocolo de uma conexão:
+#   RAW    -> modo original: cada recv(1024) é tratado como um comando
+#             inteiro e cada resposta é enviada como está.
+#   FRAMED -> cada mensagem, nos dois sentidos, é precedida pelo seu tamanho
+#             em bytes (em decimal) e por uma quebra de linha. Por exemplo,
+#             o comando lista_leiloes vira "13\nlista_leiloes". Assim os
+#             comandos podem ser enviados um atrás do outro, sem esperar as
+#             respostas, e podem ter qualquer tamanho.
+#   SINGLE -> sessão num único socket: as respostas e as notificações
+#             (lance, fim_leilao, Leilao aberto) vão pela mesma conexão,
+#             sem o socket recebedor. Os comandos do cliente são enviados
+#             como no modo FRAMED; as mensagens do servidor levam, antes do
+#             tamanho, o seu tipo (REPLY ou PUSH). Por exemplo, a resposta
+#             "ok" vira "r2\nok" e uma notificação de lance vira
+#             "n24\n1,ana,5.000000,2,1\n".
+# Toda conexão começa no modo RAW. O cliente muda de modo com o comando
+# `protocolo,<nome>` (veja MODES), cuja resposta (ok) ainda é enviada no
+# modo RAW. Cada socket (principal e recebedor) escolhe o seu modo; no
+# modo SINGLE, o login já vincula a própria conexão como recebedora.
+RAW = 'raw'
+FRAMED = 'framed'
+SINGLE = 'single'
+
+# Nome de cada modo no comando `protocolo`
+MODES = {
+    'bruto': RAW,
+    'quadros': FRAMED,
+    'unico': SINGLE,
+}
+
+# Tipos das mensagens do servidor no modo SINGLE
+REPLY = 'r'  # resposta a um comando
+PUSH = 'n'  # notificação
+
+# Tamanho máximo de um quadro e do seu cabeçalho
+MAX_FRAME = 1024 * 1024
+MAX_HEADER = len(str(MAX_FRAME)) + 1
+
+# Envio que nunca espera, mesmo num socket sem timeout (veja write)
+DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+
+
+class Connection(object):
+    # Envolve o socket de uma conexão, guardando o modo de protocolo e o
+    # buffer de leitura. Expõe os mesmos métodos do socket usados pelo
+    # servidor (recv, send, close, settimeout, getpeername, fileno), de
+    # modo que pode ser usada no lugar dele.
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.mode = RAW
+        self.buffer = ''
+        self.pending = deque()  # comandos já recebidos e ainda não lidos
+        self.out = deque()  # mensagens emolduradas ainda não enviadas
+        # Com buffered, send também não espera o socket (veja write); usado
+        # pelo laço de eventos, que envia o resto quando o socket aceita.
+        self.buffered = False
+        # No modo SINGLE, respostas e notificações são enviadas por threads
+        # diferentes; a lock impede que duas mensagens se misturem.
+        self.send_lock = threading.Lock()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def getpeername(self):
+        return self.sock.getpeername()
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def close(self):
+        self.sock.close()
+
+    def set_mode(self, mode):
+        # Troca o modo de protocolo da conexão. No modo SINGLE, respostas
+        # e notificações se alternam no mesmo socket; sem TCP_NODELAY, o
+        # algoritmo de Nagle seguraria a resposta que vem logo depois de
+        # uma notificação até a confirmação do cliente (até 40ms). Cada
+        # mensagem já sai numa única escrita.
+        if mode == SINGLE:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.mode = mode
+
+    def feed(self, data):
+        # Acrescenta ao buffer os dados recebidos e retorna a lista dos
+        # comandos completos. No modo RAW, os dados são o comando.
+        if self.mode == RAW:
+            return [data]
+
+        self.buffer += data
+        commands = []
+
+        while True:
+            header_end = self.buffer.find('\n')
+            if header_end < 0:
+                if len(self.buffer) > MAX_HEADER:
+                    raise socket.error('Cabeçalho de quadro inválido')
+                break
+
+            try:
+                size = int(self.buffer[:header_end])
+            except ValueError:
+                raise socket.error('Cabeçalho de quadro inválido')
+
+            if not 0 <= size <= MAX_FRAME:
+                raise socket.error('Quadro grande demais')
+
+            end = header_end + 1 + size
+            if len(self.buffer) < end:
+                break
+
+            commands.append(self.buffer[header_end + 1:end])
+            self.buffer = self.buffer[end:]
+
+        return commands
+
+    def recv(self, bs=1024):
+        # Retorna o próximo comando, lendo do socket quantas vezes forem
+        # necessárias. Retorna '' se o cliente fechou a conexão.
+        while not self.pending:
+            data = self.sock.recv(bs)
+            if not data:
+                return ''
+
+            self.pending.extend(self.feed(data))
+
+        return self.pending.popleft()
+
+    def frame(self, text, kind=REPLY):
+        # Emoldura a mensagem nos modos FRAMED e SINGLE. kind é o tipo da
+        # mensagem no modo SINGLE.
+        if self.mode == FRAMED:
+            return '%d\n%s' % (len(text), text)
+        elif self.mode == SINGLE:
+            return '%s%d\n%s' % (kind, len(text), text)
+        return text
+
+    def send(self, text, kind=REPLY):
+        # Envia a mensagem, esperando o socket aceitá-la por inteiro (a não
+        # ser com buffered). Os dados pendentes de write saem antes.
+        text = self.frame(text, kind)
+
+        with self.send_lock:
+            self.out.append(text)
+            if self.buffered:
+                self._send_some()
+            else:
+                data = ''.join(self.out)
+                self.out.clear()
+                self.sock.sendall(data)
+        return len(text)
+
+    def push(self, text):
+        # Envia uma notificação (no modo SINGLE, um quadro PUSH).
+        return self.send(text, PUSH)
+
+    def write(self, text, kind=PUSH):
+        # Envia a mensagem sem esperar: o que o socket não aceitar na hora
+        # fica em self.out, para flush. Retorna True se tudo foi enviado.
+        with self.send_lock:
+            self.out.append(self.frame(text, kind))
+            return self._send_some()
+
+    def flush(self):
+        # Tenta enviar, sem esperar, os dados pendentes de write. Retorna
+        # True se não sobrou nada.
+        with self.send_lock:
+            return self._send_some()
+
+    def _send_some(self):
+        # Envia as mensagens pendentes enquanto o socket aceitar. Só a
+        # mensagem da vez é cortada, quando o envio sai pela metade.
+        while self.out:
+            if not writable([self.sock], 0):
+                return False
+
+            try:
+                n = self.sock.send(self.out[0], DONTWAIT)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return False
+                raise
+
+            if n < len(self.out[0]):
+                self.out[0] = self.out[0][n:]
+            else:
+                self.out.popleft()
+
+        return True
+
+
+class Pushes(object):
+    # Socket recebedor de uma sessão no modo SINGLE: as notificações vão
+    # pela própria conexão principal, como quadros PUSH. Pode ser usado no
+    # lugar do socket recebedor (veja User.bind_receiver_socket).
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def send(self, text):
+        return self.conn.push(text)
+
+    def write(self, text):
+        return self.conn.write(text, PUSH)
+
+    def flush(self):
+        return self.conn.flush()
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def close(self):
+        self.conn.close()
+
+
+def writable(socks, timeout):
+    # Retorna os sockets (ou objetos com fileno) da lista que aceitam
+    # escrita, esperando no máximo timeout segundos.
+    if not hasattr(select, 'poll'):
+        return select.select([], socks, [], timeout)[1]
+
+    poller = select.poll()
+    by_fd = {}
+    for s in socks:
+        by_fd[s.fileno()] = s
+        poller.register(s, select.POLLOUT)
+
+    return [by_fd[fd] for fd, event in poller.poll(timeout * 1000)
+            if fd in by_fd]
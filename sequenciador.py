@@ -0,0 +1,130 @@
+# encoding: utf-8
+
+from __future__ import print_function
+
+import threading
+from collections import deque
+
+import perfil
+
+try:
+    import Queue as queue
+except ImportError:  # Python 3
+    import queue
+
+
+# Número de threads que executam as filas dos leilões
+WORKERS = 8
+
+# Máximo de tarefas de um mesmo leilão executadas de uma vez por uma
+# thread, antes de a fila voltar para o fim da fila de prontos
+BATCH = 4
+
+
+class Task(object):
+    # Uma tarefa enfileirada no sequenciador, com o seu resultado.
+
+    def __init__(self, func, args, children):
+        self.func = func
+        self.args = args
+        self.children = children  # perfis do comando perfilado (perfil.py)
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            if self.children is None:
+                self.result = self.func(*self.args)
+            else:
+                self.result = perfil.run_child(self.children, self.func,
+                                               *self.args)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done.set()
+
+    def get(self):
+        # Espera a tarefa ser executada e retorna o seu resultado, ou lança
+        # a exceção que ela lançou.
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+
+        return self.result
+
+
+class Sequencer(object):
+    # Sequenciador por leilão. Cada leilão com tarefas pendentes (lances,
+    # abertura, fechamento) tem a sua própria fila, e um conjunto de
+    # threads executa as filas. Uma fila é executada por no máximo uma
+    # thread de cada vez, então as tarefas de um mesmo leilão são aplicadas
+    # em ordem estrita, uma depois da outra, enquanto leilões diferentes
+    # andam em paralelo, sem disputar uma lock global.
+    # As filas são atendidas em rodízio: a thread executa no máximo BATCH
+    # tarefas de um leilão e, se ainda houver tarefas, devolve o leilão
+    # ao fim da fila de prontos. Assim, leilões muito disputados (mais do
+    # que threads) não deixam os outros esperando.
+    # A fila de um leilão só existe enquanto há tarefas nela.
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.queues = {}  # id do leilão -> tarefas pendentes
+        self.lock = threading.Lock()
+        self.ready = queue.Queue()  # leilões com fila a ser executada
+        self.threads = []
+
+    def submit(self, key, func, *args, **kwargs):
+        # Enfileira func(*args) na fila do leilão key. Com wait=True (o
+        # padrão), espera a tarefa ser executada e retorna o seu resultado,
+        # ou lança a exceção que ela lançou. Com wait=False, retorna a
+        # tarefa (veja Task.get).
+        task = Task(func, args, perfil.current())
+
+        with self.lock:
+            pending = self.queues.get(key)
+            if pending is None:
+                self.queues[key] = deque([task])
+                self.ready.put(key)
+            else:
+                pending.append(task)
+
+            if not self.threads:
+                self._start()
+
+        if not kwargs.get('wait', True):
+            return task
+
+        return task.get()
+
+    def _start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def _worker(self):
+        while True:
+            key = self.ready.get()
+
+            for i in range(BATCH):
+                with self.lock:
+                    pending = self.queues[key]
+                    if not pending:
+                        break
+
+                    task = pending.popleft()
+
+                task.run()
+
+            # A fila continua em self.queues enquanto a thread a executa,
+            # de modo que submit não a coloca duas vezes entre as prontas.
+            with self.lock:
+                if self.queues[key]:
+                    self.ready.put(key)
+                else:
+                    del self.queues[key]
+
+
+SEQUENCER = Sequencer(WORKERS)
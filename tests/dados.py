@@ -0,0 +1,19 @@
+# encoding: utf-8
+
+# Preparo comum aos testes que usam os módulos do servidor: eles ficam no
+# caminho de importação e gravam os seus arquivos num diretório temporário,
+# e não no diretório do repositório. Precisa ser importado antes deles.
+
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+if not os.environ.get('LEILAO_DADOS'):
+    DIRECTORY = os.environ['LEILAO_DADOS'] = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, DIRECTORY, True)
+else:
+    DIRECTORY = os.environ['LEILAO_DADOS']
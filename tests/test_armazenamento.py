@@ -0,0 +1,125 @@
+# encoding: utf-8
+
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import dados
+
+import armazenamento
+
+
+def record(id, value):
+    return {'id': id, 'user_id': 1, 'auction_id': 2, 'value': value}
+
+
+class StorageContract(object):
+    # Comportamento comum a todos os backends (veja armazenamento.Storage).
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(dir=dados.DIRECTORY)
+        self.storages = []
+
+    def tearDown(self):
+        for storage in self.storages:
+            storage.close()
+        shutil.rmtree(self.directory, True)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def reopen(self):
+        storage = self.open()
+        self.storages.append(storage)
+        return storage
+
+    def test_vazio(self):
+        self.assertEqual(self.reopen().load(), [])
+
+    def test_grava_altera_e_apaga(self):
+        storage = self.reopen()
+        storage.load()
+        storage.commit([record(2, 1.0), record(1, 2.0), record(3, 3.0)])
+        storage.commit([record(2, 5.0)], [3])
+        storage.commit(deleted=[42])  # id inexistente é ignorado
+
+        self.assertEqual(self.reopen().load(), [record(1, 2.0),
+                                                record(2, 5.0)])
+
+
+class JsonStorageTest(StorageContract, unittest.TestCase):
+
+    def open(self):
+        return armazenamento.JsonStorage(self.path('lances.json'))
+
+
+class JournalStorageTest(StorageContract, unittest.TestCase):
+
+    def open(self):
+        return armazenamento.JournalStorage(self.path('lances.json'),
+                                            self.path('lances.jsonl'))
+
+    def test_linha_incompleta(self):
+        # Uma escrita interrompida no meio deixa a última linha pela
+        # metade: ela é ignorada, e o próximo commit começa uma linha nova.
+        storage = self.reopen()
+        storage.load()
+        storage.commit([record(1, 1.0)])
+        with open(self.path('lances.jsonl'), 'a') as f:
+            f.write('{"id": 2, "val')
+
+        storage = self.reopen()
+        self.assertEqual(storage.load(), [record(1, 1.0)])
+        storage.commit([record(3, 3.0)])
+
+        self.assertEqual(self.reopen().load(), [record(1, 1.0),
+                                                record(3, 3.0)])
+
+    def test_compactacao(self):
+        storage = self.reopen()
+        storage.load()
+        for i in range(armazenamento.COMPACT_LINES):
+            storage.commit([record(1, float(i))])
+        storage.commit([record(2, 2.0)], [1])
+        self.assertTrue(storage.needs_compaction())
+
+        storage.compact(lambda: [record(2, 2.0)])
+
+        self.assertFalse(storage.needs_compaction())
+        self.assertEqual(os.path.getsize(self.path('lances.jsonl')), 0)
+        storage.commit([record(3, 3.0)])
+        self.assertEqual(self.reopen().load(), [record(2, 2.0),
+                                                record(3, 3.0)])
+
+
+class SqliteStorageTest(StorageContract, unittest.TestCase):
+
+    def open(self):
+        return armazenamento.SqliteStorage(self.path('leilao.db'), 'lances')
+
+    def test_importa_os_arquivos_json(self):
+        # Na primeira vez, a tabela vazia recebe os registros do json.
+        json_storage = armazenamento.JournalStorage(self.path('lances.json'),
+                                                    self.path('lances.jsonl'))
+        json_storage.commit([record(1, 1.0), record(2, 2.0)], [1])
+        json_storage.close()
+
+        backend = armazenamento.BACKEND
+        armazenamento.BACKEND = 'sqlite'
+        try:
+            storage = armazenamento.open_storage(
+                'lances', self.path('lances.json'), self.path('lances.jsonl'),
+                self.path('leilao.db'))
+            self.storages.append(storage)
+        finally:
+            armazenamento.BACKEND = backend
+
+        self.assertEqual(storage.load(), [record(2, 2.0)])
+        self.assertEqual(self.reopen().load(), [record(2, 2.0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
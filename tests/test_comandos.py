@@ -0,0 +1,74 @@
+# encoding: utf-8
+
+from __future__ import print_function
+
+import unittest
+
+import dados
+
+import comandos
+import leiloes
+import sequenciador
+from lances import Bid
+from leiloes import Auction
+from usuarios import User
+
+
+class BatchBidTest(unittest.TestCase):
+
+    def setUp(self):
+        # Guarda as notificações publicadas, em vez de enviá-las.
+        self.published = []
+        self.publish = User.publish
+        User.publish = classmethod(
+            lambda cls, auction_id, text, *args:
+                self.published.append((auction_id, text)))
+
+        User.ensure(1, 'ana')
+        User.ensure(2, 'bia')
+        self.user = User.load(2)
+
+        self.auctions = []
+        for i in range(2):
+            a = Auction.new(1, 'bola', 'de futebol', 2.0, 1, 1, 2000, 0, 0,
+                            0, 60)
+            sequenciador.SEQUENCER.submit(a.id, leiloes._open, a.id)
+            self.auctions.append(a)
+            self.user.seguindo.add(a.id)
+
+    def tearDown(self):
+        User.publish = self.publish
+        for a in self.auctions:
+            leiloes.SCHEDULER.cancel(a.id)
+
+    def test_uma_resposta_por_lance(self):
+        a, b = self.auctions
+        answer = comandos.enviar_lances(
+            self.user, 'enviar_lances,%d,3,%d,4,%d,1,-1,5,%d,6' % (
+                a.id, b.id, a.id, a.id))
+
+        self.assertEqual(answer.split('\n'), [
+            '%d,ok' % a.id, '%d,ok' % b.id, '%d,not_ok' % a.id, '-1,not_ok',
+            '%d,ok' % a.id, 'ok'])
+
+        self.assertEqual([r[2] for r in Bid.rows_by_auction(a.id)], [3.0, 6.0])
+        self.assertEqual((a.bid_count, a.high_value, a.leader_id), (2, 6.0, 2))
+
+        # Uma única notificação por leilão, com uma linha por lance
+        self.assertEqual(sorted((id, text.count('\n'))
+                                for id, text in self.published
+                                if not text.startswith('Leilao aberto')),
+                         sorted([(a.id, 2), (b.id, 1)]))
+
+    def test_lote_malformado(self):
+        a = self.auctions[0]
+        for data in ('enviar_lances', 'enviar_lances,%d' % a.id,
+                     'enviar_lances,%d,3,%d,x' % (a.id, a.id)):
+            self.assertRaises(Exception, comandos.enviar_lances, self.user,
+                              data)
+
+        self.assertEqual(Bid.rows_by_auction(a.id), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
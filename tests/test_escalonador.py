@@ -0,0 +1,91 @@
+# encoding: utf-8
+
+from __future__ import print_function
+
+import time
+import unittest
+
+import dados
+
+import comandos
+import leiloes
+import sequenciador
+from leiloes import Auction
+from usuarios import User
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        # Guarda as mensagens publicadas aos seguidores, em vez de enviá-las.
+        self.published = []
+        self.publish = User.publish
+        User.publish = classmethod(
+            lambda cls, auction_id, text, *args: self.published.append(text))
+
+        User.ensure(1, 'ana')
+        self.user = User.load(1)
+
+    def tearDown(self):
+        User.publish = self.publish
+
+    def auction(self, max_timeout):
+        # Cria um leilão já aberto, seguido pela sessão do teste.
+        a = Auction.new(1, 'bola', 'de futebol', 1.0, 1, 1, 2000, 0, 0, 0,
+                        max_timeout)
+        sequenciador.SEQUENCER.submit(a.id, leiloes._open, a.id)
+        self.user.seguindo.add(a.id)
+        return a
+
+    def finished(self):
+        return [text for text in self.published
+                if text.startswith('fim_leilao')]
+
+    def wait_closed(self, a, timeout=5):
+        limit = time.time() + timeout
+        while not a.closed and time.time() < limit:
+            time.sleep(0.05)
+        time.sleep(0.3)  # tempo para um eventual fechamento repetido
+
+    def test_fecha_sem_lances(self):
+        a = self.auction(0.3)
+        self.wait_closed(a)
+
+        self.assertTrue(a.closed)
+        self.assertFalse(a.open)
+        self.assertEqual(self.finished(), [])
+
+    def test_lance_na_fila_antes_do_fechamento(self):
+        # Um lance que chega pouco antes do prazo e fica na fila do leilão
+        # à frente do fechamento adia o prazo: o evento de fechamento que
+        # já estava na fila é ignorado, e o leilão fecha uma única vez,
+        # max_timeout segundos depois do lance.
+        a = self.auction(0.5)
+
+        delay = a.deadline() - time.time() + 0.2
+        sequenciador.SEQUENCER.submit(a.id, time.sleep, delay, wait=False)
+        bid = sequenciador.SEQUENCER.submit(
+            a.id, comandos._registra_lance, self.user, a.id, 5.0, wait=False)
+
+        bid.get()
+        self.assertTrue(a.open)
+
+        self.wait_closed(a)
+
+        self.assertTrue(a.closed)
+        self.assertEqual(self.finished(), ['fim_leilao,%d,5.00,ana' % a.id])
+
+    def test_abertura_repetida_e_ignorada(self):
+        a = self.auction(60)
+        open_time = a.open_time
+
+        sequenciador.SEQUENCER.submit(a.id, leiloes._open, a.id)
+
+        self.assertEqual(a.open_time, open_time)
+        self.assertEqual(len([text for text in self.published
+                              if text.startswith('Leilao aberto')]), 1)
+        leiloes.SCHEDULER.cancel(a.id)
+
+
+if __name__ == '__main__':
+    unittest.main()
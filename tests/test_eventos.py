@@ -0,0 +1,92 @@
+# encoding: utf-8
+
+from __future__ import print_function
+
+import time
+import socket
+import threading
+import unittest
+
+import dados
+
+import comandos
+import main
+
+
+def client(port, name):
+    # Cliente no modo com quadros, já com o usuário registrado.
+    s = socket.create_connection(('127.0.0.1', port))
+    s.settimeout(5)
+    s.recv(1024)
+    s.send(b'protocolo,quadros')
+    assert s.recv(1024) == b'ok'
+    send(s, 'adiciona_usuario,%s,1,rua,e,senha' % name)
+    assert replies(s, 1) == ['ok']
+    return s
+
+
+def send(s, *commands):
+    s.sendall(''.join('%d\n%s' % (len(c), c) for c in commands).encode())
+
+
+def replies(s, count):
+    buf = b''
+    answers = []
+    while len(answers) < count:
+        buf += s.recv(4096)
+        while b'\n' in buf:
+            size, rest = buf.split(b'\n', 1)
+            if len(rest) < int(size):
+                break
+            answers.append(rest[:int(size)].decode())
+            buf = rest[int(size):]
+    return answers
+
+
+class EventLoopTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(main.BACKLOG)
+        cls.port = server.getsockname()[1]
+
+        t = threading.Thread(target=main.serve_events, args=(server,))
+        t.daemon = True
+        t.start()
+
+    def setUp(self):
+        # sair_leilao passa a demorar, como um lance esperando a fila de
+        # um leilão ocupado ou um fragmento lento.
+        self.handler = comandos.client_functions['sair_leilao']
+        comandos.client_functions['sair_leilao'] = (
+            lambda user, data: time.sleep(1) or True)
+
+    def tearDown(self):
+        comandos.client_functions['sair_leilao'] = self.handler
+
+    def test_comando_lento_nao_trava_as_outras_conexoes(self):
+        slow = client(self.port, 'lento')
+        fast = client(self.port, 'rapido')
+
+        send(slow, 'sair_leilao,1')
+        time.sleep(0.1)
+
+        start = time.time()
+        send(fast, 'lista_leiloes')
+        self.assertEqual(replies(fast, 1)[0].split('\n')[-1], 'ok')
+        self.assertLess(time.time() - start, 0.5)
+
+        self.assertEqual(replies(slow, 1), ['ok'])
+
+    def test_comandos_de_uma_conexao_em_ordem(self):
+        s = client(self.port, 'ordem')
+
+        send(s, 'sair_leilao,1', 'protocolo,x', 'sair_leilao,1')
+
+        self.assertEqual(replies(s, 3), ['ok', 'not_ok', 'ok'])
+
+
+if __name__ == '__main__':
+    unittest.main()
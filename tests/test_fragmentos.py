@@ -0,0 +1,167 @@
+# encoding: utf-8
+
+from __future__ import print_function
+
+import os
+import time
+import socket
+import tempfile
+import unittest
+from datetime import datetime
+
+import dados
+
+import comandos
+import armazenamento
+import fragmentos
+import lances
+import leiloes
+import usuarios
+from leiloes import Auction
+from usuarios import User
+
+
+def session(name):
+    # Registra o usuário e abre uma sessão logada com um socket de verdade
+    # (a sessão guarda a porta remota dele).
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    client = socket.create_connection(server.getsockname())
+    conn, addr = server.accept()
+    server.close()
+    user = User.signup(conn, name, '1', 'rua', 'e', 'senha')
+    user.client = client
+    return user
+
+
+def bids(shard, auction_id):
+    # Lances do leilão gravados no diretório do fragmento.
+    store = lances.open_store(shard.directory)
+    try:
+        store.load()
+        return [b['value'] for b in store.filter_by_auction(auction_id)]
+    finally:
+        store.close()
+
+
+class RouterTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # Um diretório de dados com leilões e lances do modo com um só
+        # processo, migrados para dois fragmentos na inicialização.
+        cls.directory = tempfile.mkdtemp(dir=dados.DIRECTORY)
+
+        User.ensure(1, 'ana')
+        now = time.time()
+        start_date = list(datetime.now().timetuple()[:6])
+        auctions = [Auction(id, 1, 'item%d' % id, 'd', 2.0, start_date, 600,
+                            open=True, open_time=now).to_dict()
+                    for id in range(1, 7)]
+
+        storage = leiloes.open_storage(cls.directory)
+        storage.load()
+        storage.commit(auctions)
+
+        store = lances.open_store(cls.directory)
+        store.load()
+        store.create(1, 3, 4.0, start_date)
+
+        saved = (armazenamento.DATA_DIR, leiloes.STORAGE, lances.STORE)
+        armazenamento.DATA_DIR = cls.directory
+        leiloes.STORAGE, lances.STORE = storage, store
+        try:
+            cls.router = fragmentos.Router(2)
+            cls.router.start()
+        finally:
+            armazenamento.DATA_DIR, leiloes.STORAGE, lances.STORE = saved
+
+        cls.storage, cls.store = storage, store
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.router.stop()
+        usuarios.FOLLOWED_BY = None
+        cls.storage.close()
+        cls.store.close()
+
+    def test_migracao(self):
+        # Os registros saem do diretório do servidor e cada leilão vai
+        # para o fragmento id % 2, com os seus lances.
+        self.assertEqual(self.storage.load(), [])
+        self.assertEqual(self.store.all(), [])
+
+        for shard in self.router.shards:
+            listing = shard.call('lista', 'lista_leiloes').split('\n')[:-1]
+            self.assertEqual([int(line.split(',')[0]) for line in listing],
+                             [id for id in range(1, 7)
+                              if id % 2 == shard.index])
+
+        self.assertEqual(bids(self.router.owner(3), 3), [4.0])
+
+        listing = self.router.lista_leiloes(None, 'lista_leiloes,limite=3')
+        self.assertEqual([line.split(',')[0] for line in listing.split('\n')],
+                         ['1', '2', '3', 'cursor', 'ok'])
+
+    def test_lote_de_lances(self):
+        user = User.load(1)
+        user.seguindo = set([1, 2])
+
+        answer = self.router.enviar_lances(
+            user, 'enviar_lances,1,5,2,6,99,7,2,1,1,8')
+
+        self.assertEqual(answer.split('\n'), ['1,ok', '2,ok', '99,not_ok',
+                                              '2,not_ok', '1,ok', 'ok'])
+        self.assertEqual(bids(self.router.owner(1), 1), [5.0, 8.0])
+        self.assertEqual(bids(self.router.owner(2), 2), [6.0])
+
+    def test_lote_malformado_nao_aplica_nada(self):
+        user = User.load(1)
+        user.seguindo = set([4])
+
+        self.assertRaises(ValueError, self.router.enviar_lances, user,
+                          'enviar_lances,4,5,4,x')
+        self.assertEqual(bids(self.router.owner(4), 4), [])
+
+    def test_fragmento_com_falha(self):
+        # Só os lances do fragmento que falhou são recusados.
+        user = User.load(1)
+        user.seguindo = set([5, 6])
+        shard = self.router.owner(6)
+
+        def send(request):
+            raise IOError('fragmento fora do ar')
+
+        shard.send = send
+        try:
+            answer = self.router.enviar_lances(user,
+                                               'enviar_lances,6,9,5,9')
+        finally:
+            del shard.send
+
+        self.assertEqual(answer.split('\n'), ['6,not_ok', '5,ok', 'ok'])
+        self.assertEqual(bids(shard, 6), [])
+
+    def test_apagar_usuario_esquece_os_seguidores(self):
+        seller = session('carla')
+        follower = session('davi')
+
+        self.router.lanca_produto(
+            seller, 'lanca_produto,vaso,azul,1.0,1,1,2030,0,0,0,60')
+        listing = self.router.lista_leiloes(None, 'lista_leiloes').split('\n')
+        auction_id = [int(line.split(',')[0]) for line in listing
+                      if line.endswith(',carla')][0]
+
+        self.router.entrar_leilao(follower, 'entrar_leilao,%d' % auction_id)
+        self.assertIn(auction_id, follower.seguindo)
+
+        self.router.apaga_usuario(seller, 'apaga_usuario,carla,senha')
+
+        self.assertNotIn(auction_id, follower.seguindo)
+        self.assertNotIn(auction_id, User._seguidores)
+        follower.logout()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+# encoding: utf-8
+
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import dados
+
+import armazenamento
+import binario
+import lances
+
+DATE = [2030, 1, 2, 3, 4, 5]
+
+
+def summary(records):
+    return [(b['id'], b['user_id'], b['auction_id'], b['value'])
+            for b in records]
+
+
+class BidStoreContract(object):
+    # Comportamento comum aos repositórios de lances.
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(dir=dados.DIRECTORY)
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        shutil.rmtree(self.directory, True)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def reopen(self):
+        store = self.open()
+        store.load()
+        self.stores.append(store)
+        return store
+
+    def test_indices_e_releitura(self):
+        store = self.reopen()
+        store.create(1, 10, 2.0, DATE)
+        store.create(2, 10, 3.0, DATE)
+        store.create(1, 20, 4.0, DATE)
+
+        for store in (store, self.reopen()):
+            self.assertEqual(summary(store.all()), [(1, 1, 10, 2.0),
+                                                    (2, 2, 10, 3.0),
+                                                    (3, 1, 20, 4.0)])
+            self.assertEqual([b['id'] for b in store.filter_by_user(1)],
+                             [1, 3])
+            self.assertEqual([r[:3] for r in store.rows_by_auction(10)],
+                             [(1, 1, 2.0), (2, 2, 3.0)])
+            self.assertEqual(store.get(4), None)
+
+        self.assertEqual(store.create(3, 20, 5.0, DATE)['id'], 4)
+
+    def test_apaga(self):
+        store = self.reopen()
+        for i in range(3):
+            store.create(1, 10, float(i), DATE)
+
+        store.delete_many([1, 3])
+        store.delete_many([3, 7])  # já apagado ou inexistente
+
+        for store in (store, self.reopen()):
+            self.assertEqual(summary(store.all()), [(2, 1, 10, 1.0)])
+            self.assertEqual([b['id'] for b in store.filter_by_auction(10)],
+                             [2])
+
+
+class JournalBidStoreTest(BidStoreContract, unittest.TestCase):
+
+    def open(self):
+        return lances.BidStore(armazenamento.JournalStorage(
+            self.path('lances.json'), self.path('lances.jsonl')))
+
+
+class BinaryBidStoreTest(BidStoreContract, unittest.TestCase):
+
+    def open(self):
+        return lances.BinaryBidStore(self.path('lances.bin'))
+
+    def test_converte_do_json(self):
+        storage = armazenamento.JournalStorage(self.path('lances.json'),
+                                               self.path('lances.jsonl'))
+        storage.commit([{'id': id, 'user_id': 1, 'auction_id': 10,
+                         'value': float(id), 'bid_date': DATE}
+                        for id in (1, 2, 3)], [2])
+        storage.close()
+
+        self.assertEqual(binario.from_json(self.path('lances.json'),
+                                           self.path('lances.jsonl'),
+                                           self.path('lances.bin')), 2)
+        self.assertEqual(summary(self.reopen().all()), [(1, 1, 10, 1.0),
+                                                        (3, 1, 10, 3.0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+# encoding: utf-8
+
+from __future__ import print_function
+
+import time
+import unittest
+
+import dados
+
+import comandos
+import leiloes
+import sequenciador
+from lances import Bid
+from leiloes import Auction
+from usuarios import User
+
+
+class AuctionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.publish = User.publish
+        User.publish = classmethod(lambda cls, *args: None)
+
+        User.ensure(1, 'ana')
+        User.ensure(2, 'bia')
+
+    def tearDown(self):
+        User.publish = self.publish
+
+    def auction(self):
+        a = Auction.new(1, 'bola', 'de futebol', 1.0, 1, 1, 2000, 0, 0, 0, 60)
+        sequenciador.SEQUENCER.submit(a.id, leiloes._open, a.id)
+        return a
+
+    def bid(self, user_id, auction_id, value, wait=True):
+        user = User.load(user_id)
+        user.seguindo.add(auction_id)
+        return sequenciador.SEQUENCER.submit(
+            auction_id, comandos._registra_lance, user, auction_id, value,
+            wait=wait)
+
+    def test_lances_na_fila_sao_apagados_com_o_leilao(self):
+        # Um lance que estava na fila antes da deleção entra e é apagado
+        # junto com o leilão; um lance que chega depois é recusado.
+        a = self.auction()
+        self.bid(2, a.id, 3.0)
+
+        sequenciador.SEQUENCER.submit(a.id, time.sleep, 0.2, wait=False)
+        queued = self.bid(2, a.id, 4.0, wait=False)
+        Auction.delete_many([a])
+        late = self.bid(2, a.id, 5.0, wait=False)
+
+        self.assertTrue(queued.get())
+        self.assertRaises(Exception, late.get)
+        self.assertEqual(Bid.rows_by_auction(a.id), [])
+        self.assertRaises(Exception, Auction.load, a.id)
+
+    def test_recalcula_os_agregados_depois_de_apagar_lances(self):
+        a = self.auction()
+        self.bid(1, a.id, 3.0)
+        self.bid(2, a.id, 5.0)
+
+        bid = Bid.filter_by_user(2)[-1]
+        Bid.delete_many([bid.id])
+        Auction.recompute([a.id, -1])
+
+        self.assertEqual((a.bid_count, a.high_value, a.leader_id), (1, 3.0, 1))
+        leiloes.SCHEDULER.cancel(a.id)
+
+    def test_listagem_com_limite(self):
+        ids = [Auction.new(1, 'item', 'd', 1.0, 1, 1, 2030, 0, 0, 0, 60).id
+               for i in range(3)]
+        cursor = ids[0] - 1
+
+        answer = comandos.lista_leiloes(
+            None, 'lista_leiloes,vendedor=ana,cursor=%d,limite=2' % cursor)
+        self.assertEqual([line.split(',')[0] for line in answer.split('\n')],
+                         [str(ids[0]), str(ids[1]), 'cursor', 'ok'])
+
+        for limit in ('0', '-1', 'x'):
+            self.assertRaises(Exception, comandos.lista_leiloes, None,
+                              'lista_leiloes,limite=' + limit)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+# encoding: utf-8
+
+from __future__ import print_function
+
+import threading
+import unittest
+
+import dados
+
+import metricas
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_soma_as_metricas_de_todas_as_threads(self):
+        # Contadores e histogramas de threads diferentes (inclusive das que
+        # já terminaram) aparecem somados na leitura.
+        lock = metricas.TimedLock(threading.Lock(), 'teste.lock')
+
+        def work():
+            for i in range(1000):
+                metricas.count('teste.contador')
+                with lock:
+                    pass
+
+        for rounds in range(3):
+            threads = [threading.Thread(target=work) for i in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        snapshot = metricas.snapshot()
+        self.assertEqual(snapshot['contadores']['teste.contador'], 24000)
+        self.assertEqual(snapshot['histogramas']['teste.lock.espera']['n'],
+                         24000)
+
+    def test_recolhe_as_threads_encerradas(self):
+        # As métricas das threads encerradas não ficam acumuladas no
+        # registro, uma entrada por thread.
+        for i in range(50):
+            t = threading.Thread(target=metricas.count,
+                                 args=('teste.encerradas',))
+            t.start()
+            t.join()
+
+        metricas.count('teste.encerradas')
+        # Só as threads vivas (inclusive as dos outros testes) têm entrada
+        self.assertLessEqual(len(metricas._threads), threading.active_count())
+        self.assertEqual(
+            metricas.snapshot()['contadores']['teste.encerradas'], 51)
+
+
+if __name__ == '__main__':
+    unittest.main()
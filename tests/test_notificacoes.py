@@ -0,0 +1,100 @@
+# encoding: utf-8
+
+from __future__ import print_function
+
+import time
+import socket
+import unittest
+
+import dados
+
+import protocolo
+import notificacoes
+
+
+class FakeUser(object):
+
+    def __init__(self):
+        self.receiver = None
+        self.logouts = 0
+        self.outbox = notificacoes.Outbox(self)
+
+    def logout(self):
+        self.logouts += 1
+
+
+def receiver():
+    # Par de sockets: o lado do servidor (emoldurado) e o do cliente.
+    server, client = socket.socketpair()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    server.settimeout(600)
+    conn = protocolo.Connection(server)
+    conn.mode = protocolo.FRAMED
+    return conn, client
+
+
+def read_until(sock, text, timeout=5):
+    sock.settimeout(0.1)
+    data = ''
+    deadline = time.time() + timeout
+    while text not in data and time.time() < deadline:
+        try:
+            data += sock.recv(65536).decode('latin-1')
+        except socket.timeout:
+            pass
+    return data
+
+
+class OutboxTest(unittest.TestCase):
+
+    def test_guarda_notificacoes_ate_o_vinculo(self):
+        # Sem socket recebedor, as notificações esperam na caixa.
+        user = FakeUser()
+        user.outbox.put('a')
+        user.outbox.put('b')
+        time.sleep(0.1)
+
+        conn, client = receiver()
+        user.receiver = conn
+        user.outbox.resume()
+        self.assertIn('1\na1\nb', read_until(client, '1\nb'))
+
+    def test_seguidor_parado_nao_trava_os_outros(self):
+        # Sessões que nunca leem o socket recebedor não prendem as
+        # threads de envio.
+        stalled = []
+        for i in range(notificacoes.WRITERS * 2):
+            user = FakeUser()
+            user.receiver, client = receiver()
+            stalled.append((user, client))
+            for j in range(50):
+                user.outbox.put('x' * 100000)
+
+        healthy = FakeUser()
+        healthy.receiver, client = receiver()
+        time.sleep(0.2)
+        healthy.outbox.put('ok')
+        try:
+            self.assertIn('2\nok', read_until(client, '2\nok'))
+        finally:
+            for user, client in stalled:
+                user.outbox.close()
+
+    def test_desconecta_sem_socket_recebedor(self):
+        # Com a política DISCONNECT, a caixa cheia encerra a sessão mesmo
+        # antes do vínculo do socket recebedor.
+        policy = notificacoes.OVERFLOW_POLICY
+        notificacoes.OVERFLOW_POLICY = notificacoes.DISCONNECT
+        try:
+            user = FakeUser()
+            for i in range(notificacoes.OUTBOX_SIZE + 1):
+                user.outbox.put(str(i))
+            self.assertEqual(user.logouts, 1)
+            self.assertTrue(user.outbox.closed)
+        finally:
+            notificacoes.OVERFLOW_POLICY = policy
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+# encoding: utf-8
+
+from __future__ import print_function
+
+import socket
+import threading
+import unittest
+from datetime import datetime, timedelta
+
+import dados
+
+import main
+import protocolo
+
+
+def pair(mode):
+    # Par de sockets: o lado do servidor, numa Connection, e o do cliente.
+    server, client = socket.socketpair()
+    client.settimeout(5)
+    conn = protocolo.Connection(server)
+    conn.mode = mode
+    return conn, client
+
+
+def read(sock, size):
+    data = ''
+    while len(data) < size:
+        data += sock.recv(size - len(data))
+    return data
+
+
+class FramedTest(unittest.TestCase):
+
+    def test_comandos_em_sequencia_e_cortados(self):
+        # Vários quadros num mesmo pedaço, e um quadro dividido em pedaços.
+        conn, client = pair(protocolo.FRAMED)
+
+        self.assertEqual(conn.feed('5\najuda13\nlista_leiloes0\n1'),
+                         ['ajuda', 'lista_leiloes', ''])
+        self.assertEqual(conn.feed('6\nenvia'), [])
+        self.assertEqual(conn.feed('r_lance,1,5'), ['enviar_lance,1,5'])
+
+    def test_quadro_invalido(self):
+        conn, client = pair(protocolo.FRAMED)
+        self.assertRaises(socket.error, conn.feed, 'x\najuda')
+
+        conn, client = pair(protocolo.FRAMED)
+        self.assertRaises(socket.error, conn.feed,
+                          '%d\n' % (protocolo.MAX_FRAME + 1))
+
+        conn, client = pair(protocolo.FRAMED)
+        self.assertRaises(socket.error, conn.feed,
+                          '1' * (protocolo.MAX_HEADER + 1))
+
+    def test_modo_bruto(self):
+        conn, client = pair(protocolo.RAW)
+        self.assertEqual(conn.feed('5\najuda'), ['5\najuda'])
+
+        conn.send('ok')
+        self.assertEqual(client.recv(1024), 'ok')
+
+    def test_recv_e_send(self):
+        conn, client = pair(protocolo.FRAMED)
+
+        client.sendall('5\najuda2\nok')
+        self.assertEqual(conn.recv(), 'ajuda')
+        self.assertEqual(conn.recv(), 'ok')
+
+        conn.send('lista\ncom quebra')
+        self.assertEqual(read(client, 19), '16\nlista\ncom quebra')
+
+        client.close()
+        self.assertEqual(conn.recv(), '')
+
+    def test_envio_sem_espera(self):
+        # Com buffered, o que o socket não aceita fica na conexão, em
+        # ordem, até o flush.
+        conn, client = pair(protocolo.FRAMED)
+        conn.buffered = True
+        conn.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+
+        text = 'x' * 100000
+        conn.send(text)
+        conn.send('ok')
+        self.assertTrue(conn.out)
+
+        data = ''
+        while not data.endswith('2\nok'):
+            data += client.recv(65536)
+            conn.flush()
+
+        self.assertEqual(data, '100000\n' + text + '2\nok')
+        self.assertFalse(conn.out)
+
+
+class SingleClient(object):
+    # Cliente de uma sessão no modo SINGLE, já com o usuário registrado.
+
+    def __init__(self, port, name):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.settimeout(5)
+        self.sock.recv(1024)
+        self.sock.send('protocolo,unico')
+        assert self.sock.recv(1024) == 'ok'
+        self.buffer = ''
+        self.pushes = []
+        assert self.command('adiciona_usuario,%s,1,rua,e,senha' % name) == 'ok'
+
+    def message(self):
+        # Próxima mensagem do servidor: (tipo, texto).
+        while True:
+            header_end = self.buffer.find('\n')
+            if header_end > 0:
+                end = header_end + 1 + int(self.buffer[1:header_end])
+                if len(self.buffer) >= end:
+                    kind = self.buffer[0]
+                    text = self.buffer[header_end + 1:end]
+                    self.buffer = self.buffer[end:]
+                    return kind, text
+            self.buffer += self.sock.recv(4096)
+
+    def command(self, text):
+        # Envia o comando e retorna a resposta; as notificações recebidas
+        # no caminho ficam guardadas.
+        self.sock.sendall('%d\n%s' % (len(text), text))
+        while True:
+            kind, text = self.message()
+            if kind == protocolo.REPLY:
+                return text
+            self.pushes.append(text)
+
+    def push(self):
+        if self.pushes:
+            return self.pushes.pop(0)
+        kind, text = self.message()
+        assert kind == protocolo.PUSH, (kind, text)
+        return text
+
+
+class SingleTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(main.BACKLOG)
+        cls.port = server.getsockname()[1]
+
+        t = threading.Thread(target=main.serve_events, args=(server,))
+        t.daemon = True
+        t.start()
+
+    def test_tipos_das_mensagens(self):
+        conn, client = pair(protocolo.SINGLE)
+        pushes = protocolo.Pushes(conn)
+
+        conn.send('ok')
+        pushes.send('1,ana,5.000000,2,1\n')
+        self.assertEqual(read(client, 28), 'r2\nokn19\n1,ana,5.000000,2,1\n')
+
+    def test_sessao_num_unico_socket(self):
+        # Respostas e notificações chegam pela mesma conexão, sem o socket
+        # recebedor.
+        seller = SingleClient(self.port, 'vendedor')
+        buyer = SingleClient(self.port, 'comprador')
+
+        start = datetime.now() + timedelta(seconds=2)
+        self.assertEqual(seller.command(
+            'lanca_produto,vaso,azul,1.0,%d,%d,%d,%d,%d,%d,1' % (
+                start.day, start.month, start.year, start.hour,
+                start.minute, start.second)), 'ok')
+
+        listing = seller.command('lista_leiloes,vendedor=vendedor')
+        auction_id = int(listing.split(',')[0])
+
+        for client in (seller, buyer):
+            self.assertEqual(
+                client.command('entrar_leilao,%d' % auction_id), 'ok')
+        for client in (seller, buyer):
+            self.assertTrue(client.push().startswith('Leilao aberto:'))
+
+        self.assertEqual(buyer.command('enviar_lance,%d,5' % auction_id),
+                         'ok')
+        self.assertEqual(seller.push(),
+                         '%d,comprador,5.000000,2,1\n' % auction_id)
+
+        end = 'fim_leilao,%d,5.00,comprador' % auction_id
+        self.assertEqual(seller.push(), end)
+        self.assertEqual(buyer.push(), end)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+# encoding: utf-8
+
+from __future__ import print_function
+
+import time
+import unittest
+
+import dados
+
+import comandos
+import leiloes
+import sequenciador
+from leiloes import Auction
+from usuarios import User
+
+
+class RecoveryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.publish = User.publish
+        User.publish = classmethod(lambda cls, *args: None)
+
+        User.ensure(1, 'ana')
+        User.ensure(2, 'bia')
+
+    def tearDown(self):
+        User.publish = self.publish
+
+    def bid(self, user_id, auction_id, value):
+        user = User.load(user_id)
+        user.seguindo.add(auction_id)
+        sequenciador.SEQUENCER.submit(auction_id, comandos._registra_lance,
+                                      user, auction_id, value)
+
+    def crash(self, snapshots):
+        # Simula uma queda: os leilões ficam no armazenamento como na
+        # última gravação em lote (snapshots), mas os lances feitos depois
+        # dela já estão gravados. Em seguida o servidor é reiniciado.
+        with leiloes.FLUSHLOCK:
+            leiloes.STORAGE.commit(snapshots, [])
+            Auction._sujos.clear()
+            Auction.load_all()
+            Auction.reconcile()
+
+    def test_recalcula_os_agregados_desatualizados(self):
+        a = Auction.new(1, 'bola', 'de futebol', 1.0, 1, 1, 2000, 0, 0, 0, 60)
+        sequenciador.SEQUENCER.submit(a.id, leiloes._open, a.id)
+        self.bid(1, a.id, 5.0)
+        snapshot = a.to_dict()
+        self.bid(2, a.id, 7.0)
+
+        self.crash([snapshot])
+        a = Auction.load(a.id)
+
+        self.assertEqual(a.bid_count, 2)
+        self.assertEqual(a.high_value, 7.0)
+        self.assertEqual(a.leader_id, 2)
+        self.assertEqual(a.last_bid, max(r[0] for r in
+                                         leiloes.Bid.rows_by_auction(a.id)))
+
+        # O prazo rearmado conta a partir do último lance
+        Auction.resume()
+        self.assertIn(a.id, leiloes.SCHEDULER.pending)
+        self.assertAlmostEqual(a.deadline(), time.time() + 60, delta=2)
+        leiloes.SCHEDULER.cancel(a.id)
+
+    def test_leilao_agendado_com_lances_estava_aberto(self):
+        a = Auction.new(1, 'bola', 'de futebol', 1.0, 1, 1, 2000, 0, 0, 0, 60)
+        snapshot = a.to_dict()
+        sequenciador.SEQUENCER.submit(a.id, leiloes._open, a.id)
+        self.bid(2, a.id, 3.0)
+
+        self.crash([snapshot])
+        a = Auction.load(a.id)
+
+        self.assertTrue(a.open)
+        self.assertEqual((a.bid_count, a.leader_id), (1, 2))
+        leiloes.SCHEDULER.cancel(a.id)
+
+    def test_leilao_em_dia_nao_muda(self):
+        a = Auction.new(1, 'bola', 'de futebol', 1.0, 1, 1, 2000, 0, 0, 0, 60)
+        sequenciador.SEQUENCER.submit(a.id, leiloes._open, a.id)
+        self.bid(1, a.id, 5.0)
+        snapshot = a.to_dict()
+
+        self.crash([snapshot])
+        a = Auction.load(a.id)
+
+        self.assertEqual((a.bid_count, a.last_bid, a.last_bid_time),
+                         (snapshot['bid_count'], snapshot['last_bid'],
+                          snapshot['last_bid_time']))
+        leiloes.SCHEDULER.cancel(a.id)
+
+
+if __name__ == '__main__':
+    unittest.main()
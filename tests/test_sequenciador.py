@@ -0,0 +1,58 @@
+# encoding: utf-8
+
+from __future__ import print_function
+
+import time
+import threading
+import unittest
+
+import dados
+
+import sequenciador
+
+
+class SequencerTest(unittest.TestCase):
+
+    def test_ordem_por_chave(self):
+        # As tarefas de uma mesma chave são executadas na ordem de envio.
+        sequencer = sequenciador.Sequencer(4)
+        done = []
+        tasks = [sequencer.submit(i % 3, done.append, i, wait=False)
+                 for i in range(300)]
+        for task in tasks:
+            task.get()
+
+        for key in range(3):
+            self.assertEqual([i for i in done if i % 3 == key],
+                             list(range(key, 300, 3)))
+
+    def test_chaves_disputadas_nao_travam_as_outras(self):
+        # Com mais chaves sempre ocupadas do que threads, uma tarefa de
+        # outra chave ainda é executada logo.
+        sequencer = sequenciador.Sequencer(2)
+        stop = threading.Event()
+
+        def flood(key):
+            while not stop.is_set():
+                sequencer.submit(key, time.sleep, 0.001, wait=False)
+                time.sleep(0.0002)
+
+        threads = [threading.Thread(target=flood, args=(key,))
+                   for key in ('a', 'b', 'c') for i in range(4)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        try:
+            time.sleep(0.2)
+            task = sequencer.submit('outra', lambda: 'ok', wait=False)
+            self.assertTrue(task.done.wait(5))
+            self.assertEqual(task.get(), 'ok')
+        finally:
+            stop.set()
+            for t in threads:
+                t.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
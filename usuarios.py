@@ -3,17 +3,40 @@
 from __future__ import print_function #Comando pra poder usar o função do em uma atualização no futuro
 
 import os
-import json
 import threading
+from collections import OrderedDict
 
+import armazenamento
+import metricas
 import lances
 import leiloes
+import notificacoes
 
 
 # Nome do arquivo referente aos usuários e lock usada para
 # sincronização na leitura e escrita do mesmo
-FILENAME = os.path.splitext(__file__)[0] + '.json'
-FILELOCK = threading.RLock() #semaforo
+FILENAME = os.path.join(armazenamento.DATA_DIR, 'usuarios.json')
+# Diário dos cadastros e deleções (veja armazenamento.JournalStorage); o
+# usuarios.json serve apenas de base para ele.
+JOURNAL_FILENAME = os.path.join(armazenamento.DATA_DIR, 'usuarios.jsonl')
+FILELOCK = metricas.TimedLock(threading.RLock(), 'usuarios.lock') #semaforo
+
+# Lock dos índices de sessões logadas (_logados, _sessoes, _seguidores e
+# _por_porta)
+SESSIONLOCK = metricas.TimedLock(threading.RLock(), 'usuarios.sessoes')
+
+# Ganchos do modo com vários processos (veja fragmentos.py):
+#   FORWARD     -> num fragmento, função (leilão, texto, chave, exclude)
+#                  que repassa as notificações ao processo da frente, onde
+#                  ficam as sessões
+#   FOLLOWED_BY -> no processo da frente, função (id do usuário) que
+#                  retorna os leilões seguidos, consultando os fragmentos
+FORWARD = None
+FOLLOWED_BY = None
+
+# Agrupador das notificações de lance (veja notificacoes.Coalescer), ou
+# None se o agrupamento está desligado.
+COALESCER = None
 
 
 class User(object):
@@ -29,6 +52,25 @@ class User(object):
     # Lista dos usuários logados
     _logados = [] 
 
+    # Índices das sessões logadas, mantidos junto com _logados:
+    #   _sessoes    -> id do usuário -> sessões logadas desse usuário
+    #   _seguidores -> id do leilão -> sessões logadas que seguem o leilão
+    #   _por_porta  -> porta remota do socket principal -> sessão
+    # Assim as notificações de um leilão chegam direto a quem interessa,
+    # sem percorrer todos os usuários logados.
+    _sessoes = {}
+    _seguidores = {}
+    _por_porta = {}
+
+    # Diretório de usuários cadastrados. É carregado do armazenamento uma
+    # única vez, na inicialização, e mantido em sincronia com ele a cada
+    # cadastro ou deleção. Os índices guardam os mesmos dicionários do
+    # arquivo json:
+    #   _por_nome -> nome do usuário -> registro
+    #   _por_id   -> id do usuário -> registro (na ordem do arquivo)
+    _por_nome = {}
+    _por_id = OrderedDict()
+
 
     @classmethod
     def get_user_by_socket_port(cls, port):
@@ -37,9 +79,11 @@ class User(object):
         # exceção.
         # Serve principalmente para vincular um usuário já conectado
         # ao seu socket recebedor.
-        for u in cls._logados:
-            if u.sender.getpeername()[1] == port: #getpeername metodo do socket que retorno uma lista em que o primeiro elemte é o host e o segundo é a porta
-                return u
+        with SESSIONLOCK:
+            u = cls._por_porta.get(port)
+
+        if u is not None:
+            return u
 
         raise Exception('Nenhum usuário disponível para o endereço especificado')
 
@@ -47,6 +91,103 @@ class User(object):
     def send_to_all(cls, what):
         pass 
 
+    @classmethod
+    def id_by_name(cls, name):
+        # Retorna o id do usuário com o nome informado, ou None.
+        u = cls._por_nome.get(name)
+        return None if u is None else u['id']
+
+    @classmethod
+    def followers(cls, auction_id):
+        # Retorna as sessões logadas que seguem o leilão informado.
+        with SESSIONLOCK:
+            return list(cls._seguidores.get(auction_id, ()))
+
+    @classmethod
+    def publish(cls, auction_id, text, key=None, exclude=None):
+        # Envia a notificação a todas as sessões logadas que seguem o
+        # leilão, exceto às do usuário cujo id é exclude. Com o
+        # agrupamento ligado, as notificações de lance (chave ('lance',
+        # leilão)) esperam a próxima janela do agrupador.
+        if FORWARD is not None:
+            FORWARD(auction_id, text, key, exclude)
+            return
+
+        if COALESCER is not None:
+            if key == ('lance', auction_id):
+                COALESCER.hold(auction_id, text, key, exclude)
+            else:
+                COALESCER.send(auction_id, text, key, exclude)
+            return
+
+        cls._deliver(auction_id, text, key, exclude)
+
+    @classmethod
+    def _deliver(cls, auction_id, text, key=None, exclude=None):
+        for u in cls.followers(auction_id): #u é cada sessão logada que segue o leilão
+            if u.id != exclude:
+                u.notify(text, key)
+
+    @classmethod
+    def subscribe(cls, user_id, auction_id):
+        # Inscreve todas as sessões logadas do usuário no leilão.
+        with SESSIONLOCK:
+            for u in cls._sessoes.get(user_id, ()):
+                cls._seguidores.setdefault(auction_id, set()).add(u)
+                u.seguindo.add(auction_id)
+
+    @classmethod
+    def unsubscribe(cls, user_id, auction_id):
+        # Retira todas as sessões logadas do usuário do leilão.
+        with SESSIONLOCK:
+            for u in cls._sessoes.get(user_id, ()):
+                u._unsubscribe(auction_id)
+
+    @classmethod
+    def drop_followers(cls, auction_id):
+        # Esquece todos os seguidores de um leilão que foi apagado.
+        with SESSIONLOCK:
+            for u in cls._seguidores.pop(auction_id, ()):
+                u.seguindo.discard(auction_id)
+
+    @classmethod
+    def _add_session(cls, user):
+        # Registra o usuário recém-logado e o inscreve nos leilões que ele
+        # segue. A sessão entra em _sessoes antes da consulta aos leilões,
+        # para que um entrar_leilao concorrente não se perca.
+        # A porta remota do socket principal é guardada aqui, uma única vez,
+        # para que o socket recebedor encontre a sessão sem nenhuma chamada
+        # a getpeername.
+        user.port = user.sender.getpeername()[1] #getpeername metodo do socket que retorno uma lista em que o primeiro elemte é o host e o segundo é a porta
+
+        with SESSIONLOCK:
+            cls._logados.append(user) #cls = classe user
+            cls._sessoes.setdefault(user.id, set()).add(user)
+            cls._por_porta[user.port] = user
+
+        if FOLLOWED_BY is not None:
+            followed = FOLLOWED_BY(user.id)
+        else:
+            followed = leiloes.Auction.followed_by(user.id)
+
+        for auction_id in followed:
+            with SESSIONLOCK:
+                if user in cls._sessoes.get(user.id, ()):
+                    cls._seguidores.setdefault(auction_id, set()).add(user)
+                    user.seguindo.add(auction_id)
+
+    @classmethod
+    def load_all(cls):
+        # Lê os usuários do armazenamento e monta os índices do diretório.
+        with FILELOCK:
+            users = STORAGE.load()
+
+            cls._por_nome.clear()
+            cls._por_id.clear()
+            for u in users:
+                cls._por_nome[u['name']] = u
+                cls._por_id[u['id']] = u
+
     @classmethod
     def signup(cls, socket, name, phone, address, email, password):
         # Tenta registrar com os dados providenciados.
@@ -55,67 +196,86 @@ class User(object):
         # É necessário o uso da Lock neste ponto a fim de não atrapalhar outra
         # thread numa eventual escrita no arquivo.
         with FILELOCK: #trava o acesso ao arquivo
-            with open(FILENAME) as f:
-                users = json.load(f)
-
-            # Corre a lista verificando se o usuário já existe
-            for u in users:
-                if u['name'] == name:  # Usuário já existe
-                    raise Exception('Usuário especificado já existe')
+            # Consulta o índice de nomes verificando se o usuário já existe
+            if name in cls._por_nome:  # Usuário já existe
+                raise Exception('Usuário especificado já existe')
 
             # Cria o id do novo usuário a partir do último id ou
             # atribui 1 se for o primeiro usuário do sistema
             try:
-                id = users[-1]['id'] + 1 #O id do próximo usuário é +1 ---- [-1] último da lista
-            except IndexError:
+                id = next(reversed(cls._por_id)) + 1 #O id do próximo usuário é +1 ---- último do diretório
+            except StopIteration:
                 id = 1
 
             # Cria e adiciona o dicionário com os dados do usuário
-            # à lista de usuários
+            # ao diretório de usuários
             user = {'name': name, 'phone': phone, 'address': address,
                     'email': email, 'password': password, 'id': id}
-            users.append(user)
+            cls._por_nome[name] = user
+            cls._por_id[id] = user
 
-            # Escreve no arquivo a lista atualizada de usuários
-            with open(FILENAME, 'w') as f: #write (w)
-                json.dump(users, f)
+            # Grava o novo usuário no armazenamento
+            cls._commit([user])
 
         # Loga e retorna o usuário
         user = cls(sender_socket=socket, **user) #######
-        cls._logados.append(user)
+        cls._add_session(user)
         return user
 
     @classmethod
     def login(cls, socket, name, password):
         # Tenta fazer login com as credenciais providenciadas.
         # Lança uma exceção se não encontrar.
-        user = None #criar uma variavel vazia 
+        # O nome é único, então basta uma consulta ao índice de nomes.
+        u = cls._por_nome.get(name)
 
-        # É necessário o uso da Lock neste ponto a fim de não atrapalhar outra
-        # thread numa eventual escrita no arquivo.
-        with FILELOCK:
-            with open(FILENAME) as f:
-                users = json.load(f)
-
-        for u in users:
-            if u['name'] == name and u['password'] == password:
-                user = cls(sender_socket=socket, **u) ##############
-
-        if user is not None:
-            cls._logados.append(user) #cls = classe user
+        if u is not None and u['password'] == password:
+            user = cls(sender_socket=socket, **u) ##############
+            cls._add_session(user)
             return user
 
         raise Exception('Usuário inexistente.')
 
     @classmethod
-    def load(cls, id): #carregar os dados do usuário sem fazer login, usado no leilão 
+    def ensure(cls, id, name):
+        # Garante que o diretório conhece o usuário, registrando apenas o
+        # id e o nome. Usado pelos fragmentos, que recebem os usuários do
+        # processo da frente a cada comando.
+        if id in cls._por_id:
+            return
+
         with FILELOCK:
-            with open(FILENAME) as f:
-                users = json.load(f)
+            if id in cls._por_id:
+                return
 
-            for u in users:
-                if u['id'] == id:
-                    return cls(sender_socket=None, **u)  ########
+            user = cls.placeholder(id, name)
+            cls._por_nome[name] = user
+            cls._por_id[id] = user
+            cls._commit([user])
+
+    @classmethod
+    def _commit(cls, saved=(), deleted=()):
+        # Grava as alterações do diretório, com FILELOCK em mãos. De tempos
+        # em tempos, o diário vira uma nova base (veja
+        # armazenamento.JournalStorage.compact).
+        STORAGE.commit(saved, deleted)
+
+        if STORAGE.needs_compaction():
+            STORAGE.compact(lambda: list(cls._por_id.values()))
+
+    @staticmethod
+    def placeholder(id, name):
+        # Registro de um usuário conhecido só pelo id e pelo nome, sem
+        # senha (veja ensure).
+        return {'name': name, 'phone': '', 'address': '', 'email': '',
+                'password': None, 'id': id}
+
+    @classmethod
+    def load(cls, id): #carregar os dados do usuário sem fazer login, usado no leilão 
+        u = cls._por_id.get(id)
+
+        if u is not None:
+            return cls(sender_socket=None, **u)  ########
 
         raise Exception('Usuário não encontrado.')
 
@@ -129,17 +289,48 @@ class User(object):
         self.password = password
         self.sender = sender_socket
         self.receiver = receiver_socket
+        self.seguindo = set()  # ids dos leilões em que a sessão está inscrita
+        self.port = None  # porta remota do socket principal, se logado
+        self.outbox = notificacoes.Outbox(self)
 
     def __str__(self): 
         return self.name #
 
     def bind_receiver_socket(self, socket):
         self.receiver = socket #Acoplar o socket recebedor 
+        self.outbox.resume()  # notificações que chegaram antes do vínculo
+
+    def _unsubscribe(self, auction_id):
+        # Retira esta sessão dos seguidores do leilão.
+        with SESSIONLOCK:
+            self.seguindo.discard(auction_id)
+            followers = self._seguidores.get(auction_id)
+            if followers is not None:
+                followers.discard(self)
+                if not followers:
+                    del self._seguidores[auction_id]
 
     def logout(self):
-        self._logados.remove(self) #remove da lista
+        self.outbox.close()
+
+        with SESSIONLOCK:
+            self._logados.remove(self) #remove da lista
+
+            sessions = self._sessoes.get(self.id)
+            if sessions is not None:
+                sessions.discard(self)
+                if not sessions:
+                    del self._sessoes[self.id]
+
+            if self._por_porta.get(self.port) is self:
+                del self._por_porta[self.port]
+
+            for auction_id in list(self.seguindo):
+                self._unsubscribe(auction_id)
+
         self.sender.close()
-        self.receiver.close()
+        if self.receiver is not None:  # Sessão sem socket recebedor
+            self.receiver.close()
 
     def recv(self, bs=1024):
         # envia e recebe ao mesmo tempo
@@ -149,37 +340,42 @@ class User(object):
         # envia e recebe ao mesmo tempo
         self.sender.send(text) #enviar o texto pra ele, usuário como resposta a algum comando dele (ok, not_ok)
 
-    def notify(self, text):
-        # envia e recebe ao mesmo tempo
-        self.receiver.send(text) #enviar pro socket receber dele, recebe as notificações do leilão 
+    def notify(self, text, key=None):
+        # Coloca a notificação na caixa de saída da sessão, sem esperar o
+        # envio pelo socket recebedor (veja notificacoes.Outbox). key
+        # identifica notificações que podem ser agrupadas.
+        metricas.count('notificacao.enfileirada')
+        self.outbox.put(text, key)
 
     def delete(self):
-        # Aplica a deleção de um usuário do sistema. Com isso, todos os
-        # leilões e lances desse usuário também são excluídos.
+        # Aplica a deleção de um usuário do sistema e encerra a sessão.
+        self.purge()
+        self.logout()
+
+    def purge(self):
+        # Apaga o usuário do diretório. Com isso, todos os leilões e lances
+        # desse usuário também são excluídos: os leilões, os lances feitos
+        # neles e os lances do próprio usuário saem num único lote em cada
+        # armazenamento. Retorna os ids dos leilões apagados.
         auctions = leiloes.Auction.filter_by_user(self.id)
-        for a in auctions:
-            a.delete() #
+        bids = lances.Bid.filter_by_user(self.id)
+        leiloes.Auction.delete_many(auctions, [b.id for b in bids])
+        leiloes.Auction.flush()  # grava as deleções junto com a do usuário
 
-        bids = lances.Bid.filter_by_user(self.id) #deleta os lances
-        for b in bids:
-            b.delete()
+        # Os leilões de outros vendedores em que o usuário deu lances
+        # precisam recalcular seus agregados (maior lance, líder...)
+        leiloes.Auction.recompute(set(b.auction_id for b in bids))
 
         with FILELOCK:
-            # abre o arquivo
-            with open(FILENAME) as f:
-                users = json.load(f)
-
-            # percorre até chegar neste usuário e remove da lista
-            for u in users:
-                if u['id'] == self.id:
-                    users.remove(u)
-                    break
+            # remove este usuário dos índices do diretório
+            u = self._por_id.pop(self.id, None)
+            if u is not None:
+                self._por_nome.pop(u['name'], None)
 
-            # salva no arquivo
-            with open(FILENAME, 'w') as f:
-                json.dump(users, f)
+            # apaga do armazenamento
+            self._commit(deleted=[self.id])
 
-        self.logout()
+        return [a.id for a in auctions]
 
 
 # Abaixo é feito o preparo do arquivo de usuários.
@@ -192,3 +388,30 @@ if not os.path.exists(FILENAME):
         # Escreve no arquivo uma "lista" json vazia.
         # Desta forma, deixamos o servidor preparado para ler e até mesmo
         # escrever json no arquivo.
+
+
+def open_storage(directory):
+    # Abre o armazenamento dos usuários de um diretório de dados (o do
+    # servidor ou o de um fragmento; veja fragmentos.Router.migrate). Os
+    # arquivos têm os mesmos nomes em qualquer diretório.
+    filename, journal_filename, sqlite_filename = [
+        os.path.join(directory, os.path.basename(name))
+        for name in (FILENAME, JOURNAL_FILENAME,
+                     armazenamento.SQLITE_FILENAME)]
+
+    return armazenamento.open_storage('usuarios', filename, journal_filename,
+                                      sqlite_filename)
+
+
+# O diretório é carregado uma única vez, aqui, logo após a garantia de que
+# o arquivo existe.
+STORAGE = open_storage(armazenamento.DATA_DIR)
+User.load_all()
+
+metricas.gauge('sessoes', lambda: len(User._logados))
+
+if notificacoes.COALESCE_WINDOW > 0:
+    COALESCER = notificacoes.Coalescer(notificacoes.COALESCE_WINDOW,
+                                       User._deliver)
+    metricas.gauge('notificacao.janela.pendentes',
+                   lambda: len(COALESCER.pending))